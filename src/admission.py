@@ -0,0 +1,133 @@
+import math
+import threading
+import time
+
+from metrics import REGISTRY
+
+BACKLOG = 1024  # connections the kernel queues before the accept loop takes them
+MAX_SESSIONS = 10000  # open connections, logged in or not
+MAX_LOGINS = 256  # connections between accept and a successful login
+RETRY_AFTER = 5  # seconds a client turned away for lack of capacity is told to wait
+MAX_REJECTING = 64  # busy replies being sent at once, past that connections are closed unanswered
+REJECT_TIMEOUT = 2  # seconds a busy reply may take, TLS handshake included
+MAX_TRACKED_IPS = 10000  # per-IP buckets kept before the full ones are dropped
+
+REJECTED = REGISTRY.counter("rps_connections_rejected_total", "Connections turned away at accept, by the limit they hit", ("reason",))
+OPEN_CONNECTIONS = REGISTRY.gauge("rps_open_connections", "Admitted connections, logged in or not")
+PENDING_LOGINS = REGISTRY.gauge("rps_pending_logins", "Admitted connections that have not logged in yet")
+
+
+class AdmissionControl:
+    # Decides at accept time whether a connection gets served. A connection counts against
+    # max_sessions until it closes and against max_logins until it logs in, which bounds both
+    # the sessions the server holds and the handshakes, password checks and queued work a
+    # connection storm can pile up. ip_rate is a token bucket per client address: ip_rate new
+    # connections a second with bursts of ip_burst. A limit of 0 turns it off.
+    def __init__(self, max_sessions=MAX_SESSIONS, max_logins=MAX_LOGINS, ip_rate=0, ip_burst=None):
+        self.max_sessions = max_sessions
+        self.max_logins = max_logins
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst or max(1, math.ceil(ip_rate))
+        self.connections = 0
+        self.logins = 0
+        self.rejecting = 0
+        # ip -> [tokens, time of the last refill]
+        self.buckets = {}
+        self.lock = threading.Lock()
+        OPEN_CONNECTIONS.set_function(lambda: self.connections)
+        PENDING_LOGINS.set_function(lambda: self.logins)
+
+    def admit(self, ip):
+        # None if the connection may go on, (reason, seconds to wait) if it is turned away.
+        # ip is None when the address is not known yet, the rate limit is then left to
+        # limit_rate.
+        with self.lock:
+            if self.ip_rate and ip is not None:
+                wait = self.take_token(ip, time.monotonic())
+                if wait:
+                    return self.rejected("rate", wait)
+            if self.max_sessions and self.connections >= self.max_sessions:
+                return self.rejected("sessions", RETRY_AFTER)
+            if self.max_logins and self.logins >= self.max_logins:
+                return self.rejected("logins", RETRY_AFTER)
+            self.connections += 1
+            self.logins += 1
+        return None
+
+    def limit_rate(self, ip):
+        # Rate limit alone, for an address learned after admit (PROXY protocol)
+        with self.lock:
+            wait = self.take_token(ip, time.monotonic()) if self.ip_rate and ip is not None else 0
+            return self.rejected("rate", wait) if wait else None
+
+    def rejected(self, reason, retry_after):
+        REJECTED.labels(reason).inc()
+        return reason, max(1, math.ceil(retry_after))
+
+    def take_token(self, ip, now):
+        # Called with the lock held. Seconds until the address gets a token, 0 if it had one.
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            if len(self.buckets) >= MAX_TRACKED_IPS:
+                self.prune(now)
+            bucket = self.buckets[ip] = [self.ip_burst, now]
+        tokens = min(self.ip_burst, bucket[0] + (now - bucket[1]) * self.ip_rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / self.ip_rate
+        bucket[0] = tokens - 1
+        return 0
+
+    def prune(self, now):
+        # A bucket that has refilled is the same as no bucket
+        for ip, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * self.ip_rate >= self.ip_burst:
+                del self.buckets[ip]
+
+    def logged_in(self):
+        with self.lock:
+            self.logins -= 1
+
+    def release(self, logged_in, held=False):
+        # The connection closed, logged_in tells whether logged_in() was called for it and
+        # held whether it was a session held for a resume, which had given its slot back
+        with self.lock:
+            if not held:
+                self.connections -= 1
+            if not logged_in:
+                self.logins -= 1
+
+    def hold(self):
+        # A logged in session lost its connection and waits for a resume
+        with self.lock:
+            self.connections -= 1
+
+    def resumed(self, held):
+        # A new connection, not logged in, resumed a session. If the session was held, the
+        # connection now counts as it; otherwise the session kept its slot and this one goes.
+        with self.lock:
+            self.logins -= 1
+            if not held:
+                self.connections -= 1
+
+    def begin_reject(self):
+        # False when enough busy replies are in flight, the connection is then just closed
+        with self.lock:
+            if self.rejecting >= MAX_REJECTING:
+                return False
+            self.rejecting += 1
+            return True
+
+    def end_reject(self):
+        with self.lock:
+            self.rejecting -= 1
+
+
+def peer_ip(addr):
+    # Client IP of an accepted connection, None for a Unix socket peer
+    return addr[0] if isinstance(addr, tuple) else None
+
+
+def busy_message(retry_after):
+    return f"Server busy, retry after {retry_after} s.\n"
@@ -0,0 +1,352 @@
+#!/bin/python3
+import asyncio
+import logging
+import signal
+import time
+
+from protocol import FrameDecoder, Outbox, SlowConsumerError, encode_frame, PROMPT, INFO, ERROR, CLOSE, BYTES_RECEIVED, BYTES_SENT, OUTBOX_LIMIT, WRITE_TIMEOUT
+from server import RPSGameServer, HANDSHAKE_TIMEOUT
+from session import enable_keepalive
+from admission import MAX_SESSIONS, REJECT_TIMEOUT, busy_message, peer_ip
+from proxy_protocol import read_header_async, ProxyProtocolError, HEADER_TIMEOUT
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+log = logging.getLogger("rps.async_server")
+
+
+class StreamConnection:
+    # Wraps an asyncio (reader, writer) pair so it can be registered in self.sessions like a
+    # socket. Like FramedSocket, a resumed session carries on over the streams of the client's
+    # new connection (take_over).
+    def __init__(self, reader, writer, on_stalled=None):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.closed = False
+        # Set while the connection is gone and the session waits for a resume
+        self.detached = False
+        self.attachments = 0
+        # Frames posted while the client is behind, drained by the `flushing` task
+        self.outbox = Outbox()
+        self.flushing = None
+        self.flushed_callbacks = []
+        self.on_stalled = on_stalled
+
+    @property
+    def _closed(self):
+        return self.closed
+
+    async def recv(self):
+        # The streams may be replaced by take_over while we wait on the old ones
+        reader, decoder = self.reader, self.decoder
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame.text.strip()
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionResetError("Connection closed by peer")
+            BYTES_RECEIVED.inc(len(data))
+            decoder.feed(data)
+
+    def write(self, data):
+        self.writer.write(data)
+        BYTES_SENT.inc(len(data))
+
+    async def drain(self):
+        try:
+            await asyncio.wait_for(self.writer.drain(), WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if self.on_stalled:
+                self.on_stalled(self)
+            raise SlowConsumerError(f"Client took no data for {WRITE_TIMEOUT} seconds") from None
+
+    async def send(self, data):
+        if self.closed:
+            return
+        if self.detached:
+            self.outbox.post(data)
+            return
+        # Posted frames go first, so frames arrive in the order they were produced
+        self.write(self.outbox.take() + data)
+        await self.drain()
+
+    def post(self, data, key=None, then=None):
+        # Queues an encoded frame without waiting, False if the outbox is full. then()
+        # runs once the frame is handed to the transport.
+        if self.closed:
+            return True
+        if self.detached:
+            if not self.outbox.post(data, key):
+                return False
+            if then:
+                self.flushed_callbacks.append(then)
+            return True
+        if not self.outbox and self.flushing is None and self.writer.transport.get_write_buffer_size() < OUTBOX_LIMIT:
+            self.write(data)
+            if then:
+                then()
+            return True
+        if not self.outbox.post(data, key):
+            return False
+        if then:
+            self.flushed_callbacks.append(then)
+        if self.flushing is None:
+            self.flushing = asyncio.get_running_loop().create_task(self.flush())
+        return True
+
+    async def flush(self):
+        try:
+            while self.outbox and not self.closed and not self.detached:
+                await self.drain()
+                if self.detached:
+                    return
+                self.write(self.outbox.take())
+            callbacks, self.flushed_callbacks = self.flushed_callbacks, []
+            for callback in callbacks:
+                callback()
+        except (SlowConsumerError, ConnectionError):
+            pass
+        finally:
+            self.flushing = None
+
+    def detach(self):
+        # The client's connection dropped, keep its frames until a new one is taken over
+        self.detached = True
+        self.writer.transport.abort()
+
+    def take_over(self, other):
+        # Carries on over the streams of `other`, a new connection from the same client,
+        # which is left closed. Bytes the client already sent on it stay in the decoder.
+        writer = self.writer
+        self.reader, self.writer, self.decoder = other.reader, other.writer, other.decoder
+        other.closed = True
+        self.detached = False
+        self.attachments += 1
+        # Ends the session's read if it is still waiting on the old connection
+        writer.transport.abort()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class AsyncRPSGameServer(RPSGameServer):
+    event_factory = asyncio.Event
+
+    def __init__(self, host='127.0.0.1', port=12345, **kwargs):
+        self.server = None
+        self.handler_tasks = set()
+        super().__init__(host, port, **kwargs)
+
+    def call_later(self, delay, callback):
+        return asyncio.get_running_loop().call_later(delay, callback)
+
+    def session_limit(self):
+        return MAX_SESSIONS
+
+    def setup_listener(self):
+        # The listening socket is created by asyncio.start_server in serve()
+        pass
+
+    async def send_message(self, conn, message, msg_type=INFO):
+        try:
+            if conn.closed:
+                return
+            if msg_type == PROMPT:
+                self.remember_prompt(conn, message)
+            await conn.send(encode_frame(msg_type, message))
+        except Exception as e:
+            log.warning("Error sending message: %s", e)
+
+    async def receive_frame(self, conn, timeout=None):
+        try:
+            return await asyncio.wait_for(conn.recv(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("timed out") from None
+
+    async def wait_event(self, event, timeout=None):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def call_blocking(self, func, args=()):
+        # Blocking calls (storage, the history scan) run off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def future_result(self, future):
+        return await asyncio.wrap_future(future)
+
+    async def run_steps(self, steps):
+        # Runs a handler generator as part of this task, awaiting each step it yields
+        value, error = None, None
+        while True:
+            try:
+                step = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                value, error = await self.step_runners[type(step)](*step), None
+            except BaseException as e:
+                value, error = None, e
+
+    async def handle_client(self, reader, writer):
+        conn = StreamConnection(reader, writer, self.close_stalled_client)
+        addr = writer.get_extra_info("peername")
+        rejected = self.admission.admit(None if self.proxy_protocol else peer_ip(addr))
+        if rejected:
+            await self.reject(reader, writer, addr, *rejected)
+            return
+        task = asyncio.current_task()
+        self.handler_tasks.add(task)
+        if self.listener != "unix":
+            enable_keepalive(writer.get_extra_info("socket"))
+        try:
+            try:
+                if self.proxy_protocol:
+                    addr = await asyncio.wait_for(read_header_async(reader), HEADER_TIMEOUT) or addr
+                    rejected = self.admission.limit_rate(peer_ip(addr))
+                    if rejected:
+                        self.admission.release(False)
+                        await self.reply_busy(writer, addr, *rejected)
+                        return
+                if self.ssl_context:
+                    await self.tls_handshake(writer)
+            except BaseException:
+                self.admission.release(False)
+                raise
+            self.sessions.open(conn, addr)
+            await self.run_steps(self.welcome(conn))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except (ProxyProtocolError, asyncio.LimitOverrunError, asyncio.TimeoutError) as e:
+            log.info("Connection setup with %s failed: %s", addr, e)
+            writer.transport.abort()
+        except Exception as e:
+            log.warning("Error handling client %s: %s", addr, e)
+        finally:
+            self.close_connection(conn)
+            self.handler_tasks.discard(task)
+
+    async def reject(self, reader, writer, addr, reason, retry_after):
+        if not self.admission.begin_reject():
+            log.debug("Rejecting %s: %s limit reached", addr, reason)
+            writer.transport.abort()
+            return
+        try:
+            if self.proxy_protocol:
+                await asyncio.wait_for(read_header_async(reader), REJECT_TIMEOUT)
+            await self.reply_busy(writer, addr, reason, retry_after)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ProxyProtocolError):
+            writer.transport.abort()
+        finally:
+            self.admission.end_reject()
+
+    async def reply_busy(self, writer, addr, reason, retry_after):
+        log.debug("Rejecting %s: %s limit reached", addr, reason)
+        try:
+            if self.ssl_context:
+                await writer.start_tls(self.ssl_context, ssl_handshake_timeout=REJECT_TIMEOUT)
+            writer.write(encode_frame(ERROR, busy_message(retry_after)) + encode_frame(CLOSE, ""))
+            await asyncio.wait_for(writer.drain(), REJECT_TIMEOUT)
+            writer.close()
+        except (OSError, asyncio.TimeoutError):
+            writer.transport.abort()
+
+    async def tls_handshake(self, writer):
+        # The listener is plain TCP and each connection upgrades itself, which lets us time the handshake
+        started = time.perf_counter()
+        await writer.start_tls(self.ssl_context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+        resumed = writer.get_extra_info("ssl_object").session_reused
+        self.login_stats.record_handshake(time.perf_counter() - started, resumed)
+
+    def post(self, conn, data, key=None, then=None):
+        # The transport buffers the write, a client that is behind gets an outbox drained by a task
+        if not conn.post(data, key, then):
+            self.slow_client(conn)
+
+    def close_stalled_client(self, conn):
+        super().close_stalled_client(conn)
+        # Its TLS close would never complete either
+        conn.writer.transport.abort()
+
+    def close_idle_session(self, session):
+        conn = session.conn
+
+        def close():
+            self.close_connection(conn)
+            # A vanished peer never completes the TLS close, drop the transport so the
+            # session's pending read returns and its handler unwinds
+            self.call_later(1, conn.writer.transport.abort)
+
+        self.post(conn, encode_frame(CLOSE, "Disconnected for inactivity.\n"), then=close)
+
+    def raise_fd_limit(self):
+        # Every idle connection holds a file descriptor, lift the soft limit as far as allowed
+        if resource is None:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError) as e:
+                log.warning("Could not raise file descriptor limit: %s", e)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.cancel)
+            except NotImplementedError:
+                pass
+
+        if self.listener == "unix":
+            self.remove_unix_socket()
+            self.server = await asyncio.start_unix_server(self.handle_client, self.unix_path, backlog=self.backlog)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle_client,
+                self.host,
+                self.port,
+                backlog=self.backlog,
+            )
+        log.info("%s server started on %s", "Secure" if self.ssl_context else "Plaintext", self.address())
+        self.schedule_idle_check()
+        self.schedule_rematch()
+        self.report_startup()
+        async with self.server:
+            try:
+                await stop
+            except asyncio.CancelledError:
+                pass
+        self.shutdown()
+        # Closing the writers wakes every pending read, let the handlers unwind on their own
+        if self.handler_tasks:
+            await asyncio.wait(self.handler_tasks, timeout=5)
+
+    def shutdown(self):
+        conns = [session.conn for session in self.sessions.all()]
+        super().shutdown()
+        for conn in conns:
+            # Don't wait for the TLS close_notify exchange, drop the transport right away
+            conn.writer.transport.abort()
+
+    def close_listener(self):
+        if self.server is not None:
+            self.server.close()
+            if self.listener == "unix":
+                self.remove_unix_socket()
+
+    def run(self):
+        log.info("Server is running (asyncio)...")
+        self.raise_fd_limit()
+        asyncio.run(self.serve())
+
@@ -0,0 +1,101 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import REGISTRY
+
+KDF_ITERATIONS = 200_000
+SALT_BYTES = 16
+
+TLS_HANDSHAKE_SECONDS = REGISTRY.histogram("rps_tls_handshake_seconds", "Server side TLS handshake time", ("resumed",))
+PASSWORD_CHECK_SECONDS = REGISTRY.histogram("rps_password_check_seconds", "Time to verify a login password")
+
+
+def hash_password(password, iterations=KDF_ITERATIONS, salt=None):
+    # Stored as "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>"
+    salt = salt or os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, stored):
+    if "$" not in stored:
+        # Unsalted sha256 hex digest written by older servers
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    algorithm, iterations, salt, expected = stored.split("$")
+    if algorithm != "pbkdf2_sha256":
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def needs_rehash(stored, iterations=KDF_ITERATIONS):
+    if "$" not in stored:
+        return True
+    return int(stored.split("$")[1]) != iterations
+
+
+class PasswordHasher:
+    # Runs the KDF in worker processes so hashing never holds the GIL of the server
+    # process or blocks an event loop. Methods return concurrent.futures.Future objects.
+    def __init__(self, iterations=KDF_ITERATIONS, workers=None):
+        self.iterations = iterations
+        # spawn: forking a process that already runs threads can deadlock the child
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def hash(self, password):
+        return self.pool.submit(hash_password, password, self.iterations)
+
+    def verify(self, password, stored):
+        return self.pool.submit(verify_password, password, stored)
+
+    def needs_rehash(self, stored):
+        return needs_rehash(stored, self.iterations)
+
+    def close(self):
+        # Waits for the KDFs already running, at most one per worker, so no pool process outlives us
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+class LoginStats:
+    # Splits connection setup cost into TLS handshake and credential verification
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+        self.handshake_time = 0.0
+        self.logins = 0
+        self.auth_time = 0.0
+
+    def record_handshake(self, seconds, resumed):
+        TLS_HANDSHAKE_SECONDS.labels("true" if resumed else "false").observe(seconds)
+        with self.lock:
+            self.handshakes += 1
+            self.resumed_handshakes += resumed
+            self.handshake_time += seconds
+
+    def record_auth(self, seconds):
+        PASSWORD_CHECK_SECONDS.observe(seconds)
+        with self.lock:
+            self.logins += 1
+            self.auth_time += seconds
+
+    def average_auth(self):
+        with self.lock:
+            return self.auth_time / self.logins if self.logins else 0.0
+
+    def resumption_rate(self):
+        return self.resumed_handshakes / self.handshakes if self.handshakes else 0.0
+
+    def summary(self):
+        with self.lock:
+            handshake_ms = 1000 * self.handshake_time / self.handshakes if self.handshakes else 0.0
+            auth_ms = 1000 * self.auth_time / self.logins if self.logins else 0.0
+            return (
+                f"TLS handshakes: {self.handshakes} ({self.resumed_handshakes} resumed, "
+                f"{100 * self.resumption_rate():.1f}% hit rate), avg {handshake_ms:.2f} ms\n"
+                f"Password checks: {self.logins}, avg {auth_ms:.2f} ms"
+            )
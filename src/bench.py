@@ -0,0 +1,687 @@
+#!/bin/python3
+import json
+import os
+import random
+import re
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from client import RPSGameClient
+from protocol import PROMPT, INFO, RESULT, ERROR
+from proxy_protocol import encode_v1
+from rules import VARIANTS, DRAW, FIRST, SECOND, VOID
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+LEGACY_BEATS = [("rock", "scissors"), ("scissors", "paper"), ("paper", "rock")]
+LEGACY_WINNING_MOVES = {"rock": "scissors", "paper": "rock", "scissors": "paper"}
+RETRY_DELAY = 0.2  # seconds between two attempts to join or start a tournament
+BUSY_RETRIES = 5  # times a bot the server turned away comes back after the wait it was told
+BUSY_REPLY = re.compile(r"Server busy, retry after (\d+) s")
+
+
+class BenchStats:
+    # Counters and latency samples shared by every bot of a run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.connections = 0
+        self.failed_connections = 0
+        self.completed_sessions = 0
+        self.aborted_sessions = 0
+        self.busy_rejections = 0
+        self.drops = 0
+        self.resumes = 0
+        self.failed_resumes = 0
+        self.match_results = 0
+        self.bot_games = 0
+        self.tournaments = 0
+
+    def record_latency(self, command, seconds):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(seconds)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class BotClient(RPSGameClient):
+    # Headless client that answers prompts from a script instead of input(). It registers,
+    # logs in, plays `games` quick play games and `bot_games` games against the server's bot
+    # with random moves, browses the rankings and, if it has a tournament, creates and starts
+    # it or joins it, then quits. With `drops`, its first quick play moves are not sent:
+    # the connection goes away instead and the bot reconnects and resumes its session.
+    def __init__(self, host, port, username, stats, games=5, tournament=None, creator=False,
+                 tournament_size=2, timeout=60, bot_games=0, tls=True, unix_path=None, proxy_source=None, drops=0):
+        super().__init__(host, port, tls, unix_path)
+        # Address a PROXY protocol v1 header claims the bot connects from, like a load balancer would
+        self.proxy_source = proxy_source
+        self.username = username
+        self.password = uuid.uuid4().hex
+        self.stats = stats
+        self.games_left = games
+        self.drops_left = drops
+        self.bot_games_left = bot_games
+        self.browse_rankings = True
+        self.tournament = tournament
+        self.creator = creator
+        self.tournament_size = tournament_size
+        self.timeout = timeout
+        self.tournament_deadline = None
+        self.registering = True
+        self.done = False
+        self.command = None
+        self.sent_at = None
+        self.listing = ""
+        self.pages_left = 0
+        self.retry_after = None
+
+    def run(self):
+        for registering in (True, False):
+            self.registering = registering
+            if not self.session():
+                return
+
+    def session(self):
+        # True if the script went through, reconnecting when the server says it is busy
+        for _ in range(BUSY_RETRIES):
+            self.retry_after = None
+            done = self.attempt()
+            if self.retry_after is None:
+                return done
+            time.sleep(self.retry_after)
+        return False
+
+    def attempt(self):
+        # One connection, True if it went through the whole script
+        self.done = False
+        try:
+            self.connect()
+            self.client_socket.settimeout(self.timeout)
+        except OSError:
+            self.stats.count("failed_connections")
+            self.disconnect()
+            return False
+        self.stats.count("connections")
+        try:
+            self.game_loop()
+        finally:
+            self.disconnect()
+        if self.retry_after is not None:
+            self.stats.count("busy_rejections")
+        else:
+            self.stats.count("completed_sessions" if self.done else "aborted_sessions")
+        return self.done
+
+    def open_socket(self):
+        sock = super().open_socket()
+        if self.proxy_source:
+            sock.sendall(encode_v1(self.proxy_source, (self.server_host, self.server_port)))
+        return sock
+
+    def display(self, text):
+        pass
+
+    def send_message(self, message):
+        self.sent_at = time.perf_counter()
+        return super().send_message(message)
+
+    def receive_message(self):
+        frame = super().receive_message()
+        # Time from our reply to the first frame of the server's answer
+        if frame is not None and self.sent_at is not None:
+            self.stats.record_latency(self.command, time.perf_counter() - self.sent_at)
+            self.sent_at = None
+        return frame
+
+    def handle_server_message(self, frame):
+        text = frame.text
+        if frame.type == PROMPT and self.drops_left and "Match found" in text:
+            self.drops_left -= 1
+            self.drop_connection()
+            return True
+        if frame.type == PROMPT and "Resume (3)" in text and self.resume_token:
+            self.command = "resume"
+        if frame.type == INFO:
+            self.listing = text
+            if text.startswith("Registration successful"):
+                self.done = True
+            elif text.startswith("Session resumed"):
+                self.stats.count("resumes")
+            elif text.startswith("Successfully joined tournament"):
+                self.tournament = None
+            elif text.startswith(f"Tournament '{self.tournament}' created"):
+                self.tournament_deadline = time.monotonic() + self.timeout
+        elif frame.type == RESULT:
+            if text.startswith("Tournament '"):
+                if text.rstrip().endswith(f"Winner: {self.username}"):
+                    self.stats.count("tournaments")
+            elif self.command == "move":
+                self.stats.count("match_results")
+            elif self.command == "bot_move":
+                self.stats.count("bot_games")
+        elif frame.type == ERROR and self.command == "resume":
+            self.stats.count("failed_resumes")
+        elif frame.type == ERROR and BUSY_REPLY.match(text):
+            self.retry_after = int(BUSY_REPLY.match(text).group(1))
+        elif frame.type == ERROR and self.command == "start" and time.monotonic() > self.tournament_deadline:
+            # Nobody joined in time
+            self.tournament = None
+        return super().handle_server_message(frame)
+
+    def drop_connection(self):
+        # A flaky link: the connection goes away without a word, the bot comes back on a new
+        # one and the server's welcome prompt gets the resume token
+        self.stats.count("drops")
+        self.disconnect()
+        self.connect()
+        self.client_socket.settimeout(self.timeout)
+
+    def reply(self, command, reply):
+        self.command = command
+        return reply
+
+    def read_reply(self, frame):
+        text = frame.text
+        if "Login (1)" in text:
+            return self.reply("hello", "2" if self.registering else "1")
+        if "username" in text:
+            return self.reply("username", self.username)
+        if "password" in text:
+            return self.reply("register" if self.registering else "login", self.password)
+        if text.startswith("Available commands"):
+            return self.next_command()
+        if "against the bot" in text:
+            return self.reply("bot_move", pick_move(text))
+        if "Play your move" in text:
+            return self.reply("move", pick_move(text))
+        if "[b]ack" in text:
+            if self.pages_left:
+                self.pages_left -= 1
+                return self.reply("rankings", random.choice("npm"))
+            return self.reply("rankings", "b")
+        if "tournament name" in text:
+            return self.reply("create", self.tournament)
+        if "number to join" in text:
+            return self.reply("join", self.pick_tournament())
+        if "number to start" in text:
+            return self.reply("start", self.pick_tournament(started=True))
+        return self.reply("unknown", "6")
+
+    def next_command(self):
+        if self.games_left:
+            self.games_left -= 1
+            return self.reply("play", "1")
+        if self.bot_games_left:
+            self.bot_games_left -= 1
+            return self.reply("play_bot", "8")
+        if self.browse_rankings:
+            self.browse_rankings = False
+            self.pages_left = 2
+            return self.reply("rankings", "2")
+        if self.tournament is not None:
+            if self.tournament_deadline is None:
+                self.tournament_deadline = time.monotonic() + self.timeout
+                if self.creator:
+                    return self.reply("create", "3")
+            elif time.monotonic() > self.tournament_deadline:
+                self.tournament = None
+                return self.next_command()
+            else:
+                time.sleep(RETRY_DELAY)
+            return self.reply("start", "5") if self.creator else self.reply("join", "4")
+        self.done = True
+        return self.reply("quit", "6")
+
+    def pick_tournament(self, started=False):
+        # Number of our tournament in the listing sent just before the prompt, 0 to try again later
+        for line in self.listing.splitlines():
+            number, _, rest = line.partition(". ")
+            if not number.isdigit() or not rest.startswith(f"{self.tournament} ("):
+                continue
+            if started:
+                players = int(rest.rsplit("Players: ", 1)[1].rstrip(")"))
+                if players < self.tournament_size and time.monotonic() < self.tournament_deadline:
+                    return "0"
+                self.tournament = None
+            return number
+        return "0"
+
+
+def process_rss(pid):
+    # Resident memory in bytes of a process and all its children (Linux /proc), None if unknown
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += f.read().split()
+    except OSError:
+        pass
+    return rss + sum(process_rss(int(child)) or 0 for child in children)
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            rss = process_rss(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        rss = process_rss(self.pid)
+        if rss is not None:
+            self.samples.append(rss)
+
+
+def percentiles(samples):
+    if len(samples) < 2:
+        return {f"p{p}": round(1000 * samples[0], 3) if samples else None for p in (50, 95, 99)}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {f"p{p}": round(1000 * cuts[p - 1], 3) for p in (50, 95, 99)}
+
+
+def raise_fd_limit():
+    # Every bot holds a socket
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def process_cpu(pid):
+    # CPU seconds, user and system, used by a process and its children that are still running
+    # (Linux /proc), None if unknown
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += f.read().split()
+    except OSError:
+        pass
+    return cpu + sum(process_cpu(int(child)) or 0 for child in children)
+
+
+def wait_for_server(host, port, unix_path=None, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if unix_path:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(unix_path)
+            else:
+                socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def start_server(args, data_dir):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+               "--host", args.host, "--port", str(args.port),
+               "--data-path", os.path.join(data_dir, "bench.db"), "--history-path", os.path.join(data_dir, "matches.bin"),
+               "--listener", args.listener,
+               *shlex.split(args.server_args)]
+    if args.listener == "unix":
+        command += ["--unix-path", args.unix_path]
+    if args.proxy_protocol:
+        command.append("--proxy-protocol")
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    wait_for_server(args.host, args.port, args.unix_path if args.listener == "unix" else None)
+    return server
+
+
+def run_bots(args, stats):
+    run_id = uuid.uuid4().hex[:6]
+    bots = []
+    size = args.tournament_size
+    for number in range(args.bots):
+        tournament = creator = None
+        if size >= 2 and number < args.bots - args.bots % size:
+            tournament = f"bench-{run_id}-{number // size}"
+            creator = number % size == 0
+        # Every bot claims its own address, so per-IP limits see them as distinct clients
+        proxy_source = (f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}", 40000 + number % 20000) if args.proxy_protocol else None
+        bots.append(BotClient(args.host, args.port, f"bot-{run_id}-{number}", stats, args.games,
+                              tournament, creator, size, args.timeout, args.bot_games, args.listener == "tls",
+                              args.unix_path if args.listener == "unix" else None, proxy_source, args.drops))
+
+    # Thousands of bot threads, keep their stacks small
+    threading.stack_size(256 * 1024)
+    threads = [threading.Thread(target=bot.run, daemon=True) for bot in bots]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def report(args, stats, elapsed, rss_samples, server_cpu):
+    all_latencies = [sample for samples in stats.latencies.values() for sample in samples]
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": args.label,
+        "commit": git_commit(),
+        "params": {
+            "bots": args.bots,
+            "games": args.games,
+            "bot_games": args.bot_games,
+            "tournament_size": args.tournament_size,
+            "drops": args.drops,
+            "server_args": args.server_args if args.spawn_server else None,
+            "listener": args.listener,
+            "proxy_protocol": args.proxy_protocol,
+        },
+        "metrics": {
+            "elapsed": round(elapsed, 3),
+            "connections": stats.connections,
+            "failed_connections": stats.failed_connections,
+            "aborted_sessions": stats.aborted_sessions,
+            "busy_rejections": stats.busy_rejections,
+            "drops": stats.drops,
+            "resumes": stats.resumes,
+            "failed_resumes": stats.failed_resumes,
+            "connections_per_sec": round(stats.connections / elapsed, 2),
+            "matches_per_sec": round(stats.match_results / 2 / elapsed, 2),
+            "bot_games_per_sec": round(stats.bot_games / elapsed, 2),
+            "tournaments": stats.tournaments,
+            "latency_ms": percentiles(all_latencies),
+            "command_latency_ms": {command: percentiles(samples) for command, samples in sorted(stats.latencies.items())},
+            "server_rss_peak_mb": round(max(rss_samples) / 2 ** 20, 1) if rss_samples else None,
+            "server_rss_end_mb": round(rss_samples[-1] / 2 ** 20, 1) if rss_samples else None,
+            # Server CPU time over the run per connection a bot made: handshake, login and games
+            "server_cpu_ms_per_connection": round(1000 * server_cpu / stats.connections, 3) if server_cpu is not None and stats.connections else None,
+        },
+    }
+
+
+def load_previous(path, result):
+    # Latest stored run with the same label and parameters
+    previous = None
+    try:
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["label"] == result["label"] and entry["params"] == result["params"]:
+                    previous = entry
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def print_report(result, previous):
+    metrics = result["metrics"]
+    old = previous["metrics"] if previous else {}
+
+    def show(name, value, old_value):
+        line = f"  {name:<30}{value}"
+        if isinstance(value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+            line += f"  ({100 * (value - old_value) / old_value:+.1f}% vs {previous['commit'] or previous['time']})"
+        print(line)
+
+    print(f"Benchmark '{result['label']}' at {result['commit'] or 'unknown commit'}:")
+    for name in ("elapsed", "connections", "failed_connections", "aborted_sessions", "busy_rejections", "drops", "resumes",
+                 "failed_resumes", "connections_per_sec",
+                 "matches_per_sec", "bot_games_per_sec", "tournaments", "server_rss_peak_mb", "server_rss_end_mb",
+                 "server_cpu_ms_per_connection"):
+        show(name, metrics[name], old.get(name))
+    for name, value in metrics["latency_ms"].items():
+        show(f"latency {name} (ms)", value, old.get("latency_ms", {}).get(name))
+    print("  per command p50/p95/p99 (ms):")
+    for command, values in metrics["command_latency_ms"].items():
+        print(f"    {command:<10}{values['p50']} / {values['p95']} / {values['p99']}")
+
+
+def pick_move(prompt):
+    # Random move among those the prompt lists, so bots play whichever variant the server runs
+    return random.choice(prompt.rsplit("Play your move:", 1)[1].strip().split(", "))
+
+
+def legacy_outcome(move1, move2):
+    # Quick play rules as determine_winner used to check them, for --rules
+    if move1 not in ["rock", "paper", "scissors"] or move2 not in ["rock", "paper", "scissors"]:
+        return VOID
+    if move1 == move2:
+        return DRAW
+    return FIRST if (move1, move2) in LEGACY_BEATS else SECOND
+
+
+def legacy_tournament_outcome(move1, move2):
+    # And as determine_tournament_winner did
+    if move1 not in ["rock", "paper", "scissors"] or move2 not in ["rock", "paper", "scissors"]:
+        return VOID
+    if move1 == move2:
+        return DRAW
+    return FIRST if LEGACY_WINNING_MOVES[move1] == move2 else SECOND
+
+
+def bench_rules(games, variant):
+    # Resolves `games` random games with the old rule checks, the rules engine one game at a
+    # time, and the rules engine in one batch, and reports games resolved per second
+    from rules import numpy
+
+    rules = VARIANTS[variant]
+    # A few invalid moves, like the ones players type
+    moves = rules.moves + ("rok",)
+    moves1 = [random.choice(moves) for _ in range(games)]
+    moves2 = [random.choice(moves) for _ in range(games)]
+
+    def timed(resolve):
+        started = time.perf_counter()
+        outcomes = resolve()
+        return outcomes, time.perf_counter() - started
+
+    results = {}
+    if variant == "rps":
+        results["determine_winner checks"] = timed(lambda: [legacy_outcome(a, b) for a, b in zip(moves1, moves2)])
+        results["determine_tournament_winner checks"] = timed(lambda: [legacy_tournament_outcome(a, b) for a, b in zip(moves1, moves2)])
+    results["rules.outcome per game"] = timed(lambda: [rules.outcome(a, b) for a, b in zip(moves1, moves2)])
+    results["encode + rules.outcomes"] = timed(lambda: rules.outcomes([rules.code(m) for m in moves1], [rules.code(m) for m in moves2]))
+    # Moves kept as codes from the start, as an array with NumPy
+    codes1 = [rules.code(move) for move in moves1]
+    codes2 = [rules.code(move) for move in moves2]
+    if numpy is not None:
+        codes1, codes2 = numpy.array(codes1, numpy.intp), numpy.array(codes2, numpy.intp)
+    results["rules.outcomes on codes"] = timed(lambda: rules.outcomes(codes1, codes2))
+
+    expected = results["rules.outcome per game"][0]
+    print(f"Rules engine '{variant}' ({'NumPy' if numpy is not None else 'pure Python'}), {games} games:")
+    for name, (outcomes, seconds) in results.items():
+        assert [int(outcome) for outcome in outcomes] == expected, name
+        print(f"  {name:<36}{round(games / seconds)} games/sec")
+
+
+def bench_bot_engine(games, rounds):
+    # The server's bot engine on its own: `games` games asking for a move at once, `rounds`
+    # times. Reports bot moves computed per second and the time one batch takes.
+    from strategy import BotEngine, numpy
+
+    engine = BotEngine(call_later=lambda delay, callback: None)
+    players = [engine.new_game(f"player-{number}") for number in range(games)]
+    tick_times = []
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for game in players:
+            engine.request(game)
+        tick_started = time.perf_counter()
+        engine.tick()
+        tick_times.append(time.perf_counter() - tick_started)
+        for game in players:
+            game.round = 1
+            game.play(random.choice(engine.rules.moves))
+    elapsed = time.perf_counter() - started
+    latency = percentiles(tick_times)
+    print(f"Bot engine ({'NumPy' if numpy is not None else 'pure Python'}), {games} games x {rounds} rounds:")
+    print(f"  predictions/sec         {round(games * rounds / sum(tick_times))}")
+    print(f"  rounds/sec end to end   {round(games * rounds / elapsed)}")
+    print(f"  batch p50/p95/p99 (ms)  {latency['p50']} / {latency['p95']} / {latency['p99']}")
+
+
+def bench_spectators(players):
+    # A tournament of `players` bots played out in process, watched by one spectator who reads
+    # every update and one who never reads. Checks that every update fits in a spectator's
+    # outbox and reports the largest one and the time to publish it.
+    from protocol import Outbox, OUTBOX_LIMIT
+    from spectators import SpectatorHub
+    from tournament import TournamentRunner, format_lobby, format_bracket, format_update, format_result
+
+    names = [f"player-{number}" for number in range(players)]
+    outboxes = {"reader": Outbox(), "idle": Outbox()}
+    sizes, rejected = [], []
+
+    def post(conn, data, key=None):
+        sizes.append(len(data))
+        if not outboxes[conn].post(data, key):
+            rejected.append(conn)
+
+    hub = SpectatorHub(post)
+    channel = hub.channel("bench", format_lobby("bench", names[:1]))
+    for conn in outboxes:
+        channel.subscribe(conn)
+    publish_times = []
+
+    def publish(update, state):
+        started = time.perf_counter()
+        channel.publish(update, state)
+        publish_times.append(time.perf_counter() - started)
+        outboxes["reader"].take()
+
+    for count in range(2, players + 1):
+        publish(f"{names[count - 1]} joined 'bench'.\n", format_lobby("bench", names[:count]))
+    runner = TournamentRunner(names, lambda match: (match.players[0], f"{match.players[0]} wins with rock!\n"),
+                              lambda champion: channel.close(format_result("bench", champion)),
+                              call_later=lambda delay, callback: None,
+                              on_update=lambda match: publish(format_update("bench", runner.bracket, match), format_bracket("bench", runner.bracket)))
+    runner.start()
+    while not runner.finished:
+        for match in list(runner.round_matches):
+            runner.finish_match(match)
+
+    latency = percentiles(publish_times)
+    print(f"Spectators of a {players} player tournament, {len(publish_times)} updates:")
+    print(f"  largest update          {max(sizes)} bytes (outbox limit {OUTBOX_LIMIT})")
+    print(f"  publish p50/p95/p99 (ms) {latency['p50']} / {latency['p95']} / {latency['p99']}")
+    assert not rejected, f"{len(rejected)} updates did not fit in a spectator's outbox"
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the RPS game server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--bots", type=int, default=100, help="concurrent bot sessions")
+    parser.add_argument("--games", type=int, default=5, help="quick play games per bot")
+    parser.add_argument("--bot-games", type=int, default=0, help="games against the server's bot per bot")
+    parser.add_argument("--drops", type=int, default=0,
+                        help="quick play matches per bot where the bot drops its connection at the move prompt and resumes")
+    parser.add_argument("--tournament-size", type=int, default=4,
+                        help="bots per tournament, 0 to skip tournaments")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds a bot waits for the server")
+    parser.add_argument("--spawn-server", action="store_true",
+                        help="start a server with a throwaway database for the run (run from the directory with server.crt)")
+    parser.add_argument("--server-args", default="", help="extra arguments for the spawned server, e.g. \"--mode async\"")
+    parser.add_argument("--listener", choices=("tls", "tcp", "unix"), default="tls",
+                        help="how bots reach the server, passed on to a spawned server; tcp and unix are plaintext")
+    parser.add_argument("--unix-path", default="rps.sock", help="server socket file for --listener unix")
+    parser.add_argument("--proxy-protocol", action="store_true",
+                        help="bots start every connection with a PROXY protocol v1 header, each with its own address")
+    parser.add_argument("--server-pid", type=int, help="pid of a running server to sample memory from")
+    parser.add_argument("--label", default="default", help="name runs are compared under")
+    parser.add_argument("--results", default="bench_results.jsonl", help="file the results are appended to")
+    parser.add_argument("--bot-engine", type=int, metavar="GAMES",
+                        help="only benchmark the bot engine in process with this many concurrent games")
+    parser.add_argument("--bot-engine-rounds", type=int, default=100, help="rounds per game for --bot-engine")
+    parser.add_argument("--rules", type=int, metavar="GAMES",
+                        help="only microbenchmark resolving this many games with the rules engine against the old checks")
+    parser.add_argument("--variant", choices=sorted(VARIANTS), default="rps", help="game variant for --rules")
+    parser.add_argument("--spectate", type=int, metavar="PLAYERS",
+                        help="only check in process that a tournament of this many players can be watched")
+    args = parser.parse_args()
+
+    if args.rules:
+        bench_rules(args.rules, args.variant)
+        return
+    if args.spectate:
+        bench_spectators(args.spectate)
+        return
+    if args.bot_engine:
+        bench_bot_engine(args.bot_engine, args.bot_engine_rounds)
+        return
+
+    raise_fd_limit()
+    with tempfile.TemporaryDirectory() as data_dir:
+        server = start_server(args, data_dir) if args.spawn_server else None
+        pid = server.pid if server else args.server_pid
+        sampler = RSSSampler(pid) if pid else None
+        if sampler:
+            sampler.start()
+        cpu_started = process_cpu(pid) if pid else None
+        stats = BenchStats()
+        server_cpu = None
+        try:
+            elapsed = run_bots(args, stats)
+        finally:
+            if sampler:
+                sampler.stop()
+            if cpu_started is not None:
+                cpu_ended = process_cpu(pid)
+                server_cpu = cpu_ended - cpu_started if cpu_ended is not None else None
+            if server:
+                # SIGINT lets every server mode shut down cleanly
+                server.send_signal(signal.SIGINT)
+                server.wait()
+
+    result = report(args, stats, elapsed, sampler.samples if sampler else [], server_cpu)
+    print_report(result, load_previous(args.results, result))
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,176 @@
 #!/bin/python3
+import re
 import socket
 import ssl
 
+from protocol import FramedSocket, PROMPT, INFO, ERROR, CLOSE, REPLY
+from resume import TOKEN_PREFIX
+
+# ';' separates replies sent ahead of time, a ';' that is part of a reply is typed as \;
+REPLY_SEPARATOR = re.compile(r"(?<!\\);")
+
+
+def split_replies(message):
+    # "1;alice;secret" answers the next three prompts in a single round trip
+    replies = (reply.replace("\\;", ";").strip() for reply in REPLY_SEPARATOR.split(message))
+    return [reply for reply in replies if reply]
+
+
 class RPSGameClient:
-    def __init__(self, host='127.0.0.1', port=12345):
+    def __init__(self, host='127.0.0.1', port=12345, tls=True, unix_path=None):
         self.server_host = host
         self.server_port = port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # tls=False talks plaintext to a server started with --listener tcp or unix
+        self.tls = tls
+        self.unix_path = unix_path
+        self.client_socket = None
         
         # Create SSL context
         self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         self.ssl_context.check_hostname = False
         self.ssl_context.verify_mode = ssl.CERT_NONE
+        # Session from the previous connection, lets a reconnect resume TLS instead of a full handshake
+        self.tls_session = None
         
+        # Token of our session on the server, a reconnect resumes the session with it instead of logging in
+        self.resume_token = None
+
         self.username = None
         self.in_tournament = False
+        # Replies sent ahead of time with ';' that answer prompts not received yet
+        self.pipelined_replies = 0
+
+    def open_socket(self):
+        if self.unix_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.unix_path)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+        return socket.create_connection((self.server_host, self.server_port))
+
+    def connect(self):
+        sock = self.open_socket()
+        self.pipelined_replies = 0
+        if not self.tls:
+            self.client_socket = FramedSocket(sock)
+            return False
+        self.client_socket = FramedSocket(self.ssl_context.wrap_socket(
+            sock, 
+            server_hostname=self.server_host,
+            session=self.tls_session
+        ))
+        return self.client_socket.sock.session_reused
+
+    def disconnect(self):
+        if self.client_socket is not None:
+            # TLS 1.3 tickets arrive after the handshake, so grab the session once we are done
+            if self.tls:
+                self.tls_session = self.client_socket.sock.session or self.tls_session
+            self.client_socket.close()
+            self.client_socket = None
 
     def connect_to_server(self):
         try:
-            self.client_socket.connect((self.server_host, self.server_port))
-            self.client_socket = self.ssl_context.wrap_socket(
-                self.client_socket, 
-                server_hostname=self.server_host
-            )
-            print("Connected to server.")
+            resumed = " (resumed TLS session)" if self.connect() else ""
+            self.display(f"Connected to server.{resumed}")
             self.game_loop()
         except Exception as e:
-            print(f"Error connecting to server: {e}")
+            self.display(f"Error connecting to server: {e}")
         finally:
-            self.client_socket.close()
-            print("Disconnected from server.")
+            self.disconnect()
+            self.display("Disconnected from server.")
 
     def send_message(self, message):
         try:
-            self.client_socket.send(message.encode())
+            replies = split_replies(message)
+            self.client_socket.send_frames([(REPLY, reply) for reply in replies])
+            self.pipelined_replies += len(replies) - 1
             return True
         except Exception as e:
-            print(f"Error sending message: {e}")
+            self.display(f"Error sending message: {e}")
             return False
 
     def receive_message(self):
         try:
-            message = self.client_socket.recv(1024).decode()
-            return message
+            return self.client_socket.recv_frame()
         except Exception as e:
-            print(f"Error receiving message: {e}")
+            self.display(f"Error receiving message: {e}")
             return None
 
-    def handle_server_message(self, message):
-        # Check if message expects a reply
-        expects_reply = False
-        if "{{expect_reply}}" in message:
-            expects_reply = True
-            message = message.replace("{{expect_reply}}", "")
-
-        # Print the message
-        print(message)
-
-        # If reply is expected, get user input and send it
-        if expects_reply:
-            while True:
-                user_input = input("Your input: ").strip()
-                if user_input:
-                    self.send_message(user_input)
-                    break
+    def display(self, text):
+        print(text)
+
+    def read_reply(self, frame):
+        # Answer to a PROMPT frame
+        while True:
+            user_input = input("Your input: ").strip()
+            if user_input:
+                return user_input
+
+    def handle_server_message(self, frame):
+        if frame.type == INFO and frame.text.startswith(TOKEN_PREFIX):
+            self.resume_token = frame.text[len(TOKEN_PREFIX):].strip()
+            return False
+        if frame.type == PROMPT and "Resume (3)" in frame.text and self.resume_token:
+            # A token is only good once, the server sends a new one if the resume works
+            self.display(frame.text)
+            self.display("Resuming the previous session...")
+            self.send_message(f"3;{self.resume_token}")
+            self.resume_token = None
             return True
-        return False
+        if frame.type == ERROR:
+            self.display(f"Error: {frame.text}")
+        else:
+            self.display(frame.text)
+
+        if frame.type != PROMPT:
+            return False
+        # Already answered by a pipelined reply
+        if self.pipelined_replies:
+            self.pipelined_replies -= 1
+            return False
+
+        self.send_message(self.read_reply(frame))
+        return True
 
     def game_loop(self):
         while True:
             try:
                 # Receive server message
-                server_message = self.receive_message()
-                if not server_message:
-                    print("Lost connection to server.")
+                frame = self.receive_message()
+                if frame is None:
+                    self.display("Lost connection to server.")
                     break
 
                 # Handle the message and check if we need to continue
-                needs_response = self.handle_server_message(server_message)
+                needs_response = self.handle_server_message(frame)
                 
                 # Check for exit conditions
-                if "Goodbye" in server_message:
-                    print("Disconnecting from server...")
+                if frame.type == CLOSE:
+                    # The server ended the session, only a connection that dropped is resumed
+                    self.resume_token = None
+                    self.display("Disconnecting from server...")
                     break
 
             except Exception as e:
-                print(f"Error in game loop: {e}")
+                self.display(f"Error in game loop: {e}")
                 break
 
 if __name__ == "__main__":
-    client = RPSGameClient()
-    client.connect_to_server()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="RPS game client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--plaintext", action="store_true", help="no TLS, for a server started with --listener tcp or unix")
+    parser.add_argument("--unix-path", help="connect to the server's Unix socket instead of host:port")
+    args = parser.parse_args()
+
+    client = RPSGameClient(args.host, args.port, tls=not args.plaintext and not args.unix_path, unix_path=args.unix_path)
+    while True:
+        client.connect_to_server()
+        if input("Reconnect? (y/n): ").strip().lower() != "y":
+            break
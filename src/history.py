@@ -0,0 +1,209 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:  # stats fall back to unpacking the records one by one
+    numpy = None
+
+from metrics import REGISTRY
+from rules import MOVE_NAMES as MOVES, MOVE_CODES
+
+log = logging.getLogger("rps.history")
+
+RECORDED_MATCHES = REGISTRY.counter("rps_history_matches_total", "Matches appended to the match history")
+STATS_SECONDS = REGISTRY.histogram("rps_history_stats_seconds", "Time to compute a player's stats from the match history")
+
+# Every match is one fixed-width little-endian record, so record n sits at n * RECORD.size
+# and the file can be mapped straight into a NumPy structured array:
+# end time, player1 id, player2 id, tournament id (0 for quick play), round (1 based, 0 for
+# quick play), player1 move, player2 move, winner (1 or 2, 0 for a draw or no result)
+RECORD = struct.Struct("<dIIIHBBB5x")
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([
+        ("time", "<f8"), ("player1", "<u4"), ("player2", "<u4"), ("tournament", "<u4"), ("round", "<u2"),
+        ("move1", "u1"), ("move2", "u1"), ("winner", "u1"), ("padding", "V5"),
+    ])
+    assert RECORD_DTYPE.itemsize == RECORD.size
+
+FLUSH_INTERVAL = 1  # seconds buffered records may wait before reaching the file
+RECENT_MATCHES = 5
+SCAN_CHUNK = 1 << 20  # records read per slice by the pure Python scan
+
+
+class MatchHistory:
+    # Append-only binary log of every match played. Players are stored as small integer ids,
+    # assigned on their first match and kept one name per line in `<path>.names`; tournaments
+    # get the next line of `<path>.tournaments` when they start. Recording
+    # a match only packs a record into the file's write buffer; a background thread flushes
+    # it every FLUSH_INTERVAL seconds. Queries map the file instead of reading it into objects.
+    def __init__(self, path="matches.bin"):
+        self.path = path
+        self.names_path = path + ".names"
+        self.tournaments_path = path + ".tournaments"
+        self.names = read_lines(self.names_path)
+        self.ids = {name: number for number, name in enumerate(self.names, 1)}
+        self.tournaments = read_lines(self.tournaments_path)
+        # A crash can leave half a record at the end, drop it so the records stay aligned
+        if os.path.exists(path) and os.path.getsize(path) % RECORD.size:
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) // RECORD.size * RECORD.size)
+        self.file = open(path, "ab")
+        self.names_file = open(self.names_path, "a", encoding="utf-8", newline="")
+        self.tournaments_file = open(self.tournaments_path, "a", encoding="utf-8", newline="")
+        self.closed = False
+        self.lock = threading.Lock()
+        self.flusher = threading.Thread(target=self.flush_loop, name="history-flusher", daemon=True)
+        self.flusher.start()
+
+    def player_id(self, username):
+        # Called with the lock held. The name is written before any record that refers to it.
+        number = self.ids.get(username)
+        if number is None:
+            self.names.append(username)
+            number = self.ids[username] = len(self.names)
+            self.names_file.write(index_line(username))
+            self.names_file.flush()
+        return number
+
+    def new_tournament(self, name):
+        # Id of a tournament that is starting
+        with self.lock:
+            self.tournaments.append(name)
+            if not self.closed:
+                self.tournaments_file.write(index_line(name))
+                self.tournaments_file.flush()
+            return len(self.tournaments)
+
+    def record(self, player1, player2, move1, move2, winner, tournament=0, round_number=0):
+        # winner is player1, player2 or None
+        outcome = 0 if winner is None else 1 if winner == player1 else 2
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(RECORD.pack(
+                time.time(), self.player_id(player1), self.player_id(player2), tournament, round_number,
+                MOVE_CODES.get(move1, 0), MOVE_CODES.get(move2, 0), outcome,
+            ))
+        RECORDED_MATCHES.inc()
+
+    def flush_loop(self):
+        while not self.closed:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.file.close()
+            self.names_file.close()
+            self.tournaments_file.close()
+
+    def stats(self, username):
+        # Dict of the player's results, move counts and last matches, None if they never played
+        self.flush()
+        started = time.perf_counter()
+        number = self.ids.get(username)
+        count = os.path.getsize(self.path) // RECORD.size
+        if number is None or not count:
+            return None
+        if numpy is not None:
+            stats = self.scan_numpy(number, count)
+        else:
+            stats = self.scan(number, count)
+        STATS_SECONDS.observe(time.perf_counter() - started)
+        if stats is None:
+            return None
+        stats["recent"] = [self.describe(number, *match) for match in stats["recent"]]
+        return stats
+
+    def describe(self, number, player1, player2, tournament, move1, move2, winner):
+        # (opponent, own move, opponent's move, outcome, tournament name) seen from player `number`
+        if player2 == number:
+            player1, player2, move1, move2 = player2, player1, move2, move1
+            winner = (0, 2, 1)[winner]
+        if winner:
+            outcome = "won" if winner == 1 else "lost"
+        else:
+            outcome = "draw" if move1 == move2 and move1 else "no result"
+        return self.names[player2 - 1], MOVES[move1], MOVES[move2], outcome, self.tournaments[tournament - 1] if tournament else None
+
+    def scan_numpy(self, number, count):
+        records = numpy.memmap(self.path, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+        first = records["player1"] == number
+        second = records["player2"] == number
+        mine = numpy.flatnonzero(first | second)
+        if not len(mine):
+            return None
+        played = records[mine]
+        first = played["player1"] == number
+        winner = played["winner"]
+        moves = numpy.where(first, played["move1"], played["move2"])
+        return {
+            "games": len(played),
+            "wins": int(numpy.count_nonzero(winner == numpy.where(first, 1, 2))),
+            "losses": int(numpy.count_nonzero(winner == numpy.where(first, 2, 1))),
+            "draws": int(numpy.count_nonzero((winner == 0) & (played["move1"] == played["move2"]) & (played["move1"] != 0))),
+            "tournament_games": int(numpy.count_nonzero(played["tournament"])),
+            "moves": dict(zip(MOVES[1:], numpy.bincount(moves, minlength=len(MOVES))[1:].tolist())),
+            "recent": [
+                (int(r["player1"]), int(r["player2"]), int(r["tournament"]), int(r["move1"]), int(r["move2"]), int(r["winner"]))
+                for r in played[-RECENT_MATCHES:]
+            ],
+        }
+
+    def scan(self, number, count):
+        stats = {"games": 0, "wins": 0, "losses": 0, "draws": 0, "tournament_games": 0, "moves": dict.fromkeys(MOVES[1:], 0), "recent": []}
+        recent = stats["recent"]
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ) as records:
+            for offset in range(0, count * RECORD.size, SCAN_CHUNK * RECORD.size):
+                for _, player1, player2, tournament, _, move1, move2, winner in RECORD.iter_unpack(records[offset:offset + SCAN_CHUNK * RECORD.size]):
+                    if player1 != number and player2 != number:
+                        continue
+                    first = player1 == number
+                    stats["games"] += 1
+                    if winner:
+                        stats["wins" if (winner == 1) == first else "losses"] += 1
+                    elif move1 == move2 and move1:
+                        stats["draws"] += 1
+                    if tournament:
+                        stats["tournament_games"] += 1
+                    move = move1 if first else move2
+                    if move:
+                        stats["moves"][MOVES[move]] += 1
+                    recent.append((player1, player2, tournament, move1, move2, winner))
+                    if len(recent) > RECENT_MATCHES:
+                        del recent[0]
+        return stats if stats["games"] else None
+
+
+def index_line(name):
+    # Names are validated when they are registered, but a line break in an older one must
+    # not shift every later id
+    return name.replace("\n", " ") + "\n"
+
+
+def read_lines(path):
+    # Only "\n" ends a line: names may hold "\r", U+2028 and other characters str.splitlines
+    # would split on
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            lines = f.read().split("\n")
+    except FileNotFoundError:
+        return []
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def open_history(path=None):
+    return MatchHistory(path or "matches.bin")
@@ -0,0 +1,168 @@
+import random
+import threading
+
+MAX_LEVEL = 32
+PAGE_SIZE = 10
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i] = how many positions next[i] is ahead of this node
+        self.width = [1] * level
+
+
+class Leaderboard:
+    # Indexable skip list ordered by (-score, username). Besides the links every node
+    # stores how many entries each link skips, which gives O(log n) insert, remove,
+    # rank-of-player and lookup-by-position, so the board is updated incrementally
+    # instead of re-sorting every player for each "View Rankings".
+    def __init__(self, scores=None):
+        self.head = _Node(None, MAX_LEVEL)
+        self.size = 0
+        self.scores = {}
+        self.lock = threading.Lock()
+        if scores:
+            self._build(scores)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, username):
+        return username in self.scores
+
+    def update(self, username, score):
+        with self.lock:
+            old_score = self.scores.get(username)
+            if old_score == score:
+                return
+            if old_score is not None:
+                self._remove((-old_score, username))
+            self.scores[username] = score
+            self._insert((-score, username))
+
+    def remove(self, username):
+        with self.lock:
+            score = self.scores.pop(username, None)
+            if score is not None:
+                self._remove((-score, username))
+
+    def rank(self, username):
+        # 1-based position of the player, None if unranked
+        with self.lock:
+            score = self.scores.get(username)
+            if score is None:
+                return None
+            key = (-score, username)
+            node = self.head
+            position = 0
+            for level in reversed(range(MAX_LEVEL)):
+                while node.next[level] is not None and node.next[level].key < key:
+                    position += node.width[level]
+                    node = node.next[level]
+            return position + 1
+
+    def range(self, start, count):
+        # (rank, username, score) for `count` entries starting at 0-based position `start`
+        with self.lock:
+            if start < 0 or start >= self.size or count <= 0:
+                return []
+            node = self.head
+            remaining = start + 1
+            for level in reversed(range(MAX_LEVEL)):
+                while node.width[level] <= remaining and node.next[level] is not None:
+                    remaining -= node.width[level]
+                    node = node.next[level]
+            entries = []
+            rank = start + 1
+            while node is not None and len(entries) < count:
+                entries.append((rank, node.key[1], -node.key[0]))
+                node = node.next[0]
+                rank += 1
+            return entries
+
+    def top(self, count):
+        return self.range(0, count)
+
+    def page(self, number, page_size=PAGE_SIZE):
+        return self.range(number * page_size, page_size)
+
+    def page_count(self, page_size=PAGE_SIZE):
+        return max(1, -(-self.size // page_size))
+
+    def around(self, username, radius=5):
+        rank = self.rank(username)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return self.range(start, rank - 1 - start + radius + 1)
+
+    def _build(self, scores):
+        # Bulk load at startup: one sort, then every node is linked after the previous one,
+        # instead of a search from the head for each player
+        last = [self.head] * MAX_LEVEL
+        last_position = [0] * MAX_LEVEL
+        for position, key in enumerate(sorted((-score, username) for username, score in scores.items()), 1):
+            node = _Node(key, self._random_level())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - last_position[level]
+                last[level] = node
+                last_position[level] = position
+        self.size = len(scores)
+        self.scores = dict(scores)
+        # The last link of each level points past the end
+        for level in range(MAX_LEVEL):
+            last[level].width[level] = self.size + 1 - last_position[level]
+
+    def _random_level(self):
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def _insert(self, key):
+        chain = [None] * MAX_LEVEL
+        steps_at_level = [0] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new_level = self._random_level()
+        new_node = _Node(key, new_level)
+        steps = 0
+        for level in range(new_level):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(new_level, MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def _remove(self, key):
+        chain = [None] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self.size -= 1
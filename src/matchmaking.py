@@ -0,0 +1,207 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+from rating import DEFAULT_RATING
+
+MOVE_TIMEOUT = 30  # seconds a player has to send their move before forfeiting
+
+# Quick play pairs players whose ratings are at most a window apart. The window starts at
+# BASE_WINDOW and grows by WINDOW_GROWTH points for every second a player has waited, so
+# nobody waits forever for an opponent of the same level.
+BUCKET_WIDTH = 50
+BASE_WINDOW = 100
+WINDOW_GROWTH = 50
+REMATCH_INTERVAL = 1  # seconds between passes that pair players whose windows have grown
+
+MATCH_WAIT_SECONDS = REGISTRY.histogram("rps_match_wait_seconds", "Time from joining quick play to getting an opponent")
+MATCH_RATING_GAP = REGISTRY.histogram("rps_match_rating_gap", "Rating difference between the two players of a quick play match",
+                                      buckets=(0, 25, 50, 100, 200, 400, 800, 1600))
+
+
+class Match:
+    # A game between two players. Each player's own session submits its move, so both
+    # moves are collected concurrently; whoever completes (or expires) the match resolves it.
+    def __init__(self, player1, player2, move_timeout, done_event):
+        self.players = (player1, player2)
+        self.moves = {}
+        self.deadline = time.monotonic() + move_timeout
+        self.result = None
+        self.done = done_event
+        self.finished = False
+        # Set by the coordinator's SharedState when workers refer to the match
+        self.key = None
+        self.lock = threading.Lock()
+
+    def opponent(self, player):
+        return self.players[1] if player == self.players[0] else self.players[0]
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def submit(self, player, move):
+        # A move of None means the player forfeits. Returns True for the call that completed the match.
+        with self.lock:
+            if self.finished or player in self.moves:
+                return False
+            self.moves[player] = move
+            if len(self.moves) == len(self.players):
+                self.finished = True
+                return True
+            return False
+
+    def expire(self):
+        # Forfeit every player that has not moved yet. Returns True if this call ended the match.
+        with self.lock:
+            if self.finished:
+                return False
+            for player in self.players:
+                self.moves.setdefault(player, None)
+            self.finished = True
+            return True
+
+
+class Ticket:
+    # Handed to a queued player; its event fires once a match is found or the wait is cancelled
+    __slots__ = ("event", "match", "username", "rating", "since")
+
+    def __init__(self, event, match=None, username=None, rating=DEFAULT_RATING):
+        self.event = event
+        self.match = match
+        self.username = username
+        self.rating = rating
+        self.since = time.monotonic()
+
+    def window(self, now):
+        return BASE_WINDOW + WINDOW_GROWTH * (now - self.since)
+
+
+class MatchScheduler:
+    # Rating-based pairing for quick play. Waiting players sit in buckets of BUCKET_WIDTH
+    # rating points, FIFO inside a bucket, and `occupied` keeps the non-empty buckets
+    # sorted, so the closest opponents are found with a bisect and a walk outwards instead
+    # of a scan of the whole queue. event_factory is threading.Event for the threaded
+    # server and asyncio.Event for the asyncio server.
+    def __init__(self, move_timeout=MOVE_TIMEOUT, event_factory=threading.Event):
+        self.move_timeout = move_timeout
+        self.event_factory = event_factory
+        self.buckets = {}
+        self.occupied = []
+        self.tickets = {}
+        # Queued tickets in arrival order (matched and cancelled ones are skipped lazily),
+        # the first one has the widest window of the queue
+        self.arrivals = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def __contains__(self, username):
+        return username in self.tickets
+
+    def add(self, ticket):
+        index = int(ticket.rating // BUCKET_WIDTH)
+        bucket = self.buckets.get(index)
+        if bucket is None:
+            bucket = self.buckets[index] = deque()
+            bisect.insort(self.occupied, index)
+        bucket.append(ticket)
+        self.tickets[ticket.username] = ticket
+        self.arrivals.append(ticket)
+
+    def remove(self, ticket):
+        index = int(ticket.rating // BUCKET_WIDTH)
+        bucket = self.buckets[index]
+        bucket.remove(ticket)
+        if not bucket:
+            del self.buckets[index]
+            del self.occupied[bisect.bisect_left(self.occupied, index)]
+        del self.tickets[ticket.username]
+
+    def nearest_buckets(self, rating):
+        # Occupied bucket indexes ordered by distance from rating, closest first
+        start = bisect.bisect_left(self.occupied, rating // BUCKET_WIDTH)
+        below, above = start - 1, start
+        while below >= 0 or above < len(self.occupied):
+            if above >= len(self.occupied) or (below >= 0 and rating - (self.occupied[below] + 1) * BUCKET_WIDTH < self.occupied[above] * BUCKET_WIDTH - rating):
+                yield self.occupied[below]
+                below -= 1
+            else:
+                yield self.occupied[above]
+                above += 1
+
+    def widest_window(self, now):
+        while self.tickets.get(self.arrivals[0].username) is not self.arrivals[0]:
+            self.arrivals.popleft()
+        return self.arrivals[0].window(now)
+
+    def find_opponent(self, ticket, now):
+        # The longest waiting player of each bucket has the widest window there, so only
+        # bucket heads are compared; the walk stops once no waiting player could reach
+        reach = max(ticket.window(now), self.widest_window(now))
+        for index in self.nearest_buckets(ticket.rating):
+            distance = max(0, index * BUCKET_WIDTH - ticket.rating, ticket.rating - (index + 1) * BUCKET_WIDTH)
+            if distance > reach:
+                return None
+            head = self.buckets[index][0]
+            if abs(head.rating - ticket.rating) <= max(ticket.window(now), head.window(now)):
+                return head
+        return None
+
+    def pair(self, waiting, ticket, now):
+        # Called with the lock held, `waiting` is still queued
+        self.remove(waiting)
+        match = Match(waiting.username, ticket.username, self.move_timeout, self.event_factory())
+        MATCH_WAIT_SECONDS.observe(now - waiting.since)
+        MATCH_WAIT_SECONDS.observe(now - ticket.since)
+        MATCH_RATING_GAP.observe(abs(waiting.rating - ticket.rating))
+        waiting.match = ticket.match = match
+        return match
+
+    def enqueue(self, username, rating=DEFAULT_RATING):
+        with self.lock:
+            if username in self.tickets:
+                return self.tickets[username]
+            now = time.monotonic()
+            ticket = Ticket(self.event_factory(), username=username, rating=rating)
+            opponent = self.find_opponent(ticket, now) if self.tickets else None
+            if opponent is None:
+                self.add(ticket)
+                return ticket
+            self.pair(opponent, ticket, now)
+        opponent.event.set()
+        ticket.event.set()
+        return ticket
+
+    def rematch(self):
+        # Pairs waiting players whose windows have grown enough to reach each other.
+        # Neighbouring buckets are the closest candidates, one pass over them is enough.
+        paired = []
+        with self.lock:
+            now = time.monotonic()
+            previous = None
+            for index in list(self.occupied):
+                bucket = self.buckets.get(index)
+                while bucket:
+                    ticket = bucket[0]
+                    if previous is not None and abs(previous.rating - ticket.rating) <= max(previous.window(now), ticket.window(now)):
+                        self.remove(ticket)
+                        self.pair(previous, ticket, now)
+                        paired += [previous, ticket]
+                        previous = None
+                    else:
+                        previous = ticket
+                        break
+        for ticket in paired:
+            ticket.event.set()
+        return len(paired) // 2
+
+    def cancel(self, username):
+        with self.lock:
+            ticket = self.tickets.get(username)
+            if ticket is None:
+                return
+            self.remove(ticket)
+        ticket.event.set()
@@ -0,0 +1,95 @@
+import logging
+import selectors
+import threading
+import time
+
+from protocol import WRITE_TIMEOUT
+
+log = logging.getLogger("rps.outbound")
+
+# What to do with a frame for a client whose outbox is full
+SLOW_CLIENT_POLICIES = ("disconnect", "drop")
+
+
+class OutboundWriter:
+    # Delivers frames posted to blocking connections from threads other than the session's
+    # own (broadcasts, timers). A frame is written right away if the socket has room,
+    # otherwise it waits in the connection's outbox and this writer's thread drains it.
+    # Only sockets with room are written to, so one stalled client never holds up the
+    # others; a client that takes nothing for write_timeout seconds goes to on_stalled.
+    def __init__(self, on_stalled, write_timeout=WRITE_TIMEOUT, poll_interval=0.05):
+        self.on_stalled = on_stalled
+        self.write_timeout = write_timeout
+        self.poll_interval = poll_interval
+        # conn -> [time it last took data, callbacks to run once its outbox is empty]
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def post(self, conn, data, key=None, then=None):
+        # False if the connection's outbox is full
+        if not conn.post(data, key):
+            return False
+        try:
+            flushed = conn.flush()
+        except OSError:
+            return True  # the session's own thread will notice the dead connection
+        if flushed:
+            if then:
+                then()
+            return True
+        with self.cond:
+            entry = self.pending.setdefault(conn, [time.monotonic(), []])
+            if then:
+                entry[1].append(then)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="outbound", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return True
+
+    def wait_writable(self, conns):
+        with selectors.DefaultSelector() as selector:
+            for conn in conns:
+                selector.register(conn, selectors.EVENT_WRITE)
+            selector.select(self.poll_interval)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                conns = [conn for conn in self.pending if not conn._closed]
+                for conn in [conn for conn in self.pending if conn._closed]:
+                    del self.pending[conn]
+            if not conns:
+                continue
+            self.wait_writable(conns)
+
+            now = time.monotonic()
+            done, stalled = [], []
+            for conn in conns:
+                before = len(conn.outbox)
+                try:
+                    flushed = conn.flush()
+                except OSError as e:
+                    log.debug("Dropping queued frames: %s", e)
+                    flushed = None
+                with self.cond:
+                    entry = self.pending[conn]
+                    if flushed or flushed is None:
+                        del self.pending[conn]
+                        if flushed:
+                            done += entry[1]
+                    elif len(conn.outbox) < before:
+                        entry[0] = now
+                    elif now - entry[0] > self.write_timeout:
+                        del self.pending[conn]
+                        stalled.append(conn)
+            for callback in done:
+                callback()
+            for conn in stalled:
+                self.on_stalled(conn)
+
+    def __len__(self):
+        return len(self.pending)
@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+PLAYER_CACHE_SIZE = 100000  # accounts kept in memory
+
+CACHE_LOOKUPS = REGISTRY.counter("rps_player_cache_lookups_total", "Account lookups, by whether the account was cached", ("result",))
+CACHED_PLAYERS = REGISTRY.gauge("rps_player_cache_size", "Accounts held in the player cache")
+
+
+class PlayerStore:
+    # Accounts, read through from storage on demand. Only the cache_size most recently used
+    # accounts stay in memory, so startup does not load every account and memory does not
+    # grow with the number of registered players. New and rehashed passwords go into the
+    # cache here and reach storage through storage.save_player.
+    def __init__(self, storage, cache_size=PLAYER_CACHE_SIZE):
+        self.storage = storage
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        CACHED_PLAYERS.set_function(lambda: len(self.cache))
+
+    def cached(self, username):
+        # Password hash if the account is in the cache, None if storage has to be asked
+        with self.lock:
+            password_hash = self.cache.get(username)
+            if password_hash is not None:
+                self.cache.move_to_end(username)
+        if password_hash is not None:
+            CACHE_LOOKUPS.labels("hit").inc()
+        return password_hash
+
+    def get(self, username, default=None):
+        password_hash = self.cached(username)
+        if password_hash is None:
+            CACHE_LOOKUPS.labels("miss").inc()
+            password_hash = self.storage.load_player(username)
+            if password_hash is None:
+                return default
+            with self.lock:
+                # A password set while storage was being read wins over the value read
+                password_hash = self.cache.setdefault(username, password_hash)
+                self.evict()
+        return password_hash
+
+    def __setitem__(self, username, password_hash):
+        with self.lock:
+            self.cache[username] = password_hash
+            self.cache.move_to_end(username)
+            self.evict()
+
+    def evict(self):
+        # Called with the lock held
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
@@ -0,0 +1,319 @@
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from metrics import REGISTRY
+
+# Every message on the wire is a frame: a fixed 6 byte header followed by a UTF-8 payload.
+#   version (1 byte) | message type (1 byte) | payload length (4 bytes, big endian)
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBI")
+MAX_PAYLOAD = 1 << 20
+
+# Outbound flow control
+WRITE_TIMEOUT = 10         # seconds a client may keep its receive window shut before it is dropped
+OUTBOX_LIMIT = 64 * 1024   # bytes of frames queued for a client that is not keeping up
+WRITE_CHUNK = 8 * 1024     # bytes handed to the socket per send, one TLS record
+
+# Server -> client
+PROMPT = 1   # informational text that expects exactly one REPLY
+INFO = 2
+RESULT = 3   # outcome of a game, a match or a tournament
+ERROR = 4
+CLOSE = 5    # the server is ending the session
+# Client -> server
+REPLY = 6
+
+MESSAGE_TYPES = {PROMPT, INFO, RESULT, ERROR, CLOSE, REPLY}
+
+Frame = namedtuple("Frame", ["type", "text"])
+
+BYTES_RECEIVED = REGISTRY.counter("rps_bytes_received_total", "Bytes read from client connections, after TLS")
+BYTES_SENT = REGISTRY.counter("rps_bytes_sent_total", "Bytes written to client connections, before TLS")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class SlowConsumerError(ConnectionError):
+    pass
+
+
+# A non-blocking send or recv that found no room or no data. TLS may need to read while
+# writing and the other way round (key updates), waiting again covers both.
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+def wait_ready(sock, write, timeout=None):
+    # True once the socket can be read (write=False) or has room in its send buffer,
+    # False after timeout seconds (None: no limit)
+    if timeout is not None:
+        timeout = max(0.0, timeout)
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLOUT if write else select.POLLIN)
+            return bool(poller.poll(None if timeout is None else timeout * 1000))
+        return bool(select.select([], [sock], [], timeout)[1] if write else select.select([sock], [], [], timeout)[0])
+    except ValueError:
+        # Closed by another thread (fileno() is -1)
+        raise ConnectionResetError("Connection closed") from None
+
+
+def encode_frame(msg_type, payload):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload of {len(payload)} bytes exceeds the {MAX_PAYLOAD} byte limit")
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + payload
+
+
+def encode_frames(frames):
+    # Several frames in one buffer so they go out in a single write (pipelining)
+    return b"".join(encode_frame(msg_type, payload) for msg_type, payload in frames)
+
+
+class FrameDecoder:
+    # Incremental decoder over a single reusable bytearray. Sockets can recv_into() the
+    # free tail of the buffer directly and headers are parsed in place with unpack_from,
+    # so the only copy of a payload is the final UTF-8 decode.
+    def __init__(self, capacity=4096):
+        self.buffer = bytearray(capacity)
+        self.start = 0
+        self.end = 0
+
+    def writable(self, min_size=4096):
+        if len(self.buffer) - self.end < min_size:
+            # Move the unparsed bytes to the front before growing
+            pending = self.end - self.start
+            if self.start:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+            if len(self.buffer) - self.end < min_size:
+                self.buffer.extend(bytes(max(min_size, len(self.buffer))))
+        return memoryview(self.buffer)[self.end:]
+
+    def commit(self, nbytes):
+        self.end += nbytes
+
+    def feed(self, data):
+        with self.writable(len(data)) as view:
+            view[:len(data)] = data
+        self.commit(len(data))
+
+    def next_frame(self):
+        if self.end - self.start < HEADER.size:
+            return None
+        version, msg_type, length = HEADER.unpack_from(self.buffer, self.start)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if msg_type not in MESSAGE_TYPES:
+            raise ProtocolError(f"Unknown message type {msg_type}")
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_PAYLOAD} byte limit")
+
+        payload_start = self.start + HEADER.size
+        payload_end = payload_start + length
+        if payload_end > self.end:
+            return None
+        with memoryview(self.buffer) as view:
+            text = str(view[payload_start:payload_end], "utf-8")
+        self.start = payload_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        return Frame(msg_type, text)
+
+
+class Outbox:
+    # Encoded frames waiting for a connection to take them, at most `limit` bytes. A frame
+    # posted with a key replaces the queued frame with the same key, so a client that falls
+    # behind gets the latest state of something instead of every step of it.
+    def __init__(self, limit=OUTBOX_LIMIT):
+        self.frames = OrderedDict()
+        self.size = 0
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def post(self, data, key=None):
+        # False if the frame does not fit
+        with self.lock:
+            replaced = self.frames.get(key, b"") if key is not None else b""
+            if self.size - len(replaced) + len(data) > self.limit:
+                return False
+            self.frames[key if key is not None else object()] = data
+            self.size += len(data) - len(replaced)
+        return True
+
+    def take(self, max_bytes=None):
+        # Pops whole frames in order, up to max_bytes but at least one, as a single buffer
+        chunks, size = [], 0
+        with self.lock:
+            while self.frames:
+                key, data = self.frames.popitem(last=False)
+                if chunks and max_bytes is not None and size + len(data) > max_bytes:
+                    self.frames[key] = data
+                    self.frames.move_to_end(key, last=False)
+                    break
+                chunks.append(data)
+                size += len(data)
+            self.size -= size
+        return b"".join(chunks)
+
+    def __len__(self):
+        return self.size
+
+
+class FramedSocket:
+    # Socket (plain or TLS) that sends and receives whole frames. The socket itself is
+    # non-blocking and every wait for it goes through poll with a deadline: a blocking TLS
+    # socket retries a stalled write forever, however much room the send buffer seemed to
+    # have. A resumed session carries on over the socket of the client's new connection
+    # (take_over), so the same FramedSocket can outlive several sockets; `attachments`
+    # counts the ones it took over.
+    def __init__(self, sock, write_timeout=WRITE_TIMEOUT):
+        self.sock = sock
+        sock.settimeout(0.0)
+        self.decoder = FrameDecoder()
+        # Broadcasts may write from other threads, keep frames from interleaving
+        self.send_lock = threading.Lock()
+        # Frames posted by other threads, written when the socket has room for them
+        self.outbox = Outbox()
+        # Bytes taken from frames that the socket has not accepted yet. A TLS write that
+        # found no room must be retried with the same bytes, `attempt` is how many.
+        self.unsent = bytearray()
+        self.attempt = 0
+        self.write_timeout = write_timeout
+        # Seconds recv_frame waits for a frame, None for no limit
+        self.timeout = None
+        # Set while the socket is gone and the session waits for a resume, frames sent
+        # meanwhile are kept in the outbox
+        self.detached = False
+        self.attachments = 0
+
+    @property
+    def _closed(self):
+        return self.sock is None or self.sock._closed
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, data=b"", deadline=None):
+        # Sends the unsent bytes, then data, WRITE_CHUNK bytes at a time. Waits for room in
+        # the send buffer until deadline; with no deadline it stops as soon as the socket is
+        # full and keeps the rest for the next write. True once everything is sent.
+        self.unsent += data
+        sent = 0
+        try:
+            while sent < len(self.unsent):
+                chunk = bytes(self.unsent[sent:sent + (self.attempt or WRITE_CHUNK)])
+                try:
+                    nbytes = self.sock.send(chunk)
+                except WOULD_BLOCK:
+                    self.attempt = len(chunk)
+                    if deadline is None:
+                        return False
+                    if not wait_ready(self.sock, True, deadline - time.monotonic()):
+                        self.close()
+                        raise SlowConsumerError(f"Client took no data for {self.write_timeout} seconds")
+                    continue
+                self.attempt = 0
+                sent += nbytes
+                BYTES_SENT.inc(nbytes)
+            return True
+        finally:
+            del self.unsent[:sent]
+
+    def send_frame(self, msg_type, payload):
+        self.send_data(encode_frame(msg_type, payload))
+
+    def send_frames(self, frames):
+        self.send_data(encode_frames(frames))
+
+    def send_data(self, data):
+        with self.send_lock:
+            if self.detached:
+                self.outbox.post(data)
+                return
+            # Posted frames go first, so frames arrive in the order they were produced
+            self.write(self.outbox.take() + data, time.monotonic() + self.write_timeout)
+
+    def post(self, data, key=None):
+        # Queues an encoded frame without blocking, False if the outbox is full
+        return self.outbox.post(data, key)
+
+    def flush(self):
+        # Writes posted frames for as long as the socket takes them without blocking,
+        # True once the outbox is empty
+        if not self.send_lock.acquire(blocking=False):
+            return not self.outbox
+        try:
+            while not self._closed and not self.detached:
+                if not self.write(self.outbox.take(WRITE_CHUNK)):
+                    return False
+                if not self.outbox:
+                    return True
+            return not self.outbox
+        finally:
+            self.send_lock.release()
+
+    def recv_frame(self):
+        # The socket and decoder may be replaced by take_over while we wait on the old ones
+        sock, decoder = self.sock, self.decoder
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame
+            try:
+                with decoder.writable() as view:
+                    nbytes = sock.recv_into(view)
+            except WOULD_BLOCK:
+                if not wait_ready(sock, False, None if deadline is None else deadline - time.monotonic()):
+                    raise socket.timeout("timed out")
+                continue
+            if not nbytes:
+                raise ConnectionResetError("Connection closed by peer")
+            BYTES_RECEIVED.inc(nbytes)
+            decoder.commit(nbytes)
+
+    def settimeout(self, timeout):
+        # Applies to recv_frame, on this socket and on the ones a resume brings in
+        self.timeout = timeout
+
+    def detach(self):
+        # The client's connection dropped, keep its frames until a new one is taken over
+        with self.send_lock:
+            self.detached = True
+            # The rest of a frame cut off mid-write would garble the next connection
+            self.unsent.clear()
+            self.attempt = 0
+        self.close_socket(self.sock)
+
+    def take_over(self, other):
+        # Carries on over the socket of `other`, a new connection from the same client, which
+        # is left closed. Bytes the client already sent on it stay in the decoder.
+        with self.send_lock:
+            sock, self.sock, self.decoder = self.sock, other.sock, other.decoder
+            other.sock = None
+            self.detached = False
+            self.attachments += 1
+        # Wakes the session's thread if it is still reading the old socket
+        self.close_socket(sock)
+
+    def close(self):
+        self.detached = False
+        if self.sock is not None:
+            self.close_socket(self.sock)
+
+    def close_socket(self, sock):
+        # close() alone does not wake up a thread waiting to read this socket
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
@@ -0,0 +1,113 @@
+import socket
+import struct
+
+# HAProxy PROXY protocol, sent by a load balancer in front of the server at the start of each
+# connection to pass on the client's address (see HAProxy's proxy-protocol.txt).
+# v1 is one text line, v2 a binary header starting with V2_SIGNATURE.
+V1_PREFIX = b"PROXY "
+V1_MAX_LENGTH = 107  # longest valid v1 line, CRLF included
+V2_SIGNATURE = b"\r\n\r\n\x00\r\nQUIT\n"
+V2_HEADER = struct.Struct("!12sBBH")  # signature, version and command, family and protocol, length
+V2_IPV4 = struct.Struct("!4s4sHH")
+V2_IPV6 = struct.Struct("!16s16sHH")
+HEADER_TIMEOUT = 5  # seconds the frontend has to send the header
+
+
+class ProxyProtocolError(ValueError):
+    pass
+
+
+def parse_v1(line):
+    # (address, port) of the client from a v1 line, None for UNKNOWN
+    try:
+        parts = line.rstrip(b"\r\n").decode("ascii").split(" ")
+        if parts[1] == "UNKNOWN":
+            return None
+        if len(parts) != 6 or parts[1] not in ("TCP4", "TCP6"):
+            raise ProxyProtocolError(f"bad PROXY v1 header {line!r}")
+        return parts[2], int(parts[4])
+    except (IndexError, UnicodeDecodeError, ValueError) as e:
+        raise ProxyProtocolError(f"bad PROXY v1 header {line!r}") from e
+
+
+def parse_v2(version_command, family, body):
+    # (address, port) of the client from a v2 header, None for a LOCAL connection (the
+    # frontend's own health checks) or an address family that has no IP
+    if version_command >> 4 != 2:
+        raise ProxyProtocolError(f"unsupported PROXY protocol version {version_command >> 4}")
+    command = version_command & 0xF
+    if command == 0:
+        return None
+    if command != 1:
+        raise ProxyProtocolError(f"unknown PROXY v2 command {command}")
+    if family >> 4 == 1 and len(body) >= V2_IPV4.size:
+        source, _, port, _ = V2_IPV4.unpack_from(body)
+        return socket.inet_ntop(socket.AF_INET, source), port
+    if family >> 4 == 2 and len(body) >= V2_IPV6.size:
+        source, _, port, _ = V2_IPV6.unpack_from(body)
+        return socket.inet_ntop(socket.AF_INET6, source), port
+    return None
+
+
+def v2_length(fixed):
+    # Bytes of the v2 header after its 16 fixed bytes
+    signature, version_command, family, length = V2_HEADER.unpack(fixed)
+    if signature != V2_SIGNATURE:
+        raise ProxyProtocolError("not a PROXY protocol header")
+    return version_command, family, length
+
+
+def read_header(sock):
+    # Reads the header from a blocking socket without taking any byte past it, so what
+    # follows (a TLS handshake or the first frame) is left in the socket.
+    # Returns the client's (address, port), None if the header does not carry one.
+    sock.settimeout(HEADER_TIMEOUT)
+    start = recv_exactly(sock, 8)
+    if start.startswith(V1_PREFIX):
+        # The line length is unknown up front, read it a byte at a time
+        line = start
+        while not line.endswith(b"\r\n"):
+            if len(line) >= V1_MAX_LENGTH:
+                raise ProxyProtocolError("PROXY v1 header too long")
+            line += recv_exactly(sock, 1)
+        return parse_v1(line)
+    version_command, family, length = v2_length(start + recv_exactly(sock, 8))
+    return parse_v2(version_command, family, recv_exactly(sock, length))
+
+
+async def read_header_async(reader):
+    # Same for an asyncio stream; bytes read past the header stay in the reader's buffer
+    start = await reader.readexactly(8)
+    if start.startswith(V1_PREFIX):
+        line = start + await reader.readuntil(b"\r\n")
+        if len(line) > V1_MAX_LENGTH:
+            raise ProxyProtocolError("PROXY v1 header too long")
+        return parse_v1(line)
+    version_command, family, length = v2_length(start + await reader.readexactly(8))
+    return parse_v2(version_command, family, await reader.readexactly(length))
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed during the PROXY header")
+        data += chunk
+    return data
+
+
+def encode_v1(source, destination):
+    # Header a frontend would send for a TCP connection from source to destination
+    family = "TCP6" if ":" in source[0] else "TCP4"
+    return f"PROXY {family} {source[0]} {destination[0]} {source[1]} {destination[1]}\r\n".encode("ascii")
+
+
+def encode_v2(source, destination):
+    if ":" in source[0]:
+        family, layout, address_family = 0x21, V2_IPV6, socket.AF_INET6
+    else:
+        family, layout, address_family = 0x11, V2_IPV4, socket.AF_INET
+    body = layout.pack(socket.inet_pton(address_family, source[0]), socket.inet_pton(address_family, destination[0]),
+                       source[1], destination[1])
+    return V2_HEADER.pack(V2_SIGNATURE, 0x21, family, len(body)) + body
@@ -0,0 +1,14 @@
+# Elo ratings for quick play. Every player starts at DEFAULT_RATING; after a game both
+# ratings move by K_FACTOR times the difference between the actual and the expected score.
+DEFAULT_RATING = 1500
+K_FACTOR = 32
+
+
+def expected_score(rating, opponent_rating):
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def rate(rating1, rating2, score1):
+    # score1 is 1 if player 1 won, 0.5 for a draw and 0 if player 2 won
+    change = K_FACTOR * (score1 - expected_score(rating1, rating2))
+    return round(rating1 + change, 1), round(rating2 - change, 1)
@@ -0,0 +1,149 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+from metrics import REGISTRY
+
+RESUME_GRACE = 60  # seconds the session of a player whose connection dropped is held for them
+TOKEN_PREFIX = "Resume token: "  # INFO frame that hands the client its current token
+
+HELD_SESSIONS = REGISTRY.gauge("rps_held_sessions", "Sessions whose connection dropped, held for their player to resume")
+HOLDS = REGISTRY.counter("rps_session_holds_total", "Dropped sessions by how the hold ended", ("outcome",))
+RESUMES_REJECTED = REGISTRY.counter("rps_resumes_rejected_total", "Resume attempts with a forged, stale or expired token")
+RESUME_GAP_SECONDS = REGISTRY.histogram("rps_resume_gap_seconds", "Time from noticing a dropped connection to its resume")
+RESUME_SAVED_SECONDS = REGISTRY.counter("rps_resume_saved_seconds_total",
+                                        "Password checks skipped by resumes, at the average check time")
+
+
+class SessionResumer:
+    # Reconnect tokens and the sessions held for them. A token is "<session id>.<nonce>.<mac>",
+    # an HMAC-SHA256 under a key drawn at startup, so forged or mangled tokens are turned
+    # away before any lookup. A session only accepts the last token it handed out: every
+    # resume issues a new one and the old one stops working.
+    # A logged in session whose connection drops is held for `grace` seconds. Its player
+    # stays in the quick play queue, tournament or match, frames sent to it wait in its
+    # outbox, and a resume moves the new connection into it without logging in again.
+    # A held session gives its admission slot back, so the resume can get in, and at most
+    # max_held sessions are held at once.
+    def __init__(self, admission, grace=RESUME_GRACE, max_held=None, key=None):
+        self.admission = admission
+        self.grace = grace
+        self.max_held = max_held
+        self.key = key or secrets.token_bytes(32)
+        self.held = 0
+        self.resumed = 0
+        self.expired = 0
+        self.lock = threading.Lock()
+        HELD_SESSIONS.set_function(lambda: self.held)
+
+    def sign(self, body):
+        mac = hmac.new(self.key, body.encode("ascii"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(mac[:18]).decode("ascii")
+
+    def issue(self, session):
+        # New token for a session, None when resumes are off
+        if not self.grace:
+            return None
+        body = f"{session.id}.{secrets.token_urlsafe(12)}"
+        session.token = f"{body}.{self.sign(body)}"
+        return session.token
+
+    def session_id(self, token):
+        # Id of the session a token was issued for, None if we did not sign it. Tokens we
+        # issue are ASCII, sign() could not even encode anything else.
+        if not token.isascii():
+            return None
+        body, _, mac = token.rpartition(".")
+        session_id = body.partition(".")[0]
+        if not session_id.isdigit() or not hmac.compare_digest(mac.encode("ascii"), self.sign(body).encode("ascii")):
+            return None
+        return int(session_id)
+
+    def hold(self, session, attachment, event):
+        # The session's connection dropped while its connection object had had `attachment`
+        # connections. Returns the event set when the player is back, None if the session
+        # ends here: resumes are off, the player never logged in or the session was closed.
+        with self.lock:
+            if session.conn.attachments != attachment:
+                # A resume moved a new connection in while the old one was still being read
+                event.set()
+                return event
+            if session.dropped_at is None:
+                if session.token is None or (self.max_held and self.held >= self.max_held):
+                    return None
+                session.conn.detach()
+                session.dropped_at = time.monotonic()
+                session.resumed = event
+                self.held += 1
+                self.admission.hold()
+            return session.resumed
+
+    def time_left(self, session):
+        dropped_at = session.dropped_at
+        return 0 if dropped_at is None else max(0.0, dropped_at + self.grace - time.monotonic())
+
+    def release(self, session):
+        # Once session.resumed is set or the grace period is over: True if the player is back.
+        # Otherwise the session is given up, its token stops working and closing it ends the hold.
+        with self.lock:
+            if session.dropped_at is None:
+                return session.token is not None
+            session.token = None
+            return False
+
+    def give_up(self, session):
+        # A fresh login replaces the session: True if it was held, it can then no longer be
+        # resumed and closing it ends the hold. False if its connection is live.
+        with self.lock:
+            if session.dropped_at is None:
+                return False
+            session.token = None
+            return True
+
+    def claim(self, token, session, conn, saved_seconds):
+        # Moves the new connection conn into `session` if token is the session's current one.
+        # Returns the session's next token, None if the resume is refused.
+        with self.lock:
+            if session is None or session.token is None or not hmac.compare_digest(token.encode(), session.token.encode()):
+                RESUMES_REJECTED.inc()
+                return None
+            session.conn.take_over(conn)
+            dropped_at, session.dropped_at = session.dropped_at, None
+            resumed = session.resumed
+            if dropped_at is not None:
+                self.held -= 1
+            # The new connection's admission slot becomes the session's, unless the session
+            # never gave its own back (its old connection had not been seen dropping yet)
+            self.admission.resumed(dropped_at is not None)
+            self.resumed += 1
+            token = self.issue(session)
+        HOLDS.labels("resumed").inc()
+        RESUME_SAVED_SECONDS.inc(saved_seconds)
+        if dropped_at is not None:
+            RESUME_GAP_SECONDS.observe(time.monotonic() - dropped_at)
+            resumed.set()
+        return token
+
+    def close(self, session):
+        # The session is over for good (quit, idle timeout, expired hold, shutdown). True if it
+        # was held, a waiting hold then gives up.
+        with self.lock:
+            session.token = None
+            dropped_at, session.dropped_at = session.dropped_at, None
+            if dropped_at is not None:
+                self.held -= 1
+                self.expired += 1
+        if dropped_at is None:
+            return False
+        HOLDS.labels("expired").inc()
+        session.resumed.set()
+        return True
+
+    def summary(self):
+        with self.lock:
+            ended = self.resumed + self.expired
+            rate = 100 * self.resumed / ended if ended else 0.0
+            return f"Session resumes: {self.resumed}, {self.expired} held sessions expired ({rate:.1f}% resumed)"
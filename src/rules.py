@@ -0,0 +1,74 @@
+try:
+    import numpy
+except ImportError:  # batches fall back to a loop over the outcome table
+    numpy = None
+
+# Outcome of a game, as stored in the outcome table. VOID is a game with an unknown move.
+DRAW = 0
+FIRST = 1
+SECOND = 2
+VOID = 3
+
+# Every move any variant knows, in a fixed order: move codes are positions in this tuple and
+# are stored in the match history, so new moves go at the end. 0 stands for no move.
+MOVE_NAMES = (None, "rock", "paper", "scissors", "lizard", "spock", "fire", "sponge", "air", "water")
+MOVE_CODES = {move: code for code, move in enumerate(MOVE_NAMES)}
+
+
+def cyclic(order):
+    # Balanced game on an odd number of moves: each move beats the (n - 1) / 2 moves after it
+    # in `order`, wrapping around, and loses to the others
+    half = (len(order) - 1) // 2
+    return {move: {order[(i + step) % len(order)] for step in range(1, half + 1)} for i, move in enumerate(order)}
+
+
+class Rules:
+    # A variant of the game. Moves are looked up once as small integer codes (0 for anything
+    # that is not a move of the variant) and every result is an index into a precomputed
+    # outcome table, table[code1][code2], instead of comparisons between strings.
+    # `beats` maps each move to the set of moves it beats.
+    def __init__(self, name, moves, beats):
+        self.name = name
+        self.moves = tuple(moves)
+        self.codes = {move: MOVE_CODES[move] for move in self.moves}
+        size = len(MOVE_NAMES)
+        self.table = [[VOID] * size for _ in range(size)]
+        for move1 in self.moves:
+            for move2 in self.moves:
+                code1, code2 = self.codes[move1], self.codes[move2]
+                if move1 == move2:
+                    self.table[code1][code2] = DRAW
+                elif move2 in beats[move1]:
+                    self.table[code1][code2] = FIRST
+                elif move1 in beats[move2]:
+                    self.table[code1][code2] = SECOND
+        # counters[i] is the position of a move that beats moves[i]
+        self.counters = tuple(self.moves.index(next(m for m in self.moves if move in beats[m])) for move in self.moves)
+        if numpy is not None:
+            self.array = numpy.array(self.table, numpy.uint8)
+        self.prompt = ", ".join(self.moves)
+
+    def code(self, move):
+        return self.codes.get(move, 0)
+
+    def outcome(self, move1, move2):
+        return self.table[self.codes.get(move1, 0)][self.codes.get(move2, 0)]
+
+    def outcomes(self, codes1, codes2):
+        # Outcomes of a batch of games, e.g. a whole tournament round, from two sequences of
+        # move codes: one fancy-indexing lookup with NumPy, a loop over the table without
+        if numpy is not None:
+            return self.array[numpy.asarray(codes1, numpy.intp), numpy.asarray(codes2, numpy.intp)]
+        table = self.table
+        return [table[code1][code2] for code1, code2 in zip(codes1, codes2)]
+
+
+VARIANTS = {
+    "rps": Rules("rps", ("rock", "paper", "scissors"), cyclic(("rock", "scissors", "paper"))),
+    # Rock-Paper-Scissors-Lizard-Spock
+    "rpsls": Rules("rpsls", ("rock", "paper", "scissors", "lizard", "spock"), cyclic(("rock", "scissors", "lizard", "paper", "spock"))),
+    # RPS-7, each move beats the three that follow it
+    "rps7": Rules("rps7", ("rock", "fire", "scissors", "sponge", "paper", "air", "water"),
+                  cyclic(("rock", "fire", "scissors", "sponge", "paper", "air", "water"))),
+}
+RPS = VARIANTS["rps"]
@@ -1,477 +1,1107 @@
 #!/bin/python3
 import socket
 import threading
-import hashlib
-import json
 import ssl
+import time
 from concurrent.futures import ThreadPoolExecutor
 import random
 import signal
+import sys
+import os
+import logging
+
+from auth import PasswordHasher, LoginStats, KDF_ITERATIONS
+from leaderboard import Leaderboard
+from matchmaking import MatchScheduler, MOVE_TIMEOUT, REMATCH_INTERVAL
+from rating import DEFAULT_RATING, rate
+from rules import VARIANTS, DRAW, FIRST, VOID
+from tournament import TournamentRunner, thread_timer, format_lobby, format_bracket, format_update, format_result, resolve_match
+from storage import open_storage, STORAGE_BACKENDS
+from history import open_history
+from strategy import BotEngine
+from players import PlayerStore
+from spectators import SpectatorHub
+from resume import SessionResumer, RESUME_GRACE, TOKEN_PREFIX
+from admission import AdmissionControl, BACKLOG, MAX_LOGINS, REJECT_TIMEOUT, busy_message, peer_ip
+from proxy_protocol import read_header, ProxyProtocolError
+from protocol import FramedSocket, encode_frame, PROMPT, INFO, RESULT, ERROR, CLOSE, WRITE_TIMEOUT
+from metrics import REGISTRY, PROCESS_STARTED, STARTUP_SECONDS, resident_memory, serve_metrics, setup_logging
+from session import SessionRegistry, IDLE_TIMEOUT, MENU, CLOSED, enable_keepalive
+from outbound import OutboundWriter, SLOW_CLIENT_POLICIES
+from steps import Send, Receive, Wait, Call, Result
+
+COMMANDS = (
+    "Available commands:\n"
+    "1. Play Game\n"
+    "2. View Rankings\n"
+    "3. Create Tournament\n"
+    "4. Join Tournament\n"
+    "5. Start Tournament\n"
+    "6. Quit\n"
+    "7. My Stats\n"
+    "8. Play vs Bot\n"
+    "9. Watch Tournament\n"
+)
+
+HANDSHAKE_TIMEOUT = 10  # seconds
+WELCOME = "Welcome! Login (1), Register (2) or Resume (3): "
+
+# tls: TCP with TLS. tcp and unix: plaintext TCP or Unix socket, for a frontend (load balancer)
+# that terminates TLS itself.
+LISTENERS = ("tls", "tcp", "unix")
+UNIX_PATH = "rps.sock"
+
+# Usernames and tournament names are shown in brackets and rankings, and kept one per line
+# in the match history indexes
+NAME_LENGTH = 32
+
+RANKINGS_MENU = "[n]ext page, [p]revious page, [t]op, [m]y position, a page number, or [b]ack: "
+
+# Menu choice -> (command name reported in metrics, handler method). Handlers are step
+# generators (see steps.py) that take (conn, username) and return the session's next state,
+# None to stay at the menu.
+COMMAND_TABLE = {
+    "1": ("play", "match_player"),
+    "2": ("rankings", "send_rankings"),
+    "3": ("create_tournament", "create_tournament"),
+    "4": ("join_tournament", "join_tournament"),
+    "5": ("start_tournament", "start_tournament"),
+    "6": ("quit", "quit"),
+    "7": ("stats", "show_stats"),
+    "8": ("play_bot", "play_bot"),
+    "9": ("watch", "watch_tournament"),
+}
+
+# Step a handler yields -> method of the server that carries it out
+STEP_TABLE = {
+    Send: "send_message",
+    Receive: "receive_frame",
+    Wait: "wait_event",
+    Call: "call_blocking",
+    Result: "future_result",
+}
+
+log = logging.getLogger("rps.server")
+
+COMMAND_SECONDS = REGISTRY.histogram("rps_command_seconds", "Time spent in a menu command, including waiting for players", ("command",))
+ACTIVE_SESSIONS = REGISTRY.gauge("rps_active_sessions", "Logged in players")
+WAITING_QUEUE_DEPTH = REGISTRY.gauge("rps_waiting_queue_depth", "Players waiting for a quick play opponent")
+EXECUTOR_THREADS = REGISTRY.gauge("rps_executor_threads", "Connection threads the server can run at once")
+EXECUTOR_BUSY = REGISTRY.gauge("rps_executor_busy_threads", "Connection threads serving a client")
+EXECUTOR_QUEUED = REGISTRY.gauge("rps_executor_queued_connections", "Accepted connections waiting for a free thread")
+IDLE_EVICTIONS = REGISTRY.counter("rps_idle_sessions_closed_total", "Sessions closed for leaving a prompt unanswered")
+SLOW_CLIENTS = REGISTRY.counter("rps_slow_clients_total", "Frames a client could not take in time, by what was done about it", ("action",))
 
 class RPSGameServer:
-    def __init__(self, host='127.0.0.1', port=12345):
+    # Primitive used to park a session until something happens (match found, round ready...)
+    event_factory = threading.Event
+    # Let several server processes bind the same port, the kernel spreads connections among them
+    reuse_port = False
+
+    def __init__(self, host='127.0.0.1', port=12345, move_timeout=MOVE_TIMEOUT, storage=None, history=None, kdf_iterations=KDF_ITERATIONS, idle_timeout=IDLE_TIMEOUT, slow_client_policy=SLOW_CLIENT_POLICIES[0],
+                 backlog=BACKLOG, max_sessions=None, max_logins=MAX_LOGINS, ip_rate=0, ip_burst=None, variant="rps",
+                 listener="tls", unix_path=UNIX_PATH, proxy_protocol=False, resume_grace=RESUME_GRACE):
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.ssl_context.load_cert_chain(certfile="server.crt", keyfile="server.key")
-        
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket = self.ssl_context.wrap_socket(
-            self.server_socket, 
-            server_side=True
-        )
-        
-        self.server_socket.listen(5)
+        self.backlog = backlog
+        self.listener = listener
+        self.unix_path = unix_path
+        # Every connection starts with a PROXY protocol header giving the client's address
+        self.proxy_protocol = proxy_protocol
 
-        self.clients = {}
-        self.players = self.load_players()
-        self.rankings = self.load_rankings()
+        self.ssl_context = None
+        if listener == "tls":
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile="server.crt", keyfile="server.key")
+            # Returning clients skip the full handshake: TLS 1.3 session tickets, plus the
+            # server-side session ID cache OpenSSL keeps for TLS 1.2
+            self.ssl_context.options &= ~ssl.OP_NO_TICKET
+            self.ssl_context.num_tickets = 2
+        self.hasher = PasswordHasher(kdf_iterations)
+        self.login_stats = LoginStats()
+
+        self.sessions = SessionRegistry()
+        self.idle_timeout = idle_timeout
+        self.slow_client_policy = slow_client_policy
+        self.outbound = OutboundWriter(self.close_stalled_client)
+        self.spectators = SpectatorHub(self.post, self.event_factory)
+        self.storage = storage or open_storage()
+        self.history = history or open_history()
         self.tournaments = []
-        self.waiting_queue = []
+        self.move_timeout = move_timeout
+        self.rules = VARIANTS[variant]
+        self.setup_state()
+        # Bot games are local to each server process, even with --workers
+        self.bots = BotEngine(self.event_factory, self.call_later, rules=self.rules)
         self.running = True
-        self.executor = ThreadPoolExecutor()
-        self.threads = {}
+        # Same size ThreadPoolExecutor picks by default, spelled out so it can be reported
+        self.max_threads = min(32, (os.cpu_count() or 1) + 4)
+        # A session held for a resume keeps its thread, there can be as many of them as live
+        # sessions and the resuming connections need threads of their own
+        self.executor_threads = self.max_threads * 2 if resume_grace else self.max_threads
+        self.executor = ThreadPoolExecutor(self.executor_threads)
+        self.admission = AdmissionControl(self.session_limit() if max_sessions is None else max_sessions, max_logins, ip_rate, ip_burst)
+        self.resumer = SessionResumer(self.admission, resume_grace, self.admission.max_sessions)
+        ACTIVE_SESSIONS.set_function(lambda: len(self.sessions))
+        WAITING_QUEUE_DEPTH.set_function(lambda: len(self.waiting_queue))
         self.lock = threading.Lock()
-        print(f"Secure server started on {self.host}:{self.port}")
+        # Bound here so the methods a subclass overrides (the asyncio server's I/O, a shard
+        # worker's matchmaking) are the ones dispatched to
+        self.commands = {choice: (name, getattr(self, method)) for choice, (name, method) in COMMAND_TABLE.items()}
+        self.step_runners = {step: getattr(self, method) for step, method in STEP_TABLE.items()}
+        self.setup_listener()
+
+    def setup_state(self):
+        # Accounts, rankings, ratings and the quick play queue, shared by every session of this
+        # server. Accounts are looked up on demand, the rest is loaded now.
+        self.players = PlayerStore(self.storage)
+        self.rankings = self.load_rankings()
+        self.ratings = self.storage.load_ratings()
+        self.leaderboard = Leaderboard(self.rankings)
+        self.waiting_queue = MatchScheduler(self.move_timeout, self.event_factory)
+
+    def call_later(self, delay, callback):
+        return thread_timer(delay, callback)
+
+    def session_limit(self):
+        # Every connection holds a worker thread until it closes, any more would only wait in
+        # the executor's queue
+        return self.max_threads
 
-    def send_message(self, conn, message, receive_message=False):
+    def setup_listener(self):
+        if self.listener == "unix":
+            self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.remove_unix_socket()
+            self.server_socket.bind(self.unix_path)
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((self.host, self.port))
+        # TLS is set up per connection in handle_client, so a slow handshake only holds
+        # up its own worker thread instead of the accept loop
+        self.server_socket.listen(self.backlog)
+        log.info("%s server started on %s", "Secure" if self.ssl_context else "Plaintext", self.address())
+
+    def address(self):
+        where = self.unix_path if self.listener == "unix" else f"{self.host}:{self.port}"
+        return where + (" (PROXY protocol)" if self.proxy_protocol else "")
+
+    def remove_unix_socket(self):
+        # A socket file left by a previous run would make bind fail
         try:
-            if conn._closed:
+            os.unlink(self.unix_path)
+        except FileNotFoundError:
+            pass
+
+    def send_message(self, conn, message, msg_type=INFO):
+        try:
+            if conn._closed and not conn.detached:
                 return
-            if isinstance(message, str):
-                if receive_message:
-                    message = "{{expect_reply}}" + message
-                message = message.encode(encoding="utf-8")
-            conn.send(message)
+            if msg_type == PROMPT:
+                self.remember_prompt(conn, message)
+            conn.send_frame(msg_type, message)
         except Exception as e:
-            print(f"Error sending message: {e}")
+            log.warning("Error sending message: %s", e)
+
+    def post(self, conn, data, key=None, then=None):
+        # Non-blocking send of an encoded frame, for writes made outside the session's own
+        # thread. then() runs once the frame is written.
+        if conn._closed and not conn.detached:
+            return
+        if not self.outbound.post(conn, data, key, then):
+            self.slow_client(conn)
+
+    def broadcast(self, usernames, message, msg_type=INFO, key=None):
+        # Encodes once and queues the frame for every player still connected, without
+        # waiting on any of them
+        data = encode_frame(msg_type, message)
+        for username in usernames:
+            session = self.sessions.get(username)
+            if session:
+                self.post(session.conn, data, key)
+
+    def slow_client(self, conn):
+        # The client's outbox is full: it has not been reading for a while
+        SLOW_CLIENTS.labels(self.slow_client_policy).inc()
+        if self.slow_client_policy == "disconnect":
+            session = self.sessions.for_conn(conn)
+            log.info("Disconnecting %s: not reading its messages", session.username if session else "unknown user")
+            self.close_connection(conn)
 
+    def close_stalled_client(self, conn):
+        SLOW_CLIENTS.labels("stalled").inc()
+        session = self.sessions.for_conn(conn)
+        log.info("Disconnecting %s: took no data for %d seconds", session.username if session else "unknown user", WRITE_TIMEOUT)
+        self.close_connection(conn)
 
-    def load_players(self):
+    def receive_message(self, conn, timeout=None):
+        # The client's next reply. If a logged in player's connection drops meanwhile, the
+        # read goes on over the connection they resume the session with.
+        self.sessions.expect_reply(conn)
         try:
-            with open("players.json", "r") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return {}
+            while True:
+                attachment = conn.attachments
+                try:
+                    return (yield Receive(conn, timeout))
+                except TimeoutError:
+                    raise
+                except OSError:
+                    if not (yield from self.hold_session(conn, attachment)):
+                        raise
+        finally:
+            self.sessions.got_reply(conn)
 
-    def save_players(self):
-        with open("players.json", "w") as f:
-            json.dump(self.players, f)
+    def run_steps(self, steps):
+        # Runs a handler generator on this thread, carrying out each step it yields
+        value, error = None, None
+        while True:
+            try:
+                step = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                value, error = self.step_runners[type(step)](*step), None
+            except BaseException as e:
+                value, error = None, e
 
-    def load_rankings(self):
+    def receive_frame(self, conn, timeout=None):
+        conn.settimeout(timeout)
         try:
-            with open("rankings.json", "r") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return {}
+            return conn.recv_frame().text.strip()
+        finally:
+            conn.settimeout(None)
 
-    def save_rankings(self):
-        with open("rankings.json", "w") as f:
-            json.dump(self.rankings, f)
+    def wait_event(self, event, timeout=None):
+        return event.wait(timeout)
+
+    def call_blocking(self, func, args=()):
+        return func(*args)
+
+    def future_result(self, future):
+        return future.result()
+
+    def remember_prompt(self, conn, message):
+        session = self.sessions.for_conn(conn)
+        if session is not None:
+            session.prompt = message
+
+    def hold_session(self, conn, attachment):
+        # conn's connection dropped while we were reading it. A logged in player gets the
+        # grace period to resume on a new connection: True once they are back, False if the
+        # session ends here.
+        session = self.sessions.for_conn(conn)
+        resumed = session and self.resumer.hold(session, attachment, self.event_factory())
+        if not resumed:
+            return False
+        if not resumed.is_set():
+            log.info("Connection of %s dropped, holding the session for %d s", session.username, self.resumer.grace)
+        yield Wait(resumed, self.resumer.time_left(session))
+        return self.resumer.release(session)
+
+    def resume_session(self, conn):
+        # Moves this connection into the held session its token names, in place of a login
+        yield Send(conn, "Enter resume token: ", PROMPT)
+        token = yield from self.receive_message(conn)
+        session_id = self.resumer.session_id(token)
+        session = self.sessions.find(session_id) if session_id is not None else None
+        addr = self.sessions.for_conn(conn).addr
+        token = self.resumer.claim(token, session, conn, self.login_stats.average_auth())
+        if token is None:
+            yield Send(conn, "Invalid or expired resume token, please log in. Disconnecting...\n", ERROR)
+            return
+        # This connection's socket now belongs to the resumed session
+        self.sessions.remove(conn)
+        session.addr = addr
+        log.info("%s resumed their session from %s", session.username, addr)
+        yield Send(session.conn, f"Session resumed. Welcome back, {session.username}!\n")
+        yield Send(session.conn, f"{TOKEN_PREFIX}{token}\n")
+        if session.idle_since is not None and session.prompt:
+            yield Send(session.conn, session.prompt, PROMPT)
+
+    def load_rankings(self):
+        return self.storage.load_rankings()
+
+    def tls_handshake(self, conn):
+        started = time.perf_counter()
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        conn = self.ssl_context.wrap_socket(conn, server_side=True)
+        conn.settimeout(None)
+        self.login_stats.record_handshake(time.perf_counter() - started, conn.session_reused)
+        return conn
+
+    def lookup_player(self, username):
+        # Accounts missing from the cache are read from storage as a blocking step
+        stored = self.players.cached(username)
+        if stored is None:
+            stored = yield Call(self.players.get, (username,))
+        return stored
+
+    def check_password(self, username, password):
+        started = time.perf_counter()
+        stored = yield from self.lookup_player(username)
+        valid = stored is not None and (yield Result(self.hasher.verify(password, stored)))
+        self.login_stats.record_auth(time.perf_counter() - started)
+        if valid and self.hasher.needs_rehash(stored):
+            # Upgrade legacy sha256 hashes (or an old iteration count) now that we know the password
+            hashed_pw = yield Result(self.hasher.hash(password))
+            self.players[username] = hashed_pw
+            yield Call(self.storage.save_player, (username, hashed_pw))
+        return valid
+
+    def open_connection(self, conn, addr):
+        # Reads the PROXY header and does the TLS handshake, whichever are enabled. Returns the
+        # socket frames go over and the client's address, None if the client is turned away.
+        if self.proxy_protocol:
+            addr = read_header(conn) or addr
+            conn.settimeout(None)
+            rejected = self.admission.limit_rate(peer_ip(addr))
+            if rejected:
+                log.debug("Rejecting %s: %s limit reached", addr, rejected[0])
+                self.admission.release(False)
+                self.reply_busy(conn, rejected[1])
+                return None, addr
+        if self.ssl_context:
+            conn = self.tls_handshake(conn)
+        return conn, addr
 
     def handle_client(self, conn, addr):
+        try:
+            conn, addr = self.open_connection(conn, addr)
+        except (OSError, ProxyProtocolError) as e:
+            log.info("Connection setup with %s failed: %s", addr, e)
+            conn.close()
+            self.admission.release(False)
+            return
+        if conn is None:
+            return
+        conn = FramedSocket(conn)
+        self.sessions.open(conn, addr)
         try:
             if conn._closed:
                 return
-            self.send_message(conn, "Welcome! Login (1) or Register (2): ", True)
-            choice = conn.recv(1024).decode().strip()
-            
-            if choice == "1":
-                self.login(conn)
-            elif choice == "2":
-                self.register(conn)
-            else:
-                self.send_message(conn, "Invalid choice. Disconnecting...\n")
+            self.run_steps(self.welcome(conn))
         except Exception as e:
-            print(f"Error handling client {addr}: {e}")
+            log.warning("Error handling client %s: %s", addr, e)
+        finally:
+            self.close_connection(conn)
 
+    def welcome(self, conn):
+        yield Send(conn, WELCOME, PROMPT)
+        choice = yield from self.receive_message(conn)
+
+        if choice == "1":
+            username = yield from self.login(conn)
+            if username:
+                yield from self.command_loop(conn, username)
+        elif choice == "2":
+            yield from self.register(conn)
+        elif choice == "3":
+            yield from self.resume_session(conn)
+        else:
+            yield Send(conn, "Invalid choice. Disconnecting...\n", ERROR)
 
     def login(self, conn):
-        self.send_message(conn, "Enter username: ", True)
-        username = conn.recv(1024).decode().strip()
-        self.send_message(conn, "Enter password: ", True)
-        password = conn.recv(1024).decode().strip()
+        # The username once logged in, None if the client is turned away
+        yield Send(conn, "Enter username: ", PROMPT)
+        username = yield from self.receive_message(conn)
+        yield Send(conn, "Enter password: ", PROMPT)
+        password = yield from self.receive_message(conn)
 
-        hashed_pw = hashlib.sha256(password.encode()).hexdigest()
+        if not (yield from self.check_password(username, password)):
+            yield Send(conn, "Invalid credentials. Disconnecting...\n", ERROR)
+            return None
+        session = self.sessions.for_conn(conn)
+        other = self.sessions.bind(session, username)
+        while other is not None:
+            if not self.resumer.give_up(other):
+                yield Send(conn, "This account is already logged in. Disconnecting...\n", ERROR)
+                return None
+            # The player's previous connection dropped: logging in again ends that session
+            log.info("%s logged in again, closing their held session", username)
+            self.close_connection(other.conn)
+            other = self.sessions.bind(session, username)
+        yield Send(conn, "Logged In successfully!.\n")
+        self.admission.logged_in()
+        token = self.resumer.issue(session)
+        if token:
+            yield Send(conn, f"{TOKEN_PREFIX}{token}\n")
+        return username
 
-        if username in self.players and self.players[username] == hashed_pw :
-            self.send_message(conn, "Logged In successfully!.\n")
-            self.clients[username] = conn
-            self.wait_for_command(conn, username)
-        else:
-            self.send_message(conn, "Invalid credentials. Disconnecting...\n")
-            conn.close()
+    def valid_name(self, name):
+        return 0 < len(name) <= NAME_LENGTH and name.isprintable()
 
     def register(self, conn):
-        self.send_message(conn, "Enter a new username: ", True)
-        username = conn.recv(1024).decode().strip()
-        self.send_message(conn, "Enter a new password: ", True)
-        password = conn.recv(1024).decode().strip()
+        yield Send(conn, "Enter a new username: ", PROMPT)
+        username = yield from self.receive_message(conn)
+        yield Send(conn, "Enter a new password: ", PROMPT)
+        password = yield from self.receive_message(conn)
 
-        if username in self.players:
-            self.send_message(conn, "Username already exists. Disconnecting...\n")
-            conn.close()
+        if not self.valid_name(username):
+            yield Send(conn, f"Usernames are 1 to {NAME_LENGTH} printable characters. Disconnecting...\n", ERROR)
+        elif (yield from self.lookup_player(username)) is not None:
+            yield Send(conn, "Username already exists. Disconnecting...\n", ERROR)
         else:
-            hashed_pw = hashlib.sha256(password.encode()).hexdigest()
+            hashed_pw = yield Result(self.hasher.hash(password))
             self.players[username] = hashed_pw
-            self.save_players()
-            self.send_message(conn, "Registration successful! You can now log in.\n")
-            conn.close()
-            
-    def send_rankings(self, conn):
-        if not self.rankings:
-            conn.send("No rankings available yet.\n")
-        else:
-            rankings_list = "\n".join([f"{player}: {score}" for player, score in sorted(self.rankings.items(), key=lambda x: x[1], reverse=True)])
-            conn.send(f"Player Rankings:\n{rankings_list}\n".encode())
-        self.wait_for_command(conn)
-
-    def match_player(self, username):
-        self.waiting_queue.append(username)
-        if len(self.waiting_queue) >= 2:
-            self.start_game()
-        
+            # save_player waits for the group commit to land
+            yield Call(self.storage.save_player, (username, hashed_pw))
+            yield Send(conn, "Registration successful! You can now log in.\n")
 
-    def restart_connection_thread(self, conn2, username):
-        # haka ndiro l connection f another thread w na7oo l 9dim so that we continue interactions with each connection with its own thread (kima m lwl)
-        fileno = conn2.fileno()
-        self.threads[fileno].cancel()
-        self.threads[fileno] = self.executor.submit(self.wait_for_command, conn2, username )
-        return fileno
+    def format_rankings_page(self, page):
+        if not len(self.leaderboard):
+            return "No rankings available yet.\n"
+        page = min(page, self.leaderboard.page_count() - 1)
+        rankings_list = "\n".join(f"{rank}. {player}: {score}" for rank, player, score in self.leaderboard.page(page))
+        return f"Player Rankings (page {page + 1}/{self.leaderboard.page_count()}):\n{rankings_list}\n"
 
-    def start_game(self):
-        
-        player1, player2 = self.waiting_queue[0], self.waiting_queue[1]
-        self.waiting_queue = self.waiting_queue[2:]
-        conn1, conn2 = self.clients[player1], self.clients[player2]
+    def format_player_position(self, username):
+        rank = self.leaderboard.rank(username)
+        if rank is None:
+            return f"You are not ranked yet, win a game to get on the board. Rating: {self.rating(username):g}\n"
+        around = "\n".join(
+            f"{'>' if player == username else ' '} {position}. {player}: {score}"
+            for position, player, score in self.leaderboard.around(username)
+        )
+        return f"You are ranked #{rank} of {len(self.leaderboard)}, rating {self.rating(username):g}:\n{around}\n"
 
-        self.send_message( conn1,"Match found! Play your move: rock, paper, scissors\n", True)
-        self.send_message(conn2,"Match found! Play your move: rock, paper, scissors\n", True)
+    def rankings_command(self, username, command, page):
+        # Returns the text to show (None to leave the rankings view) and the page the player is on next
+        last_page = self.leaderboard.page_count() - 1
+        if command == "b":
+            return None, page
+        if command == "m":
+            return self.format_player_position(username), page
+        if command == "t":
+            page = 0
+        elif command == "n":
+            page = min(page + 1, last_page)
+        elif command == "p":
+            page = max(page - 1, 0)
+        elif command.isdigit() and int(command) >= 1:
+            page = min(int(command) - 1, last_page)
+        else:
+            return "Unknown option.\n", page
+        return self.format_rankings_page(page), page
 
-        move1 = conn1.recv(1024).decode().strip()
-        move2 = conn2.recv(1024).decode().strip()
+    def send_rankings(self, conn, username):
+        text, page = self.rankings_command(username, "t", 0)
+        while text is not None:
+            yield Send(conn, text)
+            yield Send(conn, RANKINGS_MENU, PROMPT)
+            text, page = self.rankings_command(username, (yield from self.receive_message(conn)).lower(), page)
+
+    def match_player(self, conn, username):
+        ticket = self.waiting_queue.enqueue(username, self.rating(username))
+        if ticket.match is None:
+            yield Send(conn, "Waiting for an opponent...\n")
+            yield Wait(ticket.event)
+            if ticket.match is None:
+                return
+        yield from self.play_match(conn, username, ticket.match)
 
-        print(move1,move2)
-        result = self.determine_winner(move1, move2, player1, player2)
-        self.send_message(conn1, result)
-        self.send_message(conn2, result)
+    def play_bot(self, conn, username):
+        game = self.bots.new_game(username)
+        try:
+            while not game.over:
+                self.bots.request(game)
+                yield Wait(game.event)
+                yield Send(conn, game.prompt(), PROMPT)
+                try:
+                    move = yield from self.receive_message(conn, self.move_timeout)
+                except TimeoutError:
+                    yield Send(conn, "Time is up, you forfeit the game.\n", ERROR)
+                    return
+                yield Send(conn, game.play(move.lower()))
+            yield Send(conn, game.result(), RESULT)
+        finally:
+            self.bots.end_game(game)
 
-        self.restart_connection_thread(conn2, player2)
+    def play_match(self, conn, username, match, finish=None, intro="Match found"):
+        # Runs in each player's own session, so a slow player never delays reading the other's move
+        finish = finish or self.finish_match
+        yield Send(conn, f"{intro} against {match.opponent(username)}! Play your move: {self.rules.prompt}\n", PROMPT)
+        try:
+            move = yield from self.receive_message(conn, match.remaining())
+        except TimeoutError:
+            move = None
+            yield Send(conn, "Time is up, you forfeit this match.\n", ERROR)
+        except OSError:
+            if match.submit(username, None):
+                finish(match)
+            raise
 
-        self.wait_for_command(conn1, player1)
+        if match.submit(username, move):
+            finish(match)
+        # The opponent's session resolves the match, unless it is stuck past the deadline
+        if not (yield Wait(match.done, match.remaining() + 1)):
+            if match.expire():
+                finish(match)
+            yield Wait(match.done)
+        yield Send(conn, match.result, RESULT)
 
+    def finish_match(self, match):
+        player1, player2 = match.players
+        move1, move2 = match.moves[player1], match.moves[player2]
+        log.debug("Match %s vs %s: %s / %s", player1, player2, move1, move2)
+        if move1 is None and move2 is None:
+            self.history.record(player1, player2, None, None, None)
+            match.result = "Neither player moved in time. Match abandoned."
+        elif move1 is None or move2 is None:
+            winner, loser = (player2, player1) if move1 is None else (player1, player2)
+            self.history.record(player1, player2, move1, move2, winner)
+            self.update_rankings(winner)
+            self.update_ratings(winner, loser, 1)
+            match.result = f"{winner} wins! {loser} forfeited."
+        else:
+            match.result = self.determine_winner(move1, move2, player1, player2)
+        match.done.set()
 
     def determine_winner(self, move1, move2, player1, player2):
-        if move1 not in ["rock", "paper", "scissors"] or move2 not in ["rock", "paper", "scissors"]:
+        outcome = self.rules.outcome(move1, move2)
+        if outcome == VOID:
+            self.history.record(player1, player2, move1, move2, None)
             return "Invalid move. Game aborted."
 
-        if move1 == move2:
+        if outcome == DRAW:
+            self.history.record(player1, player2, move1, move2, None)
+            self.update_ratings(player1, player2, 0.5)
             return f"Draw! Both chose {move1}."
 
-        winner = player1 if (move1, move2) in [("rock", "scissors"), ("scissors", "paper"), ("paper", "rock")] else player2
+        if outcome == FIRST:
+            winner, loser, winning_move, losing_move = player1, player2, move1, move2
+        else:
+            winner, loser, winning_move, losing_move = player2, player1, move2, move1
 
+        self.history.record(player1, player2, move1, move2, winner)
         self.update_rankings(winner)
-        return f"{winner} wins! {move1} beats {move2}."
+        self.update_ratings(winner, loser, 1)
+        return f"{winner} wins! {winning_move} beats {losing_move}."
 
     def update_rankings(self, winner, points=1):
-        if winner not in self.rankings:
-            self.rankings[winner] = 0
-        self.rankings[winner] += points
-        self.save_rankings()
+        # The index and the storage queue are updated under the lock too, so two wins of
+        # the same player can never leave the older score in either of them
+        with self.lock:
+            score = self.rankings.get(winner, 0) + points
+            self.rankings[winner] = score
+            self.leaderboard.update(winner, score)
+            self.storage.save_ranking(winner, score)
 
-    def create_tournament(self, conn, creator):
-        self.send_message(conn, "Enter tournament name: ", True)
-        name = conn.recv(1024).decode().strip()
+    def rating(self, username):
+        return self.ratings.get(username, DEFAULT_RATING)
 
-        if any(t["name"] == name for t in self.tournaments):
-            self.send_message(conn, "Tournament with this name already exists.\n")
-            return
+    def update_ratings(self, player1, player2, score1):
+        # Quick play only, score1 is 1 if player1 won and 0.5 for a draw
+        with self.lock:
+            rating1, rating2 = rate(self.rating(player1), self.rating(player2), score1)
+            self.ratings[player1] = rating1
+            self.ratings[player2] = rating2
+            self.storage.save_rating(player1, rating1)
+            self.storage.save_rating(player2, rating2)
 
-        self.tournaments.append({
+    def new_tournament(self, name, creator):
+        return {
             "name": name,
             "creator": creator,
             "players": [creator],
-            "matches": [],
-            "in_progress": False
-        })
-        self.send_message(conn, f"Tournament '{name}' created.\n")
-        self.wait_for_command(conn, creator)
+            "in_progress": False,
+            "started": self.event_factory(),
+            "runner": None,
+            "channel": self.spectators.channel(name, format_lobby(name, [creator])),
+        }
+
+    def add_tournament(self, name, creator):
+        # False if a tournament with that name is already open or running
+        with self.lock:
+            if any(t["name"] == name for t in self.tournaments):
+                return False
+            self.tournaments.append(self.new_tournament(name, creator))
+        return True
+
+    def lobbies(self):
+        # Tournaments waiting to start
+        return [t for t in self.tournaments if not t["in_progress"]]
+
+    def enter_tournament(self, tournament, username):
+        # None once username is in the lobby, otherwise what keeps them out
+        if username in tournament["players"]:
+            return "You are already in this tournament.\n"
+        if tournament["in_progress"]:
+            return "This tournament has already started.\n"
+        tournament["players"].append(username)
+        tournament["channel"].publish(f"{username} joined '{tournament['name']}'.\n", format_lobby(tournament["name"], tournament["players"]))
+        return None
+
+    def publish_tournament(self, tournament, match):
+        # Called by the runner with the match that just finished, or None when a round starts
+        bracket = tournament["runner"].bracket
+        tournament["channel"].publish(format_update(tournament["name"], bracket, match), format_bracket(tournament["name"], bracket))
+
+    def create_tournament(self, conn, creator):
+        yield Send(conn, "Enter tournament name: ", PROMPT)
+        name = yield from self.receive_message(conn)
+
+        if not self.valid_name(name):
+            yield Send(conn, f"Tournament names are 1 to {NAME_LENGTH} printable characters.\n", ERROR)
+            return
+        if not self.add_tournament(name, creator):
+            yield Send(conn, "Tournament with this name already exists.\n", ERROR)
+            return
+        yield Send(conn, f"Tournament '{name}' created.\n")
 
     def join_tournament(self, conn, username):
-        if not self.tournaments:
-            self.send_message(conn, "No tournaments available to join.\n")
+        available_tournaments = self.lobbies()
+        if not available_tournaments:
+            yield Send(conn, "No tournaments available to join.\n")
             return
 
         # Send list of available tournaments
         tournament_list = "Available tournaments to join:\n"
-        available_tournaments = [t for t in self.tournaments if not t["in_progress"]]
         for i, t in enumerate(available_tournaments, 1):
             tournament_list += f"{i}. {t['name']} (Creator: {t['creator']})\n"
-        self.send_message(conn, tournament_list)
+        yield Send(conn, tournament_list)
         
         # Send prompt for selection
-        self.send_message(conn, "Enter tournament number to join (0 to cancel): ", True)
+        yield Send(conn, "Enter tournament number to join (0 to cancel): ", PROMPT)
         
         try:
-            choice = int(conn.recv(1024).decode().strip())
-            if choice == 0:
-                return
-            if 1 <= choice <= len(available_tournaments):
-                tournament = available_tournaments[choice - 1]
-                if username in tournament["players"]:
-                    self.send_message(conn, "You are already in this tournament.\n")
-                elif tournament["in_progress"]:
-                    self.send_message(conn, "This tournament has already started.\n")
-                    self.wait_for_command(conn, username)
-                else:
-                    tournament["players"].append(username)
-                    self.send_message(conn, f"Successfully joined tournament '{tournament['name']}'.\n")
-            else:
-                self.send_message(conn, "Invalid tournament number.\n")
-                self.wait_for_command(conn, username)
+            choice = int((yield from self.receive_message(conn)))
         except ValueError:
-            self.send_message(conn, "Invalid input. Please enter a number.\n")
-            self.wait_for_command(conn, username)
+            yield Send(conn, "Invalid input. Please enter a number.\n", ERROR)
+            return
+        if choice == 0:
+            return
+        if not 1 <= choice <= len(available_tournaments):
+            yield Send(conn, "Invalid tournament number.\n", ERROR)
+            return
 
+        tournament = available_tournaments[choice - 1]
+        error = self.enter_tournament(tournament, username)
+        if error:
+            yield Send(conn, error, ERROR)
+            return
+        yield Send(conn, f"Successfully joined tournament '{tournament['name']}'.\n")
+        yield Send(conn, "Waiting for the tournament to start...\n")
+        yield Wait(tournament["started"])
+        yield from self.play_tournament(conn, username, tournament)
 
     def start_tournament(self, conn, username):
-        available_tournaments = [t for t in self.tournaments if t["creator"] == username and not t["in_progress"] and len(t["players"]) >= 2]
+        available_tournaments = [t for t in self.lobbies() if t["creator"] == username and len(t["players"]) >= 2]
         
         if not available_tournaments:
-            self.send_message(conn, "You have no tournaments ready to start (must have at least 2 players).\n")
-            self.wait_for_command(conn, username)
+            yield Send(conn, "You have no tournaments ready to start (must have at least 2 players).\n", ERROR)
             return
 
         # Send list of available tournaments
         tournament_list = "Available tournaments to start:\n"
         for i, t in enumerate(available_tournaments, 1):
             tournament_list += f"{i}. {t['name']} (Players: {len(t['players'])})\n"
-        self.send_message(conn, tournament_list)
+        yield Send(conn, tournament_list)
         
         # Send prompt for selection
-        self.send_message(conn, "Enter tournament number to start (0 to cancel): ", True)
+        yield Send(conn, "Enter tournament number to start (0 to cancel): ", PROMPT)
         
         try:
-            choice = int(conn.recv(1024).decode().strip())
-            if choice == 0:
-                return
-            if 1 <= choice <= len(available_tournaments):
-                tournament = available_tournaments[choice - 1]
-                tournament["in_progress"] = True
-                self.generate_tournament_matches(tournament)
-                self.run_tournament_round(tournament, conn)
-                self.send_message(conn, f"Tournament '{tournament['name']}' started!\n")
-            else:
-                self.send_message(conn, "Invalid tournament number.\n")
+            choice = int((yield from self.receive_message(conn)))
         except ValueError:
-            self.send_message(conn, "Invalid input. Please enter a number.\n")
+            yield Send(conn, "Invalid input. Please enter a number.\n", ERROR)
+            return
+        if choice == 0:
+            return
+        if not 1 <= choice <= len(available_tournaments):
+            yield Send(conn, "Invalid tournament number.\n", ERROR)
+            return
+
+        tournament = available_tournaments[choice - 1]
+        yield Send(conn, f"Tournament '{tournament['name']}' started!\n")
+        self.launch_tournament(tournament)
+        yield from self.play_tournament(conn, username, tournament)
+
+    def launch_tournament(self, tournament):
+        tournament["in_progress"] = True
+        # Players who left the lobby are dropped, the rest are seeded by ranking (ties in random order)
+        players = [p for p in tournament["players"] if p in self.sessions]
+        random.shuffle(players)
+        players.sort(key=lambda p: self.rankings.get(p, 0), reverse=True)
+        tournament["players"] = players
+        tournament["id"] = self.history.new_tournament(tournament["name"])
+        tournament["runner"] = TournamentRunner(
+            players,
+            lambda match: self.resolve_tournament_match(match, tournament["id"]),
+            lambda champion: self.announce_tournament_winner(tournament, champion),
+            self.move_timeout,
+            self.event_factory,
+            self.call_later,
+            lambda match: self.publish_tournament(tournament, match),
+        )
+        tournament["started"].set()
+        tournament["runner"].start()
+
+    def cancel_tournaments(self, creator):
+        # Tournaments that never started die with their creator, players in the lobby are released
+        with self.lock:
+            cancelled = [t for t in self.tournaments if t["creator"] == creator and not t["in_progress"]]
+            for tournament in cancelled:
+                self.tournaments.remove(tournament)
+        for tournament in cancelled:
+            tournament["started"].set()
+            tournament["channel"].close(f"Tournament '{tournament['name']}' was cancelled.\n", ERROR)
+
+    def play_tournament(self, conn, username, tournament):
+        runner = tournament["runner"]
+        if runner is None:
+            yield Send(conn, f"Tournament '{tournament['name']}' was cancelled.\n", ERROR)
+            return
+        while True:
+            ticket = runner.ticket(username)
+            if not ticket.event.is_set():
+                yield Send(conn, "Waiting for your next match...\n")
+                yield Wait(ticket.event)
+            if ticket.match is None:
+                break
+            yield from self.play_match(conn, username, ticket.match, runner.finish_match, "Tournament match")
+        if not runner.finished:
+            yield Send(conn, "You are out of the tournament.\n")
+        elif username in runner.still_playing():
+            # The others got the result in announce_tournament_winner's broadcast
+            yield Send(conn, tournament["result"], RESULT)
+
+    def watching_choice(self):
+        # Listing of the tournaments that can be watched, in the order they are numbered
+        tournaments = list(self.tournaments)
+        return tournaments, self.format_watching(tournaments)
 
-    def generate_tournament_matches(self, tournament):
-        players = tournament["players"]
-        random.shuffle(players)  # Randomize player order
-        for i in range(0, len(players), 2):
-            if i + 1 < len(players):
-                tournament["matches"].append((players[i], players[i + 1]))
+    def format_watching(self, tournaments):
+        listing = "Tournaments to watch:\n"
+        for i, t in enumerate(tournaments, 1):
+            listing += f"{i}. {t['name']} ({'in progress' if t['in_progress'] else 'waiting for players'}, {len(t['players'])} players)\n"
+        return listing
+
+    def watch_tournament(self, conn, username):
+        tournaments, listing = self.watching_choice()
+        if not tournaments:
+            yield Send(conn, "No tournaments to watch.\n")
+            return
+        yield Send(conn, listing)
+        yield Send(conn, "Enter tournament number to watch (0 to cancel): ", PROMPT)
+        try:
+            choice = int((yield from self.receive_message(conn)))
+        except ValueError:
+            yield Send(conn, "Invalid input. Please enter a number.\n", ERROR)
+            return
+        if choice == 0:
+            return
+        if not 1 <= choice <= len(tournaments):
+            yield Send(conn, "Invalid tournament number.\n", ERROR)
+            return
+
+        channel = tournaments[choice - 1]["channel"]
+        yield Send(conn, f"Watching tournament '{channel.name}', you will be back at the menu when it ends.\n")
+        ended = channel.subscribe(conn)
+        if ended is None:
+            yield Send(conn, "This tournament is over.\n")
+            return
+        # Not idle: like a player waiting for a match, the spectator is waiting on the server
+        try:
+            yield Wait(ended)
+        finally:
+            channel.unsubscribe(conn)
 
     def shutdown(self):
         self.running = False
         # Close all client connections
-        for username, conn in self.clients.items():
-          self.close_connection(conn,username)
-        # Close server socket
+        for session in self.sessions.all():
+            self.close_connection(session.conn)
+        self.close_listener()
+        self.close_storage()
+        self.hasher.close()
+        log.info(self.login_stats.summary())
+        log.info(self.resumer.summary())
+
+    def close_listener(self):
         if not self.server_socket._closed:
             self.server_socket.close()
+            if self.listener == "unix":
+                self.remove_unix_socket()
 
+    def close_storage(self):
+        self.storage.close()
+        self.history.close()
 
-    def wait_for_command(self, conn, username= None):
-        
-        commands = (
-            "Available commands:\n"
-            "1. Play Game\n"
-            "2. View Rankings\n"
-            "3. Create Tournament\n"
-            "4. Join Tournament\n"
-            "5. Start Tournament\n"
-            "6. Quit\n"
-        )
-        print(f"Sent command to {username}")  # Debugging statement
-        self.send_message(conn, commands, True)
-        if not username:
-            username = [k for k, v in self.clients.items() if v == conn][0]
+    def command(self, choice):
+        return self.commands.get(choice, ("invalid", self.invalid_command))
+
+    def command_loop(self, conn, username):
+        # One iteration per command: the stack stays flat however long the session runs
+        session = self.sessions.for_conn(conn)
+        session.state = MENU
         try:
-            choice = conn.recv(1024).decode().strip()
-            if choice == "1":
-                self.match_player(username)
-            elif choice == "2":
-                self.send_rankings(conn)
-            elif choice == "3":
-                self.create_tournament(conn, username)
-            elif choice == "4":
-                self.join_tournament(conn, username)
-            elif choice == "5":
-                self.start_tournament(conn, username)
-            elif choice == "6":
-                self.send_message(conn, "Goodbye!\n")
-                self.close_connection(conn, username)
-            else:
-                self.send_message(conn, "Invalid choice. Please try again.\n")
-                self.wait_for_command(conn, username)
+            while self.running and session.state == MENU:
+                log.debug("Sent command menu to %s", username)
+                yield Send(conn, COMMANDS, PROMPT)
+                name, handler = self.command((yield from self.receive_message(conn)))
+                started = time.perf_counter()
+                next_state = (yield from handler(conn, username)) or MENU
+                # An idle timeout may have closed the session in the meantime
+                if session.state == MENU:
+                    session.state = next_state
+                COMMAND_SECONDS.labels(name).observe(time.perf_counter() - started)
         except Exception as e:
-            print(f"Error processing command: {e}")
-            
+            log.info("Error processing command for %s: %s", username, e)
 
-    def run_tournament_round(self, tournament, conn):
-        if not tournament["matches"]:
-            self.announce_tournament_winner(tournament)
-            return
-        
-        current_matches = tournament["matches"].copy()
-        tournament["matches"] = []  # Clear for next round
-        winners = []
-        
-        for player1, player2 in current_matches:
-            try:
-                # Get the connections for both players
-                conn1 = self.clients.get(player1)
-                conn2 = self.clients.get(player2)
-                
-                if not conn1 or not conn2:
-                    print(f"Player disconnected from tournament: {player1 if not conn1 else player2}")
-                    # Advance the connected player
-                    winners.append(player2 if not conn1 else player1)
-                    continue
-                
-                # Notify players of their match
-                match_msg = f"Tournament match against {player2}\n"
-                conn1.send(match_msg.encode())
-                match_msg = f"Tournament match against {player1}\n"
-                conn2.send(match_msg.encode())
-                
-                # Get moves from both players
-                self.send_message(conn1, "Enter your move (rock/paper/scissors): ", True)
-                self.send_message(conn2, "Enter your move (rock/paper/scissors): ", True)
-                
-                move1 = conn1.recv(1024).decode().strip().lower()
-                move2 = conn2.recv(1024).decode().strip().lower()
-                
-                # Determine winner
-                result = self.determine_tournament_winner(move1, move2, player1, player2)
-                winner = result["winner"]
-                result_msg = result["message"]
-                
-                # Send result to both players
-                conn1.send(result_msg.encode())
-                conn2.send(result_msg.encode())
-                
-                if winner:
-                    winners.append(winner)
-                
-            except Exception as e:
-                print(f"Error in tournament match: {e}")
-                continue
-        
-        # Set up next round if there are winners
-        if len(winners) > 1:
-            # Pair up winners for next round
-            for i in range(0, len(winners), 2):
-                if i + 1 < len(winners):
-                    tournament["matches"].append((winners[i], winners[i + 1]))
-                else:
-                    # If odd number of winners, give bye to last player
-                    tournament["matches"].append((winners[i], winners[i]))
-            
-            # Start next round
-            self.run_tournament_round(tournament, conn)
-        else:
-            # Tournament is complete
-            self.announce_tournament_winner(tournament)
-
-            for player in tournament["players"]:
-                if player in self.clients and self.clients[player] != conn:
-                    self.restart_connection_thread(self.clients[player], player)
-            self.wait_for_command(conn)
-            
-
-    def determine_tournament_winner(self, move1, move2, player1, player2):
-        if move1 not in ["rock", "paper", "scissors"] or move2 not in ["rock", "paper", "scissors"]:
-            return {
-                "winner": None,
-                "message": "Invalid move. Match voided.\n"
-            }
-        
-        if move1 == move2:
-            # In tournament, no draws allowed - player1 advances
-            return {
-                "winner": player1,
-                "message": f"Draw! {player1} advances by default.\n"
-            }
-        
-        winning_moves = {
-            "rock": "scissors",
-            "paper": "rock",
-            "scissors": "paper"
-        }
-        
-        if winning_moves[move1] == move2:
-            winner = player1
-        else:
-            winner = player2
-        
-        return {
-            "winner": winner,
-            "message": f"{winner} wins with {move1 if winner == player1 else move2}!\n"
-        }
+    def invalid_command(self, conn, username):
+        yield Send(conn, "Invalid choice. Please try again.\n", ERROR)
 
-    def announce_tournament_winner(self, tournament):
-        if not tournament["matches"] and len(tournament["players"]) > 0:
-            winner = tournament["players"][0]
-            winner_conn = self.clients.get(winner)
-            
-            # Award tournament points
-            self.update_rankings(winner, points=5)  # More points for tournament win
-            
-            # Broadcast to all tournament players
-            for player in tournament["players"]:
-                if player in self.clients:
-                    conn = self.clients[player]
-                    conn.send(f"Tournament '{tournament['name']}' finished! Winner: {winner}\n".encode())
-            
-            # Remove tournament from active list
-            self.tournaments.remove(tournament)
-        else:
-            print("Tournament ended without a clear winner")
+    def quit(self, conn, username):
+        yield Send(conn, "Goodbye!\n", CLOSE)
+        return CLOSED
+
+    def show_stats(self, conn, username):
+        # Scanning the history reads the whole log
+        stats = yield Call(self.history.stats, (username,))
+        yield Send(conn, self.format_stats(stats))
+
+    def format_stats(self, stats):
+        if stats is None:
+            return "You have not played any matches yet.\n"
+        games, wins = stats["games"], stats["wins"]
+        moves = sum(stats["moves"].values()) or 1
+        lines = [
+            f"Matches played: {games} ({stats['tournament_games']} in tournaments)",
+            f"Won {wins}, lost {stats['losses']}, drawn {stats['draws']}: {wins * 100 / games:.0f}% win rate",
+            "Moves: " + ", ".join(f"{move} {count * 100 / moves:.0f}%" for move, count in stats["moves"].items() if count or move in self.rules.codes),
+            "Last matches:",
+        ]
+        for opponent, move, opponent_move, outcome, tournament in reversed(stats["recent"]):
+            line = f"  {outcome} against {opponent}: {move or 'no move'} vs {opponent_move or 'no move'}"
+            lines.append(line + (f" (tournament '{tournament}')" if tournament else ""))
+        return "\n".join(lines) + "\n"
+
+    def resolve_tournament_match(self, match, tournament_id=0):
+        return resolve_match(self.rules, self.history, match, tournament_id)
+
+    def end_tournament(self, tournament, champion):
+        with self.lock:
+            if tournament in self.tournaments:
+                self.tournaments.remove(tournament)
+        if champion is not None:
+            self.update_rankings(champion, points=5)  # More points for tournament win
+        tournament["result"] = format_result(tournament["name"], champion)
+        return tournament["result"]
+
+    def eliminated_players(self, tournament):
+        still_playing = tournament["runner"].still_playing()
+        return [player for player in tournament["players"] if player not in still_playing]
+
+    def announce_tournament_winner(self, tournament, champion):
+        message = self.end_tournament(tournament, champion)
+        # Broadcast to the players knocked out earlier. Called from the thread that finished
+        # the final, which must not wait on any of them.
+        self.broadcast(self.eliminated_players(tournament), message, RESULT)
+        tournament["channel"].close(message, RESULT)
         
     def run(self):
-        print("Server is running...")
+        log.info("Server is running...")
         signal.signal(signal.SIGINT, self.signal_handler)  # Catch Ctrl+C
+        EXECUTOR_THREADS.set(self.executor_threads)
+        self.schedule_idle_check()
+        self.schedule_rematch()
+        self.report_startup()
 
         while self.running:
             try:
                 conn, addr = self.server_socket.accept()
-                self.threads[conn.fileno()] = self.executor.submit(self.handle_client, conn, addr)
+                # Behind a PROXY protocol frontend the peer is the frontend, the client's own
+                # address is only known once the header is read
+                rejected = self.admission.admit(None if self.proxy_protocol else peer_ip(addr))
+                if rejected:
+                    self.reject(conn, addr, *rejected)
+                    continue
+                if conn.family != socket.AF_UNIX:
+                    enable_keepalive(conn)
+                EXECUTOR_QUEUED.inc()
+                self.executor.submit(self.serve_client, conn, addr)
             except Exception as e:
                 if self.running:
-                    print(f"Error accepting connection: {e}")
+                    log.error("Error accepting connection: %s", e)
+
+    def reject(self, conn, addr, reason, retry_after):
+        # Turned away before a worker thread is involved: a short-lived thread tells the client
+        # when to come back, or the connection is just closed if enough of those are running
+        log.debug("Rejecting %s: %s limit reached", addr, reason)
+        if self.admission.begin_reject():
+            threading.Thread(target=self.send_busy, args=(conn, retry_after), daemon=True).start()
+        else:
+            conn.close()
+
+    def send_busy(self, conn, retry_after):
+        try:
+            if self.proxy_protocol:
+                conn.settimeout(REJECT_TIMEOUT)
+                read_header(conn)
+            self.reply_busy(conn, retry_after)
+        except (OSError, ProxyProtocolError):
+            conn.close()
+        finally:
+            self.admission.end_reject()
+
+    def reply_busy(self, conn, retry_after):
+        # With TLS, frames only reach the client inside it, so the reply costs a handshake
+        try:
+            conn.settimeout(REJECT_TIMEOUT)
+            if self.ssl_context:
+                conn = self.ssl_context.wrap_socket(conn, server_side=True)
+            FramedSocket(conn, REJECT_TIMEOUT).send_frames([(ERROR, busy_message(retry_after)), (CLOSE, "")])
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def report_startup(self):
+        startup = time.monotonic() - PROCESS_STARTED
+        STARTUP_SECONDS.set(startup)
+        log.info("Accepting connections %.3f s after start, %.1f MB resident", startup, resident_memory() / 2 ** 20)
+
+    def serve_client(self, conn, addr):
+        EXECUTOR_QUEUED.dec()
+        EXECUTOR_BUSY.inc()
+        try:
+            self.handle_client(conn, addr)
+        finally:
+            EXECUTOR_BUSY.dec()
 
     def signal_handler(self, sig, frame):
         self.shutdown()
         sys.exit(0)
         
-    def close_connection(self, conn, username=None):
+    def schedule_rematch(self):
+        # Players who found nobody close to their rating get paired as their windows widen
+        self.call_later(REMATCH_INTERVAL, self.rematch)
+
+    def rematch(self):
+        if self.running:
+            self.waiting_queue.rematch()
+            self.schedule_rematch()
+
+    def schedule_idle_check(self):
+        if self.idle_timeout:
+            self.call_later(min(5, self.idle_timeout / 2), self.close_idle_sessions)
+
+    def close_idle_sessions(self):
+        if not self.running:
+            return
+        for session in self.sessions.idle(self.idle_timeout):
+            log.info("Closing session %d (%s): no reply for %d seconds", session.id, session.username or session.addr, self.idle_timeout)
+            IDLE_EVICTIONS.inc()
+            if session.dropped_at is not None:
+                # Held for a resume, there is no client to tell
+                self.close_connection(session.conn)
+            else:
+                self.close_idle_session(session)
+        self.schedule_idle_check()
+
+    def close_idle_session(self, session):
+        # Closing the socket wakes up the session's thread blocked in receive_message
+        conn = session.conn
+        self.post(conn, encode_frame(CLOSE, "Disconnected for inactivity.\n"), then=lambda: self.close_connection(conn))
+
+    def close_connection(self, conn):
+        session = self.sessions.remove(conn)
+        username = session.username if session else None
+        if session:
+            self.admission.release(username is not None, self.resumer.close(session))
+        self.spectators.leave(conn)
         try:
-            if not conn._closed:
-                print(f"Closing connection for {username if username else 'unknown user'}")
+            if not conn._closed or conn.detached:
+                log.debug("Closing connection for %s", username or "unknown user")
                 conn.close()
-                if username:
-                    del self.clients[username]
-                    if username in self.waiting_queue:
-                        self.waiting_queue.remove(username)
+            # A new login under the same name may already be using its queue entry and tournaments
+            if username and self.sessions.get(username) is None:
+                self.waiting_queue.cancel(username)
+                self.cancel_tournaments(username)
         except Exception as e:
-            print(f"Error closing connection: {e}")
+            log.warning("Error closing connection: %s", e)
 
 
 if __name__ == "__main__":
-    server = RPSGameServer()
-    server.run()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rock-Paper-Scissors game server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="threaded: one worker thread per connection, async: asyncio event loop")
+    parser.add_argument("--listener", choices=LISTENERS, default="tls",
+                        help="tls: TCP with TLS, tcp/unix: plaintext TCP or Unix socket behind a frontend that terminates TLS")
+    parser.add_argument("--unix-path", default=UNIX_PATH, help="socket file for --listener unix")
+    parser.add_argument("--proxy-protocol", action="store_true",
+                        help="expect a PROXY protocol v1/v2 header on every connection and take the client address from it")
+    parser.add_argument("--move-timeout", type=float, default=MOVE_TIMEOUT,
+                        help="seconds a player has to move before forfeiting")
+    parser.add_argument("--storage", choices=sorted(STORAGE_BACKENDS), default="sqlite",
+                        help="sqlite: SQLite database in WAL mode, log: append-only log with compaction")
+    parser.add_argument("--data-path", help="database or log file (defaults to rps.db / rps.log)")
+    parser.add_argument("--history-path", default="matches.bin", help="binary match history log")
+    parser.add_argument("--variant", choices=sorted(VARIANTS), default="rps",
+                        help="rps: rock, paper, scissors; rpsls: adds lizard and spock; rps7: seven moves")
+    parser.add_argument("--kdf-iterations", type=int, default=KDF_ITERATIONS,
+                        help="PBKDF2 iterations for new password hashes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server processes sharing the port through SO_REUSEPORT (0: one per CPU core)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a client may leave a prompt unanswered before it is disconnected (0: never)")
+    parser.add_argument("--resume-grace", type=float,
+                        help=f"seconds the session of a player whose connection dropped is held for them to resume "
+                             f"(default {RESUME_GRACE}, off with --workers; 0 to turn resumes off)")
+    parser.add_argument("--slow-client", choices=SLOW_CLIENT_POLICIES, default=SLOW_CLIENT_POLICIES[0],
+                        help="when a client stops reading and its queued messages pile up: disconnect it or drop the messages")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="length of the listen queue")
+    parser.add_argument("--max-sessions", type=int,
+                        help="open connections per server process, past that new ones are told to retry later "
+                             "(defaults to the worker thread count, 10000 with --mode async; 0: no limit)")
+    parser.add_argument("--max-logins", type=int, default=MAX_LOGINS,
+                        help="connections per server process that have not logged in yet (0: no limit)")
+    parser.add_argument("--ip-rate", type=float, default=0,
+                        help="new connections a second allowed from one address (0: no limit)")
+    parser.add_argument("--ip-burst", type=int, help="connections one address may open at once under --ip-rate")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-socket", help="serve Prometheus metrics over HTTP on this Unix socket")
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count()
+    if workers > 1 and args.mode != "threaded":
+        parser.error("--workers only supports --mode threaded")
+    if workers > 1 and args.listener == "unix":
+        parser.error("--workers needs a TCP listener")
+    if args.resume_grace is None:
+        args.resume_grace = RESUME_GRACE if workers == 1 else 0
+    elif args.resume_grace and workers > 1:
+        # Every worker signs its own tokens and holds its own sessions, while the kernel
+        # hands the reconnect to any of them
+        parser.error("--resume-grace needs a single server process, resumes are off with --workers")
+    if args.mode == "async" and args.listener == "tls" and args.proxy_protocol:
+        # asyncio may read the start of the TLS handshake along with the header, and
+        # start_tls would not see those bytes
+        parser.error("--mode async only supports --proxy-protocol with --listener tcp or unix")
+
+    setup_logging(args.log_level)
+    storage = open_storage(args.storage, args.data_path)
+    history = open_history(args.history_path)
+    options = dict(move_timeout=args.move_timeout, kdf_iterations=args.kdf_iterations, idle_timeout=args.idle_timeout,
+                   slow_client_policy=args.slow_client, backlog=args.backlog, max_sessions=args.max_sessions,
+                   max_logins=args.max_logins, ip_rate=args.ip_rate, ip_burst=args.ip_burst, variant=args.variant,
+                   listener=args.listener, unix_path=args.unix_path, proxy_protocol=args.proxy_protocol,
+                   resume_grace=args.resume_grace)
+    if workers > 1:
+        from sharding import run_sharded
+        run_sharded(args.host, args.port, workers, storage, history, args.log_level, args.metrics_port, args.metrics_socket, **options)
+    else:
+        if args.metrics_port is not None or args.metrics_socket:
+            serve_metrics(args.metrics_port, args.metrics_socket)
+        if args.mode == "async":
+            from async_server import AsyncRPSGameServer
+            server = AsyncRPSGameServer(args.host, args.port, storage=storage, history=history, **options)
+        else:
+            server = RPSGameServer(args.host, args.port, storage=storage, history=history, **options)
+        server.run()
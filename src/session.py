@@ -0,0 +1,138 @@
+import itertools
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+IDLE_TIMEOUT = 300  # seconds a client may leave a prompt unanswered
+# TCP keepalive: probe a silent peer after KEEPALIVE_IDLE seconds, every KEEPALIVE_INTERVAL
+# seconds, and drop the connection after KEEPALIVE_COUNT unanswered probes
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+# Session states: connected but not logged in, at the command menu, gone
+LOGIN = "login"
+MENU = "menu"
+CLOSED = "closed"
+
+
+def enable_keepalive(sock):
+    # The kernel sends the heartbeats, so a peer that vanished (crash, cable pulled, NAT
+    # timeout) is noticed even while its session is parked waiting for a match
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, option):  # Linux, recent macOS and Windows
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class Session:
+    __slots__ = ("id", "conn", "addr", "username", "state", "connected_at", "idle_since", "prompt", "token", "dropped_at", "resumed")
+
+    def __init__(self, session_id, conn, addr):
+        self.id = session_id
+        self.conn = conn
+        self.addr = addr
+        self.username = None
+        self.state = LOGIN
+        self.connected_at = time.monotonic()
+        # Set while the server waits for this client to answer a prompt
+        self.idle_since = None
+        # Last prompt sent, sent again to a client that resumes the session
+        self.prompt = None
+        # Resume token the client was last given (see resume.py), and while the connection
+        # is down, when that was noticed and the event a resume sets
+        self.token = None
+        self.dropped_at = None
+        self.resumed = None
+
+
+class SessionRegistry:
+    # Every open connection of this server, found in O(1) by session id, by connection or,
+    # once logged in, by username. Sessions waiting on their client are also kept in the
+    # order they started waiting, so finding the idle ones only looks at the expired few.
+    def __init__(self):
+        self.by_id = {}
+        self.by_conn = {}
+        self.by_username = {}
+        self.awaiting = OrderedDict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def open(self, conn, addr):
+        session = Session(next(self.ids), conn, addr)
+        with self.lock:
+            self.by_id[session.id] = session
+            self.by_conn[conn] = session
+        return session
+
+    def bind(self, session, username):
+        # Logs session in as username. Returns the other session already logged in under
+        # that name instead, if there is one.
+        with self.lock:
+            other = self.by_username.get(username)
+            if other is not None and other is not session:
+                return other
+            session.username = username
+            self.by_username[username] = session
+        return None
+
+    def remove(self, conn):
+        # Returns the session that was registered for conn, None if it was already removed
+        with self.lock:
+            session = self.by_conn.pop(conn, None)
+            if session is None:
+                return None
+            session.state = CLOSED
+            del self.by_id[session.id]
+            self.awaiting.pop(session.id, None)
+            if session.username and self.by_username.get(session.username) is session:
+                del self.by_username[session.username]
+        return session
+
+    def get(self, username):
+        return self.by_username.get(username)
+
+    def find(self, session_id):
+        return self.by_id.get(session_id)
+
+    def for_conn(self, conn):
+        return self.by_conn.get(conn)
+
+    def expect_reply(self, conn):
+        session = self.by_conn.get(conn)
+        if session is not None:
+            with self.lock:
+                session.idle_since = time.monotonic()
+                self.awaiting[session.id] = session
+                self.awaiting.move_to_end(session.id)
+
+    def got_reply(self, conn):
+        session = self.by_conn.get(conn)
+        if session is not None:
+            with self.lock:
+                session.idle_since = None
+                self.awaiting.pop(session.id, None)
+
+    def idle(self, timeout):
+        # Sessions that have left a prompt unanswered for more than timeout seconds
+        cutoff = time.monotonic() - timeout
+        expired = []
+        with self.lock:
+            for session in self.awaiting.values():
+                if session.idle_since > cutoff:
+                    break
+                expired.append(session)
+        return expired
+
+    def logged_in(self):
+        return list(self.by_username.values())
+
+    def all(self):
+        return list(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_username)
+
+    def __contains__(self, username):
+        return username in self.by_username
@@ -0,0 +1,664 @@
+import itertools
+import logging
+import multiprocessing
+import random
+import signal
+import threading
+import time
+from collections import deque
+from multiprocessing.managers import BaseManager, DictProxy
+
+from leaderboard import Leaderboard
+from matchmaking import MatchScheduler, MOVE_TIMEOUT, REMATCH_INTERVAL
+from metrics import serve_metrics, setup_logging
+from players import PlayerStore
+from protocol import RESULT, ERROR
+from rating import DEFAULT_RATING, rate
+from rules import VARIANTS
+from server import RPSGameServer, WAITING_QUEUE_DEPTH
+from steps import Send, Call
+from tournament import TournamentRunner, thread_timer, format_lobby, format_bracket, format_update, format_result, resolve_match
+
+FEED_LENGTH = 10000  # tournament events kept for workers that fall behind
+FEED_POLL = 1.0  # seconds a worker's read of the tournament feed waits for an event
+
+log = logging.getLogger("rps.sharding")
+
+
+class SharedState:
+    # Accounts, rankings, ratings and quick play matchmaking for every worker of a sharded server.
+    # It lives in the coordinator process and workers reach it through CoordinatorManager
+    # proxies. Each worker thread gets its own connection, served by its own thread here,
+    # so a blocking call (waiting for an opponent or a move) only holds up that session.
+    def __init__(self, storage, history, move_timeout=MOVE_TIMEOUT, variant="rps"):
+        self.storage = storage
+        self.history = history
+        self.players = PlayerStore(storage)
+        self.rankings = storage.load_rankings()
+        self.ratings = storage.load_ratings()
+        self.leaderboard = Leaderboard(self.rankings)
+        self.move_timeout = move_timeout
+        self.waiting_queue = MatchScheduler(move_timeout)
+        # Tickets and matches cannot leave this process, workers refer to them by key
+        self.tickets = {}
+        self.matches = {}
+        # Not id(match): a timer forgetting a finished match must not drop a newer one that
+        # was given the same id
+        self.match_keys = itertools.count(1)
+        self.lock = threading.Lock()
+        self.tournaments = SharedTournaments(self, VARIANTS[variant])
+
+    def add_points(self, username, points):
+        with self.lock:
+            score = self.rankings.get(username, 0) + points
+            self.rankings[username] = score
+            self.leaderboard.update(username, score)
+            self.storage.save_ranking(username, score)
+        return score
+
+    def update_ratings(self, player1, player2, score1):
+        with self.lock:
+            rating1, rating2 = rate(self.ratings.get(player1, DEFAULT_RATING), self.ratings.get(player2, DEFAULT_RATING), score1)
+            self.ratings[player1] = rating1
+            self.ratings[player2] = rating2
+            self.storage.save_rating(player1, rating1)
+            self.storage.save_rating(player2, rating2)
+
+    def rematch(self):
+        # Periodic pass over the queue, workers leave it to the coordinator
+        self.waiting_queue.rematch()
+        thread_timer(REMATCH_INTERVAL, self.rematch)
+
+    def track(self, match):
+        if match is None:
+            return None
+        with self.lock:
+            if match.key is None:
+                match.key = next(self.match_keys)
+            self.matches[match.key] = match
+        return match.key
+
+    def enqueue(self, username):
+        # Id of the player's match, or None if they have to wait_for_match
+        ticket = self.waiting_queue.enqueue(username, self.ratings.get(username, DEFAULT_RATING))
+        if ticket.match is None:
+            with self.lock:
+                self.tickets[username] = ticket
+        return self.track(ticket.match)
+
+    def wait_for_match(self, username):
+        # None if the wait was cancelled
+        with self.lock:
+            ticket = self.tickets.pop(username, None)
+        if ticket is None:
+            return None
+        ticket.event.wait()
+        return self.track(ticket.match)
+
+    def match_info(self, match_id):
+        match = self.matches[match_id]
+        return match.players, match.deadline
+
+    def match_moves(self, match_id):
+        return dict(self.matches[match_id].moves)
+
+    def submit_move(self, match_id, username, move):
+        return self.matches[match_id].submit(username, move)
+
+    def expire_match(self, match_id):
+        return self.matches[match_id].expire()
+
+    def complete_match(self, match_id, result):
+        match = self.matches[match_id]
+        match.result = result
+        match.done.set()
+        # Both players pick up the result right away, keep it around a while for a slow one
+        thread_timer(self.move_timeout, lambda: self.matches.pop(match_id, None))
+
+    def wait_match(self, match_id, timeout=None):
+        return self.matches[match_id].done.wait(timeout)
+
+    def match_result(self, match_id):
+        return self.matches[match_id].result
+
+
+class SharedTournaments:
+    # Tournaments of a sharded server, hosted by the coordinator so that players on every
+    # worker see the same lobbies and play in the same brackets. Workers refer to a tournament
+    # by key and to its matches by the ids of SharedState.track. What a worker has to pass
+    # on to its own sessions (spectator updates, the result for players knocked out earlier)
+    # goes into a feed of numbered events that every worker reads with events(), and each
+    # worker keeps spectator channels of its own for the tournaments the feed opened.
+    def __init__(self, state, rules):
+        self.state = state
+        self.rules = rules
+        self.tournaments = {}
+        self.keys = itertools.count(1)
+        # (key, username) -> ticket of a player waiting for their next match
+        self.tickets = {}
+        self.feed = deque(maxlen=FEED_LENGTH)
+        self.sequence = 0
+        self.changed = threading.Condition()
+        self.lock = threading.Lock()
+
+    def create(self, name, creator):
+        # False if a tournament with that name is already open or running
+        with self.lock:
+            if any(t["name"] == name and t["result"] is None for t in self.tournaments.values()):
+                return False
+            key = next(self.keys)
+            self.tournaments[key] = {
+                "key": key,
+                "name": name,
+                "creator": creator,
+                "players": [creator],
+                "in_progress": False,
+                "started": threading.Event(),
+                "runner": None,
+                "result": None,
+            }
+        self.push(("open", key, name, format_lobby(name, [creator])))
+        return True
+
+    def listing(self):
+        # (key, name, creator, players, in progress) of every tournament not over yet
+        with self.lock:
+            return [(t["key"], t["name"], t["creator"], list(t["players"]), t["in_progress"])
+                    for t in self.tournaments.values() if t["result"] is None]
+
+    def join(self, key, username):
+        # None once username is in the lobby, otherwise what keeps them out
+        with self.lock:
+            tournament = self.tournaments.get(key)
+            if tournament is None:
+                return "This tournament was cancelled.\n"
+            if username in tournament["players"]:
+                return "You are already in this tournament.\n"
+            if tournament["in_progress"]:
+                return "This tournament has already started.\n"
+            tournament["players"].append(username)
+            players = list(tournament["players"])
+        self.publish(key, f"{username} joined '{tournament['name']}'.\n", format_lobby(tournament["name"], players))
+        return None
+
+    def wait_started(self, key, timeout=None):
+        with self.lock:
+            tournament = self.tournaments.get(key)
+        return tournament is None or tournament["started"].wait(timeout)
+
+    def launch(self, key):
+        with self.lock:
+            tournament = self.tournaments.get(key)
+            if tournament is None or tournament["in_progress"]:
+                return
+            tournament["in_progress"] = True
+            # Players who left the lobby were dropped by cancel(), the rest are seeded by
+            # ranking (ties in random order)
+            players = list(tournament["players"])
+        random.shuffle(players)
+        players.sort(key=lambda p: self.state.rankings.get(p, 0), reverse=True)
+        tournament["players"] = players
+        tournament_id = self.state.history.new_tournament(tournament["name"])
+        tournament["runner"] = TournamentRunner(
+            players,
+            lambda match: resolve_match(self.rules, self.state.history, match, tournament_id),
+            lambda champion: self.finish(tournament, champion),
+            self.state.move_timeout,
+            on_update=lambda match: self.update(tournament, match),
+        )
+        tournament["started"].set()
+        tournament["runner"].start()
+
+    def cancel(self, username):
+        # username left: the tournaments they created and never started die with them, the
+        # other lobbies drop them
+        cancelled, left = [], []
+        with self.lock:
+            for key, tournament in list(self.tournaments.items()):
+                if tournament["in_progress"]:
+                    continue
+                if tournament["creator"] == username:
+                    del self.tournaments[key]
+                    cancelled.append(tournament)
+                elif username in tournament["players"]:
+                    tournament["players"].remove(username)
+                    left.append((tournament, list(tournament["players"])))
+        for tournament in cancelled:
+            tournament["started"].set()
+            self.push(("close", tournament["key"], f"Tournament '{tournament['name']}' was cancelled.\n", ERROR))
+        for tournament, players in left:
+            self.publish(tournament["key"], f"{username} left '{tournament['name']}'.\n", format_lobby(tournament["name"], players))
+
+    def runner(self, key):
+        with self.lock:
+            tournament = self.tournaments.get(key)
+        return tournament and tournament["runner"]
+
+    def running(self, key):
+        # False if the tournament was cancelled before it started
+        return self.runner(key) is not None
+
+    def ticket(self, key, username):
+        # (match id, True) once the player's next match is known, None for no more matches.
+        # (None, False) if they have to wait_ticket.
+        runner = self.runner(key)
+        if runner is None:
+            return None, True
+        ticket = runner.ticket(username)
+        if not ticket.event.is_set():
+            with self.lock:
+                self.tickets[key, username] = ticket
+            return None, False
+        return self.track(ticket.match), True
+
+    def wait_ticket(self, key, username):
+        with self.lock:
+            ticket = self.tickets.pop((key, username))
+        ticket.event.wait()
+        return self.track(ticket.match)
+
+    def track(self, match):
+        match_id = self.state.track(match)
+        if match is not None and match.done.is_set():
+            # Decided before the player picked it up, update() already let it go
+            self.forget_later(match_id)
+        return match_id
+
+    def forget_later(self, match_id):
+        # Both players pick up the result right away, keep it around a while for a slow one
+        thread_timer(self.state.move_timeout, lambda: self.state.matches.pop(match_id, None))
+
+    def finish_match(self, key, match_id):
+        self.runner(key).finish_match(self.state.matches[match_id])
+
+    def finished(self, key):
+        runner = self.runner(key)
+        return runner is None or runner.finished
+
+    def still_playing(self, key):
+        runner = self.runner(key)
+        return set() if runner is None else runner.still_playing()
+
+    def result(self, key):
+        with self.lock:
+            tournament = self.tournaments.get(key)
+        return tournament and tournament["result"]
+
+    def update(self, tournament, match):
+        # Called by the runner with the match that just finished, or None when a round starts
+        if match is not None and match.key is not None:
+            self.forget_later(match.key)
+        bracket = tournament["runner"].bracket
+        self.publish(tournament["key"], format_update(tournament["name"], bracket, match), format_bracket(tournament["name"], bracket))
+
+    def finish(self, tournament, champion):
+        if champion is not None:
+            self.state.add_points(champion, 5)  # More points for tournament win
+        message = tournament["result"] = format_result(tournament["name"], champion)
+        still_playing = tournament["runner"].still_playing()
+        self.push(("result", [player for player in tournament["players"] if player not in still_playing], message))
+        self.push(("close", tournament["key"], message, RESULT))
+        # Kept a while for the finalists, who read the result from their own session
+        thread_timer(self.state.move_timeout, lambda: self.forget(tournament["key"]))
+
+    def forget(self, key):
+        with self.lock:
+            self.tournaments.pop(key, None)
+
+    def publish(self, key, update, state):
+        self.push(("update", key, update, state))
+
+    def push(self, event):
+        with self.changed:
+            self.sequence += 1
+            self.feed.append((self.sequence, event))
+            self.changed.notify_all()
+
+    def position(self):
+        # Sequence number of the last event, a new reader starts after it
+        with self.changed:
+            return self.sequence
+
+    def events(self, after, timeout=FEED_POLL):
+        # (sequence number, event) of the events after `after`, waiting up to timeout
+        # seconds for the first one
+        with self.changed:
+            self.changed.wait_for(lambda: self.sequence > after, timeout)
+            return [(number, event) for number, event in self.feed if number > after]
+
+
+class CoordinatorManager(BaseManager):
+    pass
+
+
+SHARED_OBJECTS = {
+    # typeid: (attribute of SharedState, proxy type, exposed methods)
+    "state": (None, None, None),
+    "players": ("players", None, ("get", "__setitem__", "__contains__")),
+    "rankings": ("rankings", DictProxy, None),
+    "ratings": ("ratings", DictProxy, None),
+    "leaderboard": ("leaderboard", None, ("update", "rank", "range", "top", "page", "page_count", "around", "__len__", "__contains__")),
+    "waiting_queue": ("waiting_queue", None, ("cancel", "__len__", "__contains__")),
+    "storage": ("storage", None, ("save_player", "save_ranking")),
+    "history": ("history", None, ("record", "new_tournament", "stats")),
+    "tournaments": ("tournaments", None, ("create", "listing", "join", "wait_started", "launch", "cancel", "running", "ticket",
+                                          "wait_ticket", "finish_match", "finished", "still_playing", "result", "position",
+                                          "events")),
+}
+
+for typeid, (attribute, proxytype, exposed) in SHARED_OBJECTS.items():
+    CoordinatorManager.register(typeid, proxytype=proxytype, exposed=exposed)
+
+
+def start_coordinator(state):
+    # Serves `state` from background threads of this process, returns the address workers connect to
+    for typeid, (attribute, proxytype, exposed) in SHARED_OBJECTS.items():
+        shared = getattr(state, attribute) if attribute else state
+        CoordinatorManager.register(typeid, callable=lambda shared=shared: shared, proxytype=proxytype, exposed=exposed)
+    server = CoordinatorManager().get_server()
+    threading.Thread(target=server.serve_forever, name="coordinator", daemon=True).start()
+    return server.address
+
+
+class RemoteMatch:
+    # Stand-in for a Match held by the coordinator with the same interface, so play_match
+    # and finish_match run unchanged on a worker
+    def __init__(self, state, match_id):
+        self.state = state
+        self.id = match_id
+        self.players, self.deadline = state.match_info(match_id)
+        self.done = RemoteMatchDone(self)
+        self._result = None
+
+    def opponent(self, player):
+        return self.players[1] if player == self.players[0] else self.players[0]
+
+    def remaining(self):
+        # CLOCK_MONOTONIC is system wide, so the coordinator's deadline holds here as well
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def moves(self):
+        return self.state.match_moves(self.id)
+
+    @property
+    def result(self):
+        if self._result is None:
+            self._result = self.state.match_result(self.id)
+        return self._result
+
+    @result.setter
+    def result(self, result):
+        self._result = result
+
+    def submit(self, player, move):
+        return self.state.submit_move(self.id, player, move)
+
+    def expire(self):
+        return self.state.expire_match(self.id)
+
+
+class RemoteMatchDone:
+    def __init__(self, match):
+        self.match = match
+
+    def set(self):
+        self.match.state.complete_match(self.match.id, self.match.result)
+
+    def wait(self, timeout=None):
+        return self.match.state.wait_match(self.match.id, timeout)
+
+
+class RemoteTournament:
+    # Stand-in for a tournament hosted by the coordinator. The session handlers read it with
+    # the keys of a tournament dict: the lobby as it was listed, then the start event, runner,
+    # result and spectator channel from the coordinator.
+    def __init__(self, worker, key, name, creator, players, in_progress):
+        self.worker = worker
+        self.key = key
+        self.name = name
+        self.creator = creator
+        self.players = players
+        self.in_progress = in_progress
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def started(self):
+        return RemoteTournamentStart(self.worker.tournaments, self.key)
+
+    @property
+    def runner(self):
+        if not self.worker.tournaments.running(self.key):
+            return None
+        return RemoteTournamentRunner(self.worker.tournaments, self.worker.shared, self.key)
+
+    @property
+    def result(self):
+        return self.worker.tournaments.result(self.key)
+
+    @property
+    def channel(self):
+        return self.worker.tournament_channel(self.key, self.name)
+
+
+class RemoteTournamentStart:
+    def __init__(self, tournaments, key):
+        self.tournaments = tournaments
+        self.key = key
+
+    def wait(self, timeout=None):
+        return self.tournaments.wait_started(self.key, timeout)
+
+
+class RemoteTournamentRunner:
+    # Stand-in for the coordinator's TournamentRunner, with what play_tournament uses
+    def __init__(self, tournaments, state, key):
+        self.tournaments = tournaments
+        self.state = state
+        self.key = key
+
+    @property
+    def finished(self):
+        return self.tournaments.finished(self.key)
+
+    def ticket(self, username):
+        return RemoteTicket(self, username)
+
+    def finish_match(self, match):
+        self.tournaments.finish_match(self.key, match.id)
+
+    def still_playing(self):
+        return self.tournaments.still_playing(self.key)
+
+
+class RemoteTicket:
+    # Stand-in for a tournament Ticket, and for its event: waiting on it asks the coordinator
+    # for the player's next match
+    def __init__(self, runner, username):
+        self.runner = runner
+        self.username = username
+        self.event = self
+        match_id, self.ready = runner.tournaments.ticket(runner.key, username)
+        self.match = self.remote_match(match_id)
+
+    def remote_match(self, match_id):
+        return None if match_id is None else RemoteMatch(self.runner.state, match_id)
+
+    def is_set(self):
+        return self.ready
+
+    def wait(self, timeout=None):
+        if not self.ready:
+            self.match = self.remote_match(self.runner.tournaments.wait_ticket(self.runner.key, self.username))
+            self.ready = True
+        return True
+
+
+class ShardWorker(RPSGameServer):
+    # Threaded server process that shares the listening port with the other workers and
+    # keeps accounts, rankings, the quick play queue and tournaments in the coordinator.
+    # Connections, TLS and spectators stay local to the worker.
+    reuse_port = True
+
+    def __init__(self, manager, host='127.0.0.1', port=12345, **kwargs):
+        self.manager = manager
+        super().__init__(host, port, storage=manager.storage(), history=manager.history(), **kwargs)
+
+    def setup_state(self):
+        self.shared = self.manager.state()
+        self.players = self.manager.players()
+        self.rankings = self.manager.rankings()
+        self.ratings = self.manager.ratings()
+        self.leaderboard = self.manager.leaderboard()
+        self.waiting_queue = self.manager.waiting_queue()
+        self.tournaments = self.manager.tournaments()
+        # Tournament key -> this worker's spectator channel
+        self.channels = {}
+        self.feed_position = self.tournaments.position()
+
+    def update_rankings(self, winner, points=1):
+        self.shared.add_points(winner, points)
+
+    def update_ratings(self, player1, player2, score1):
+        self.shared.update_ratings(player1, player2, score1)
+
+    def schedule_rematch(self):
+        pass
+
+    def lookup_player(self, username):
+        # The accounts cache is the coordinator's
+        return (yield Call(self.players.get, (username,)))
+
+    def match_player(self, conn, username):
+        match_id = self.shared.enqueue(username)
+        if match_id is None:
+            yield Send(conn, "Waiting for an opponent...\n")
+            match_id = yield Call(self.shared.wait_for_match, (username,))
+            if match_id is None:
+                return
+        yield from self.play_match(conn, username, RemoteMatch(self.shared, match_id))
+
+    def add_tournament(self, name, creator):
+        return self.tournaments.create(name, creator)
+
+    def lobbies(self):
+        return [tournament for tournament in self.listed_tournaments() if not tournament.in_progress]
+
+    def listed_tournaments(self):
+        return [RemoteTournament(self, *entry) for entry in self.tournaments.listing()]
+
+    def enter_tournament(self, tournament, username):
+        return self.tournaments.join(tournament.key, username)
+
+    def launch_tournament(self, tournament):
+        self.tournaments.launch(tournament.key)
+
+    def cancel_tournaments(self, creator):
+        self.tournaments.cancel(creator)
+
+    def watching_choice(self):
+        tournaments = self.listed_tournaments()
+        return tournaments, self.format_watching(tournaments)
+
+    def tournament_channel(self, key, name):
+        with self.lock:
+            channel = self.channels.get(key)
+        if channel is None:
+            # Over already: subscribing to a closed channel says so
+            channel = self.spectators.channel(name, "")
+            channel.close("")
+        return channel
+
+    def relay_tournaments(self):
+        # Passes what the coordinator's tournaments publish on to this worker's sessions
+        while self.running:
+            try:
+                events = self.tournaments.events(self.feed_position)
+            except (OSError, EOFError):
+                return
+            for self.feed_position, event in events:
+                self.relay(*event)
+
+    def relay(self, kind, *event):
+        if kind == "open":
+            key, name, state = event
+            with self.lock:
+                self.channels[key] = self.spectators.channel(name, state)
+        elif kind == "update":
+            key, update, state = event
+            channel = self.channels.get(key)
+            if channel is not None:
+                channel.publish(update, state)
+        elif kind == "close":
+            key, message, msg_type = event
+            with self.lock:
+                channel = self.channels.pop(key, None)
+            if channel is not None:
+                channel.close(message, msg_type)
+        elif kind == "result":
+            # Only the players connected to this worker are found here
+            usernames, message = event
+            self.broadcast(usernames, message, RESULT)
+
+    def run(self):
+        threading.Thread(target=self.relay_tournaments, name="tournament-feed", daemon=True).start()
+        super().run()
+
+    def close_storage(self):
+        # The coordinator owns the storage and history and closes them once every worker is gone
+        pass
+
+
+def run_worker(address, host, port, number, log_level, metrics_port, metrics_socket, options):
+    setup_logging(log_level)
+    # Every worker has its own endpoint: the coordinator's port or socket plus the worker number
+    if metrics_port is not None:
+        serve_metrics(metrics_port + number)
+    elif metrics_socket:
+        serve_metrics(path=f"{metrics_socket}.{number}")
+    manager = CoordinatorManager(address)
+    manager.connect()
+    server = ShardWorker(manager, host, port, **options)
+    # The coordinator stops its workers with SIGTERM
+    signal.signal(signal.SIGTERM, server.signal_handler)
+    server.run()
+
+
+def run_sharded(host, port, workers, storage, history, log_level="INFO", metrics_port=None, metrics_socket=None, **options):
+    state = SharedState(storage, history, options.get("move_timeout", MOVE_TIMEOUT), options.get("variant", "rps"))
+    address = start_coordinator(state)
+    thread_timer(REMATCH_INTERVAL, state.rematch)
+    if metrics_port is not None or metrics_socket:
+        # Storage and queue metrics live here, sessions are reported by the workers
+        WAITING_QUEUE_DEPTH.set_function(lambda: len(state.waiting_queue))
+        serve_metrics(metrics_port, metrics_socket)
+    # spawn: the coordinator already runs threads, forking it could deadlock the children
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, name=f"rps-worker-{number}",
+                        args=(address, host, port, number, log_level, metrics_port, metrics_socket, options))
+        for number in range(1, workers + 1)
+    ]
+    for process in processes:
+        process.start()
+    log.info("Coordinator running %d workers on %s:%s", workers, host, port)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig, frame: stopping.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.set())
+    while not stopping.is_set() and any(process.is_alive() for process in processes):
+        stopping.wait(1)
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + 10
+    for process in processes:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+    storage.close()
+    history.close()
+    log.info("Coordinator stopped")
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from metrics import REGISTRY
+from protocol import encode_frame, INFO
+
+SPECTATORS = REGISTRY.gauge("rps_spectators", "Sessions watching a tournament")
+FANOUT_FRAMES = REGISTRY.counter("rps_spectator_buffers_total", "Encoded updates handed to spectators")
+PUBLISH_SECONDS = REGISTRY.histogram("rps_spectator_publish_seconds", "Time to hand one tournament update to every spectator")
+
+
+class Channel:
+    # The spectators of one tournament. An update is encoded once and the same buffer is
+    # posted to every subscriber. Updates go under the channel's key, so a spectator that
+    # falls behind keeps only the latest one in its outbox; each update carries the whole
+    # bracket, so nothing is lost by skipping the older ones. A late joiner starts from
+    # `snapshot`, the encoded current state.
+    def __init__(self, hub, name, state):
+        self.hub = hub
+        self.name = name
+        self.key = ("tournament", id(self))
+        self.snapshot = encode_frame(INFO, state)
+        # conn -> event set when the subscription ends
+        self.subscribers = {}
+        self.closed = False
+        # Reentrant: a post that finds the outbox full may close the connection, which
+        # unsubscribes it
+        self.lock = threading.RLock()
+
+    def subscribe(self, conn):
+        # Event the spectator's session waits on, None if the tournament is already over
+        with self.lock:
+            if self.closed:
+                return None
+            event = self.hub.event_factory()
+            self.subscribers[conn] = event
+            self.hub.joined(conn, self)
+            self.hub.post(conn, self.snapshot, self.key)
+        return event
+
+    def unsubscribe(self, conn):
+        with self.lock:
+            event = self.subscribers.pop(conn, None)
+        if event is not None:
+            self.hub.left(conn)
+            event.set()
+
+    def publish(self, update, state):
+        # update says what happened, state is the tournament as it now stands
+        started = time.perf_counter()
+        snapshot = encode_frame(INFO, state)
+        data = encode_frame(INFO, update) + snapshot
+        with self.lock:
+            if self.closed:
+                return
+            self.snapshot = snapshot
+            subscribers = list(self.subscribers)
+        for conn in subscribers:
+            self.hub.post(conn, data, self.key)
+        FANOUT_FRAMES.inc(len(subscribers))
+        PUBLISH_SECONDS.observe(time.perf_counter() - started)
+
+    def close(self, message, msg_type=INFO):
+        # Last message, then every spectator is released back to their menu
+        data = encode_frame(msg_type, message)
+        with self.lock:
+            self.closed = True
+            subscribers, self.subscribers = self.subscribers, {}
+        for conn, event in subscribers.items():
+            self.hub.post(conn, data)
+            self.hub.left(conn)
+            event.set()
+        FANOUT_FRAMES.inc(len(subscribers))
+
+
+class SpectatorHub:
+    # Per tournament subscriber lists for "Watch Tournament". post(conn, data, key) is the
+    # server's non-blocking send, so publishing never waits on a spectator. The hub also
+    # remembers which channel each connection watches, so a closed connection leaves it.
+    def __init__(self, post, event_factory=threading.Event):
+        self.post = post
+        self.event_factory = event_factory
+        self.watching = {}
+        self.lock = threading.Lock()
+        SPECTATORS.set_function(lambda: len(self.watching))
+
+    def channel(self, name, state):
+        return Channel(self, name, state)
+
+    def joined(self, conn, channel):
+        with self.lock:
+            self.watching[conn] = channel
+
+    def left(self, conn):
+        with self.lock:
+            self.watching.pop(conn, None)
+
+    def leave(self, conn):
+        with self.lock:
+            channel = self.watching.get(conn)
+        if channel is not None:
+            channel.unsubscribe(conn)
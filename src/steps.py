@@ -0,0 +1,22 @@
+from collections import namedtuple
+
+from protocol import INFO
+
+# Session handlers (the welcome dialogue, login, menu commands, matches...) are generators
+# shared by the threaded and the asyncio server. They do no I/O of their own: every step
+# that may block is yielded as one of the requests below, the server running the handler
+# carries it out (on the session's thread, or as an await on the event loop) and sends the
+# outcome back into the generator, or throws the exception in. Handlers call each other
+# with `yield from`.
+
+# Send a frame to the client, returns nothing
+Send = namedtuple("Send", ["conn", "message", "msg_type"], defaults=[INFO])
+# The client's next reply, TimeoutError after timeout seconds
+Receive = namedtuple("Receive", ["conn", "timeout"], defaults=[None])
+# Wait for an event (threading.Event, asyncio.Event or anything with the same wait), False
+# if it was not set within timeout seconds
+Wait = namedtuple("Wait", ["event", "timeout"], defaults=[None])
+# func(*args) for a call that blocks (storage, the history scan), returns its result
+Call = namedtuple("Call", ["func", "args"], defaults=[()])
+# Result of a concurrent.futures.Future (password hashing)
+Result = namedtuple("Result", ["future"])
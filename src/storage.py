@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import REGISTRY
+
+log = logging.getLogger("rps.storage")
+
+FLUSH_SECONDS = REGISTRY.histogram("rps_storage_flush_seconds", "Time to commit one batch of writes")
+FLUSHED_RECORDS = REGISTRY.counter("rps_storage_flushed_records_total", "Player, ranking and rating rows written")
+PENDING_WRITES = REGISTRY.gauge("rps_storage_pending_writes", "Writes queued for the next group commit")
+
+COMMIT_INTERVAL = 0.05  # seconds between group commits
+
+
+class GroupCommitStorage:
+    # Base class for persistence backends. Writes are queued and a background thread
+    # commits everything queued since the last commit in one batch, so a burst of
+    # ranking updates costs one transaction/fsync and only touches the changed rows.
+    # Repeated updates of the same player inside a batch coalesce into one write.
+    def __init__(self, commit_interval=COMMIT_INTERVAL):
+        self.commit_interval = commit_interval
+        self.pending_players = {}
+        self.pending_rankings = {}
+        self.pending_ratings = {}
+        self.requested = 0
+        self.committed = 0
+        self.closed = False
+        self.last_flush_time = 0.0
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self.flush_loop, name="storage-flusher", daemon=True)
+        PENDING_WRITES.set_function(lambda: len(self.pending_players) + len(self.pending_rankings) + len(self.pending_ratings))
+
+    def start(self):
+        self.flusher.start()
+        return self
+
+    def save_player(self, username, password_hash):
+        # Blocks until the account is durable, registrations must survive a crash
+        with self.cond:
+            self.pending_players[username] = password_hash
+            self.requested += 1
+            seq = self.requested
+            self.cond.notify_all()
+            while self.committed < seq and not self.closed:
+                self.cond.wait()
+
+    def save_ranking(self, username, score):
+        with self.cond:
+            self.pending_rankings[username] = score
+            self.requested += 1
+
+    def save_rating(self, username, rating):
+        with self.cond:
+            self.pending_ratings[username] = rating
+            self.requested += 1
+
+    def load_player(self, username):
+        # Password hash of one account, None if there is no such account
+        with self.cond:
+            if username in self.pending_players:
+                return self.pending_players[username]
+        return self.read_player(username)
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(self.commit_interval)
+                if self.closed and not (self.pending_players or self.pending_rankings or self.pending_ratings):
+                    return
+            self.flush()
+
+    def flush(self):
+        with self.cond:
+            players, self.pending_players = self.pending_players, {}
+            rankings, self.pending_rankings = self.pending_rankings, {}
+            ratings, self.pending_ratings = self.pending_ratings, {}
+            target = self.requested
+        if players or rankings or ratings:
+            started = time.perf_counter()
+            try:
+                self.write_batch(players, rankings, ratings)
+            except Exception as e:
+                log.error("Error committing to storage: %s", e)
+                with self.cond:
+                    # Put the batch back unless newer values were queued meanwhile
+                    for username, password_hash in players.items():
+                        self.pending_players.setdefault(username, password_hash)
+                    for username, score in rankings.items():
+                        self.pending_rankings.setdefault(username, score)
+                    for username, rating in ratings.items():
+                        self.pending_ratings.setdefault(username, rating)
+                return
+            self.last_flush_time = time.perf_counter() - started
+            FLUSH_SECONDS.observe(self.last_flush_time)
+            FLUSHED_RECORDS.inc(len(players) + len(rankings) + len(ratings))
+        with self.cond:
+            self.committed = max(self.committed, target)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.flusher.is_alive():
+            self.flusher.join()
+        self.flush()
+        self.close_backend()
+
+    def read_player(self, username):
+        raise NotImplementedError
+
+    def has_players(self):
+        raise NotImplementedError
+
+    def load_rankings(self):
+        raise NotImplementedError
+
+    def load_ratings(self):
+        raise NotImplementedError
+
+    def write_batch(self, players, rankings, ratings=None):
+        raise NotImplementedError
+
+    def close_backend(self):
+        pass
+
+
+class SQLiteStorage(GroupCommitStorage):
+    def __init__(self, path="rps.db", commit_interval=COMMIT_INTERVAL):
+        super().__init__(commit_interval)
+        self.path = path
+        # Only the flusher thread writes, loads happen before it starts
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS players (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rankings (username TEXT PRIMARY KEY, score INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ratings (username TEXT PRIMARY KEY, rating REAL NOT NULL)")
+        self.db.commit()
+        # Account lookups run on session threads while the flusher writes; in WAL mode a
+        # second connection reads the last commit without waiting for the writer
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.read_lock = threading.Lock()
+
+    def read_player(self, username):
+        with self.read_lock:
+            row = self.reader.execute("SELECT password_hash FROM players WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def has_players(self):
+        return self.db.execute("SELECT 1 FROM players LIMIT 1").fetchone() is not None
+
+    def load_rankings(self):
+        return dict(self.db.execute("SELECT username, score FROM rankings"))
+
+    def load_ratings(self):
+        return dict(self.db.execute("SELECT username, rating FROM ratings"))
+
+    def write_batch(self, players, rankings, ratings=None):
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO players (username, password_hash) VALUES (?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET password_hash = excluded.password_hash",
+                players.items(),
+            )
+            self.db.executemany(
+                "INSERT INTO rankings (username, score) VALUES (?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET score = excluded.score",
+                rankings.items(),
+            )
+            self.db.executemany(
+                "INSERT INTO ratings (username, rating) VALUES (?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET rating = excluded.rating",
+                (ratings or {}).items(),
+            )
+
+    def close_backend(self):
+        self.reader.close()
+        self.db.close()
+
+
+class LogStorage(GroupCommitStorage):
+    # Append-only JSON lines log. Every record holds the latest value for one key, so
+    # recovery is a single replay and compaction rewrites only the live records.
+    def __init__(self, path="rps.log", commit_interval=COMMIT_INTERVAL, compact_ratio=4, compact_min_records=10000):
+        super().__init__(commit_interval)
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.players = {}
+        self.rankings = {}
+        self.ratings = {}
+        self.records = 0
+        self.recover()
+        self.log = open(self.path, "a", encoding="utf-8")
+
+    def recover(self):
+        if not os.path.exists(self.path):
+            return
+        good_offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash, everything before it is intact
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.apply(record)
+                self.records += 1
+                good_offset += len(line)
+        if good_offset != os.path.getsize(self.path):
+            log.warning("Truncating damaged tail of %s at byte %d", self.path, good_offset)
+            with open(self.path, "r+b") as f:
+                f.truncate(good_offset)
+
+    def apply(self, record):
+        if record["t"] == "p":
+            self.players[record["u"]] = record["h"]
+        elif record["t"] == "e":
+            self.ratings[record["u"]] = record["e"]
+        else:
+            self.rankings[record["u"]] = record["s"]
+
+    def read_player(self, username):
+        return self.players.get(username)
+
+    def has_players(self):
+        return bool(self.players)
+
+    def load_rankings(self):
+        return dict(self.rankings)
+
+    def load_ratings(self):
+        return dict(self.ratings)
+
+    def write_batch(self, players, rankings, ratings=None):
+        ratings = ratings or {}
+        lines = [json.dumps({"t": "p", "u": u, "h": h}) for u, h in players.items()]
+        lines += [json.dumps({"t": "r", "u": u, "s": s}) for u, s in rankings.items()]
+        lines += [json.dumps({"t": "e", "u": u, "e": e}) for u, e in ratings.items()]
+        self.log.write("\n".join(lines) + "\n")
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.players.update(players)
+        self.rankings.update(rankings)
+        self.ratings.update(ratings)
+        self.records += len(lines)
+
+        live = len(self.players) + len(self.rankings) + len(self.ratings)
+        if self.records >= self.compact_min_records and self.records > live * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for u, h in self.players.items():
+                f.write(json.dumps({"t": "p", "u": u, "h": h}) + "\n")
+            for u, s in self.rankings.items():
+                f.write(json.dumps({"t": "r", "u": u, "s": s}) + "\n")
+            for u, e in self.ratings.items():
+                f.write(json.dumps({"t": "e", "u": u, "e": e}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.log.close()
+        os.replace(tmp_path, self.path)
+        self.log = open(self.path, "a", encoding="utf-8")
+        self.records = len(self.players) + len(self.rankings) + len(self.ratings)
+
+    def close_backend(self):
+        self.log.close()
+
+
+STORAGE_BACKENDS = {
+    "sqlite": (SQLiteStorage, "rps.db"),
+    "log": (LogStorage, "rps.log"),
+}
+
+
+def read_legacy_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def import_legacy_json(storage, players_path="players.json", rankings_path="rankings.json"):
+    # One time migration from the old whole-file JSON dumps, runs before the flusher starts
+    if storage.has_players():
+        return
+    players = read_legacy_json(players_path)
+    rankings = read_legacy_json(rankings_path)
+    if players or rankings:
+        log.info("Importing %d players and %d rankings from %s and %s", len(players), len(rankings), players_path, rankings_path)
+        storage.write_batch(players, rankings)
+
+
+def open_storage(backend="sqlite", path=None):
+    storage_class, default_path = STORAGE_BACKENDS[backend]
+    storage = storage_class(path or default_path)
+    import_legacy_json(storage)
+    return storage.start()
@@ -0,0 +1,195 @@
+import random
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:  # predictions fall back to a loop over the batch
+    numpy = None
+
+from metrics import REGISTRY
+from rules import RPS, DRAW, FIRST
+from tournament import thread_timer
+
+ORDER = 2  # the bot predicts a player's move from their last ORDER moves
+BOT_ROUNDS = 5
+TICK = 0.02  # seconds games asking for a move are collected into one batch
+
+BOT_GAMES = REGISTRY.gauge("rps_bot_games", "Games against the bot in progress")
+PREDICTIONS = REGISTRY.counter("rps_bot_predictions_total", "Moves computed for the bot")
+TICK_SECONDS = REGISTRY.histogram("rps_bot_tick_seconds", "Time to compute one batch of bot moves")
+TICK_BATCH = REGISTRY.histogram("rps_bot_tick_batch_size", "Bot moves computed per batch", buckets=(1, 10, 100, 1000, 10000))
+
+
+class BotGame:
+    # A player's game of BOT_ROUNDS rounds against the bot. The bot's move for a round is
+    # fixed by the engine before the player is prompted, so it cannot react to their move.
+    def __init__(self, engine, slot):
+        self.engine = engine
+        self.slot = slot
+        self.round = 1
+        self.wins = 0
+        self.losses = 0
+        self.event = None
+        self.bot_move = None
+
+    @property
+    def over(self):
+        return self.round > BOT_ROUNDS
+
+    def prompt(self):
+        return f"Round {self.round}/{BOT_ROUNDS} against the bot! Play your move: {self.engine.rules.prompt}\n"
+
+    def play(self, move):
+        # Plays the player's move against the bot's, returns the round result
+        self.round += 1
+        rules = self.engine.rules
+        if move not in rules.codes:
+            self.losses += 1
+            return f"Invalid move, the bot takes the round with {self.bot_move}.\n"
+        self.engine.observe(self.slot, rules.moves.index(move))
+        outcome = rules.outcome(move, self.bot_move)
+        if outcome == DRAW:
+            return f"Draw! Both chose {move}.\n"
+        if outcome == FIRST:
+            self.wins += 1
+            return f"You take the round! {move} beats {self.bot_move}.\n"
+        self.losses += 1
+        return f"The bot takes the round! {self.bot_move} beats {move}.\n"
+
+    def result(self):
+        if self.wins > self.losses:
+            return f"You beat the bot {self.wins}-{self.losses}!\n"
+        if self.wins < self.losses:
+            return f"The bot wins {self.losses}-{self.wins}.\n"
+        return f"Draw against the bot, {self.wins}-{self.losses}.\n"
+
+
+class BotEngine:
+    # Plays against every player with an order-ORDER Markov model of their moves: counts of
+    # the move they played after each sequence of ORDER moves, kept for as long as the server
+    # runs. The bot plays a move that beats the most likely next move. Games do not compute
+    # their own moves: they ask with request() and every game that asked within `tick`
+    # seconds is served by one vectorized pass over the counts (NumPy when installed).
+    # Moves the players made are queued the same way and counted at the start of the pass,
+    # and a whole batch shares one event, so a tick costs a handful of array operations
+    # and a single wake-up however many games it serves.
+    #
+    # event_factory/call_later are threading.Event and thread_timer for the threaded
+    # server, asyncio.Event and loop.call_later for asyncio. Moves are positions in
+    # rules.moves.
+    def __init__(self, event_factory=threading.Event, call_later=thread_timer, tick=TICK, rules=RPS):
+        self.event_factory = event_factory
+        self.call_later = call_later
+        self.tick_interval = tick
+        self.rules = rules
+        self.moves = len(rules.moves)
+        self.context_count = self.moves ** ORDER
+        # username -> slot; the counts of slot s are rows s * context_count to (s + 1) * context_count
+        self.slots = {}
+        self.capacity = 0
+        if numpy is not None:
+            self.counters = numpy.array(rules.counters, numpy.intp)
+            self.counts = numpy.zeros((0, self.moves), numpy.int32)
+            self.contexts = numpy.zeros(0, numpy.intp)
+        else:
+            self.counts = []
+            self.contexts = []
+        self.pending = []
+        self.batch_event = None
+        # (slot, move) played since the last tick
+        self.observed = []
+        self.lock = threading.Lock()
+
+    def new_game(self, username):
+        with self.lock:
+            slot = self.slots.get(username)
+            if slot is None:
+                slot = self.slots[username] = len(self.slots)
+                if slot == self.capacity:
+                    self.grow()
+        BOT_GAMES.inc()
+        return BotGame(self, slot)
+
+    def end_game(self, game):
+        BOT_GAMES.dec()
+
+    def grow(self):
+        self.capacity = max(64, self.capacity * 2)
+        if numpy is not None:
+            counts = numpy.zeros((self.capacity * self.context_count, self.moves), numpy.int32)
+            counts[:len(self.counts)] = self.counts
+            contexts = numpy.zeros(self.capacity, numpy.intp)
+            contexts[:len(self.contexts)] = self.contexts
+            self.counts, self.contexts = counts, contexts
+        else:
+            self.counts.extend([0] * self.moves for _ in range((self.capacity - len(self.contexts)) * self.context_count))
+            self.contexts.extend([0] * (self.capacity - len(self.contexts)))
+
+    def request(self, game):
+        # game.event fires once game.bot_move holds the bot's move for the next round
+        with self.lock:
+            schedule = not self.pending
+            if schedule:
+                self.batch_event = self.event_factory()
+            self.pending.append(game)
+            game.event = self.batch_event
+        if schedule:
+            self.call_later(self.tick_interval, self.tick)
+
+    def observe(self, slot, move):
+        with self.lock:
+            self.observed.append((slot, move))
+
+    def tick(self):
+        started = time.perf_counter()
+        with self.lock:
+            games, self.pending = self.pending, []
+            observed, self.observed = self.observed, []
+            event = self.batch_event
+            if numpy is not None:
+                self.learn_numpy(observed)
+                moves = self.predict_numpy([game.slot for game in games])
+            else:
+                self.learn(observed)
+                moves = self.predict([game.slot for game in games])
+        for game, move in zip(games, moves):
+            game.bot_move = self.rules.moves[move]
+        if event is not None:
+            event.set()
+        PREDICTIONS.inc(len(games))
+        TICK_BATCH.observe(len(games))
+        TICK_SECONDS.observe(time.perf_counter() - started)
+
+    def predict_numpy(self, slots):
+        slots = numpy.array(slots, numpy.intp)
+        counts = self.counts[slots * self.context_count + self.contexts[slots]]
+        # Noise below 1 only breaks ties, so an unseen context gets a random prediction
+        predicted = (counts + numpy.random.random(counts.shape)).argmax(axis=1)
+        return self.counters[predicted].tolist()
+
+    def predict(self, slots):
+        moves = []
+        for slot in slots:
+            counts = self.counts[slot * self.context_count + self.contexts[slot]]
+            best = max(counts)
+            predicted = random.choice([move for move, count in enumerate(counts) if count == best])
+            moves.append(self.rules.counters[predicted])
+        return moves
+
+    def learn_numpy(self, observed):
+        if not observed:
+            return
+        slots, moves = numpy.array(observed, numpy.intp).T
+        # add.at counts every occurrence should a slot have played twice since the last tick
+        numpy.add.at(self.counts, (slots * self.context_count + self.contexts[slots], moves), 1)
+        self.contexts[slots] = (self.contexts[slots] * self.moves + moves) % self.context_count
+
+    def learn(self, observed):
+        for slot, move in observed:
+            context = self.contexts[slot]
+            self.counts[slot * self.context_count + context][move] += 1
+            self.contexts[slot] = (context * self.moves + move) % self.context_count
+
+    def __len__(self):
+        return len(self.slots)
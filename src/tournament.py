@@ -0,0 +1,273 @@
+import threading
+
+from matchmaking import Match, Ticket, MOVE_TIMEOUT
+from protocol import OUTBOX_LIMIT
+from rules import DRAW, FIRST, VOID
+
+# Bytes of lobby or bracket text shown at once. A spectator is sent an update and the whole
+# state in one go, so this leaves them room in their outbox at any tournament size.
+TEXT_LIMIT = OUTBOX_LIMIT // 4
+TEXT_RESERVE = 100  # of those bytes kept for the line saying what was left out
+
+
+def seed_positions(size):
+    # Standard bracket order for `size` slots (a power of two), e.g. 8 -> [1, 8, 4, 5, 2, 7, 3, 6],
+    # so the top seeds can only meet in the late rounds and byes go to the best players
+    positions = [1]
+    while len(positions) < size:
+        total = len(positions) * 2 + 1
+        positions = [p for seed in positions for p in (seed, total - seed)]
+    return positions
+
+
+def thread_timer(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def format_lobby(name, players, limit=TEXT_LIMIT):
+    text = f"Tournament '{name}' is waiting to start. Players: {', '.join(players)}\n"
+    if len(text.encode()) <= limit:
+        return text
+    # Too many to list: the latest players who fit, and how many there are
+    shown, size = [], 0
+    for player in reversed(players):
+        size += len(player.encode()) + 2
+        if size > limit - TEXT_RESERVE:
+            break
+        shown.append(player)
+    return f"Tournament '{name}' is waiting to start. {len(players)} players, latest: {', '.join(reversed(shown))}\n"
+
+
+def format_pairings(pairings, results):
+    for index, (player1, player2) in enumerate(pairings):
+        pairing = f"{player1 or 'bye'} vs {player2 or 'bye'}"
+        if index in results:
+            pairing += f" -> {results[index] or 'no winner'}"
+        yield f"  {pairing}"
+
+
+def format_bracket(name, bracket):
+    return f"Tournament '{name}' bracket:\n" + bracket.format()
+
+
+def format_update(name, bracket, match):
+    # What spectators are told: the match that just finished, or None when a round starts
+    if match is None:
+        return f"Round {bracket.current_round + 1} of '{name}' is starting.\n"
+    return f"{' vs '.join(match.players)}: {match.result}"
+
+
+def format_result(name, champion):
+    if champion is None:
+        return f"Tournament '{name}' ended without a winner.\n"
+    return f"Tournament '{name}' finished! Winner: {champion}\n"
+
+
+def resolve_match(rules, history, match, tournament_id=0):
+    # (winner, message) of a tournament match whose moves are all in, recorded in the history
+    player1, player2 = match.players
+    move1, move2 = match.moves[player1], match.moves[player2]
+    if move1 is None and move2 is None:
+        winner, message = None, "Neither player moved in time. Both are out.\n"
+    elif move1 is None or move2 is None:
+        winner, loser = (player2, player1) if move1 is None else (player1, player2)
+        message = f"{winner} advances, {loser} forfeited.\n"
+    else:
+        move1, move2 = move1.lower(), move2.lower()
+        winner, message = tournament_outcome(rules, move1, move2, player1, player2)
+    history.record(player1, player2, move1, move2, winner, tournament_id, match.round)
+    return winner, message
+
+
+def tournament_outcome(rules, move1, move2, player1, player2):
+    outcome = rules.outcome(move1, move2)
+    if outcome == VOID:
+        return None, "Invalid move. Match voided.\n"
+    if outcome == DRAW:
+        # In tournament, no draws allowed - player1 advances
+        return player1, f"Draw! {player1} advances by default.\n"
+    winner = player1 if outcome == FIRST else player2
+    return winner, f"{winner} wins with {move1 if winner == player1 else move2}!\n"
+
+
+class Bracket:
+    # Single elimination bracket. rounds[r] is the list of (player1, player2) pairings of
+    # round r, where None is an empty slot (a bye); results[r] maps pairing index -> winner.
+    def __init__(self, players):
+        # players are ordered by seed, best first
+        size = 2
+        while size < len(players):
+            size *= 2
+        slots = [players[seed - 1] if seed <= len(players) else None for seed in seed_positions(size)]
+        self.rounds = [list(zip(slots[0::2], slots[1::2]))]
+        self.results = [{}]
+        self.champion = None
+        self.finished = False
+
+    @property
+    def current_round(self):
+        return len(self.rounds) - 1
+
+    def record(self, index, winner):
+        self.results[-1][index] = winner
+
+    def round_complete(self):
+        return len(self.results[-1]) == len(self.rounds[-1])
+
+    def advance(self):
+        # Builds the next round from the winners, returns False once the final is decided
+        winners = [self.results[-1][i] for i in range(len(self.rounds[-1]))]
+        if len(winners) == 1:
+            self.champion = winners[0]
+            self.finished = True
+            return False
+        self.rounds.append(list(zip(winners[0::2], winners[1::2])))
+        self.results.append({})
+        return True
+
+    def format(self, limit=TEXT_LIMIT):
+        lines = []
+        for number, (pairings, results) in enumerate(zip(self.rounds, self.results), 1):
+            lines.append(f"Round {number}:")
+            lines.extend(format_pairings(pairings, results))
+        text = "\n".join(lines) + "\n"
+        if len(text.encode()) <= limit:
+            return text
+        # Too big to show whole: a line per finished round, then as much of the current one
+        # as fits
+        lines = [f"Round {number}: {len(pairings)} matches played" for number, pairings in enumerate(self.rounds[:-1], 1)]
+        lines.append(f"Round {len(self.rounds)}:")
+        size = sum(len(line.encode()) + 1 for line in lines)
+        shown = 0
+        for line in format_pairings(self.rounds[-1], self.results[-1]):
+            size += len(line.encode()) + 1
+            if size > limit - TEXT_RESERVE:
+                break
+            lines.append(line)
+            shown += 1
+        lines.append(f"  ... {len(self.rounds[-1]) - shown} more, {len(self.results[-1])} of {len(self.rounds[-1])} decided")
+        return "\n".join(lines) + "\n"
+
+
+class TournamentRunner:
+    # Drives a bracket round by round without recursion. Every match of a round is created
+    # at once and handed to the two players' own sessions, which play them concurrently;
+    # the call that resolves the last match of a round starts the next one. A timer per
+    # round forfeits players who never show up, so a round always finishes.
+    #
+    # resolve(match) -> (winner, message) applies the game rules, on_finish(champion) is
+    # called once the bracket is decided, on_update(match) after each result and with None
+    # when a round starts. event_factory/call_later are threading.Event and thread_timer for
+    # the threaded server, asyncio.Event and loop.call_later for asyncio.
+    def __init__(self, players, resolve, on_finish, move_timeout=MOVE_TIMEOUT,
+                 event_factory=threading.Event, call_later=thread_timer, on_update=None):
+        self.bracket = Bracket(players)
+        self.resolve = resolve
+        self.on_finish = on_finish
+        self.on_update = on_update or (lambda match: None)
+        self.move_timeout = move_timeout
+        self.event_factory = event_factory
+        self.call_later = call_later
+        self.alive = set(players)
+        self.round_matches = []
+        # username -> match of the current round the player has not picked up yet
+        self.ready = {}
+        # username -> ticket of a player waiting for their next match
+        self.tickets = {}
+        self.lock = threading.RLock()
+
+    @property
+    def finished(self):
+        return self.bracket.finished
+
+    def start(self):
+        with self.lock:
+            self.start_round()
+
+    def start_round(self):
+        while True:
+            self.round_matches = []
+            for index, (player1, player2) in enumerate(self.bracket.rounds[-1]):
+                if player1 is None or player2 is None:
+                    self.bracket.record(index, player1 or player2)
+                    continue
+                match = Match(player1, player2, self.move_timeout, self.event_factory())
+                match.index = index
+                match.round = self.bracket.current_round + 1
+                self.round_matches.append(match)
+                for player in match.players:
+                    self.deliver(player, match)
+
+            if self.round_matches:
+                self.on_update(None)
+                self.call_later(self.move_timeout + 1, lambda number=self.bracket.current_round: self.expire_round(number))
+                return
+            # A round made only of byes is already decided
+            if not self.bracket.advance():
+                self.finish()
+                return
+
+    def deliver(self, player, match):
+        ticket = self.tickets.pop(player, None)
+        if ticket is None:
+            self.ready[player] = match
+        else:
+            ticket.match = match
+            ticket.event.set()
+
+    def ticket(self, username):
+        # The player's next match; the ticket event fires when it is ready. A ticket without
+        # a match means the player is out or the tournament is over.
+        with self.lock:
+            if username in self.ready:
+                ticket = Ticket(self.event_factory(), self.ready.pop(username))
+            elif self.finished or username not in self.alive:
+                ticket = Ticket(self.event_factory())
+            else:
+                ticket = self.tickets[username] = Ticket(self.event_factory())
+                return ticket
+            ticket.event.set()
+            return ticket
+
+    def still_playing(self):
+        # Players still playing when the bracket is decided (the finalists and anyone waiting
+        # for a match) get the final result from their own session right after their last
+        # match result. The set is fixed once finished is.
+        with self.lock:
+            players = set(self.alive)
+            for match in self.round_matches:
+                players.update(match.players)
+            return players
+
+    def finish_match(self, match):
+        with self.lock:
+            winner, match.result = self.resolve(match)
+            for player in match.players:
+                if player != winner:
+                    self.alive.discard(player)
+            self.bracket.record(match.index, winner)
+            match.done.set()
+            self.on_update(match)
+            if not self.bracket.round_complete():
+                return
+            if self.bracket.advance():
+                self.start_round()
+            else:
+                self.finish()
+
+    def expire_round(self, round_number):
+        with self.lock:
+            if self.finished or round_number != self.bracket.current_round:
+                return
+            for match in list(self.round_matches):
+                if match.expire():
+                    self.finish_match(match)
+
+    def finish(self):
+        for ticket in self.tickets.values():
+            ticket.event.set()
+        self.tickets.clear()
+        self.on_finish(self.bracket.champion)